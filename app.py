@@ -1,3 +1,13 @@
+import os
+
+# Cooperative workers must patch the stdlib before anything else is imported
+if os.environ.get("SOCKETIO_ASYNC_MODE") == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+elif os.environ.get("SOCKETIO_ASYNC_MODE") == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+
 from flask import Flask, session, redirect, url_for
 from login import login_bp
 from signup import signup_bp
@@ -5,13 +15,29 @@ from chat import chat_bp
 from send_message import send_bp
 from profiles import profile_bp
 from groups import groups_bp
-from flask_socketio import SocketIO
+from sockets import socketio
+import db_config
+import fanout
+import archive
+import metrics
+import assets
+import compression
+from blob_store import MAX_UPLOAD_BYTES
 
 app = Flask(__name__)
-# socketio = SocketIO(app, cors_allowed_origins="*")
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
+fanout.init_socketio(app, socketio)
 
 app.secret_key = "supersecretkey"
+# Reject oversized bodies before Werkzeug parses them (1 MB slack for form fields)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 1024 * 1024
+# Apache mod_xsendfile / lighttpd: the server streams files Flask points at
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "0") == "1"
+
+db_config.init_app(app)
+archive.start_background(app)
+metrics.init_app(app, socketio)
+assets.init_app(app)
+compression.init_app(app)
 
 # Register blueprints
 app.register_blueprint(login_bp)
@@ -28,4 +54,4 @@ def logout():
 
 if __name__ == "__main__":
     # app.run(debug=True)
-    socketio.run(app, debug=True)
\ No newline at end of file
+    socketio.run(app, debug=True, port=int(os.environ.get("PORT", 5000)))
\ No newline at end of file
@@ -0,0 +1,201 @@
+"""Cold tier for old chat history: compressed per-conversation month buckets.
+
+With MESSAGE_ARCHIVE_DAYS set, a background job moves messages from whole
+calendar months older than that age out of ``messages``/``group_messages``
+into ``message_archive``. Each bucket document holds up to
+ARCHIVE_BUCKET_SIZE messages of one conversation and month as one
+zlib-compressed BSON array, plus the bounds needed to find it (``start``,
+``end``). The hot collections and their indexes then only hold recent
+messages. history.fetch_* reads across both tiers, so callers do not change.
+
+Every archived message also keeps a small uncompressed stub in
+``message_archive_index`` (text, sender, receiver/group, timestamp and its
+bucket id). Its (conversation_id, message) text index lets /search find
+archived messages, and ``find_by_ids`` lets forwarding resolve them by _id.
+The stubs give back part of the storage saved; attachments, receipts and the
+rest of the message stay only in the compressed bucket.
+
+Bucket ids are derived from (conversation, month, part). Re-running the job
+after a crash finds the bucket that already exists and only deletes the hot
+copies, so nothing is stored twice. Stubs are upserted before the hot copies
+are deleted, so a message is always reachable from one tier or the other.
+"""
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import bson
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get("MESSAGE_ARCHIVE_DAYS", 0))  # 0 disables the job
+ARCHIVE_BUCKET_SIZE = int(os.environ.get("ARCHIVE_BUCKET_SIZE", 200))
+ARCHIVE_INTERVAL = int(os.environ.get("ARCHIVE_INTERVAL_SECONDS", 3600))
+SOURCES = ("messages", "group_messages")
+COLLECTION = "message_archive"
+INDEX_COLLECTION = "message_archive_index"
+STUB_FIELDS = ("sender", "receiver", "group_id", "message", "timestamp")
+
+
+def _month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def _next_month(dt):
+    return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+
+def pack(messages):
+    return bson.Binary(zlib.compress(bson.encode({"m": messages}), 6))
+
+
+def unpack(bucket):
+    """The bucket's messages, oldest first, as stored in the hot tier."""
+    messages = bson.decode(zlib.decompress(bucket["data"]))["m"]
+    for m in messages:
+        m["conversation_id"] = bucket["conversation_id"]
+    return messages
+
+
+def _strip(m):
+    # Every message in a bucket shares its conversation_id
+    m = dict(m)
+    m.pop("conversation_id", None)
+    return m
+
+
+def _index(db, bucket_id, conversation_id, messages):
+    """Upsert the search/lookup stubs of one bucket's messages."""
+    ops = [UpdateOne({"_id": m["_id"]},
+                     {"$setOnInsert": {"bucket": bucket_id, "conversation_id": conversation_id,
+                                       **{f: m[f] for f in STUB_FIELDS if f in m}}},
+                     upsert=True)
+           for m in messages]
+    if ops:
+        db[INDEX_COLLECTION].bulk_write(ops, ordered=False)
+
+
+def compact_month(db, source, conversation_id, month):
+    """Archive one conversation's messages for one month; returns messages moved."""
+    hot = db[source]
+    window = {"conversation_id": conversation_id,
+              "timestamp": {"$gte": month, "$lt": _next_month(month)}}
+    moved = 0
+    part = 0
+    while True:
+        batch = list(hot.find(window).sort([("timestamp", 1), ("_id", 1)]).limit(ARCHIVE_BUCKET_SIZE))
+        if not batch:
+            return moved
+        bucket_id = f"{conversation_id}|{month:%Y-%m}|{part}"
+        ids = [m["_id"] for m in batch]
+        try:
+            db[COLLECTION].insert_one({
+                "_id": bucket_id,
+                "source": source,
+                "conversation_id": conversation_id,
+                "start": batch[0]["timestamp"],
+                "end": batch[-1]["timestamp"],
+                "count": len(batch),
+                "data": pack([_strip(m) for m in batch]),
+            })
+        except DuplicateKeyError:
+            # An earlier run stored this bucket; drop only what it holds
+            batch = unpack(db[COLLECTION].find_one({"_id": bucket_id}))
+            ids = [m["_id"] for m in batch]
+        _index(db, bucket_id, conversation_id, batch)
+        moved += hot.delete_many({"_id": {"$in": ids}}).deleted_count
+        part += 1
+
+
+def compact(db, older_than_days=None, now=None):
+    """Archive every whole month older than the cutoff; returns {source: messages moved}."""
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    cutoff = _month_start((now or datetime.utcnow()) - timedelta(days=days))
+    moved = {}
+    for source in SOURCES:
+        moved[source] = 0
+        pipeline = [
+            {"$match": {"timestamp": {"$lt": cutoff}, "conversation_id": {"$exists": True}}},
+            {"$group": {"_id": {"c": "$conversation_id", "y": {"$year": "$timestamp"},
+                                "m": {"$month": "$timestamp"}}}},
+        ]
+        for row in db[source].aggregate(pipeline, allowDiskUse=True):
+            month = datetime(row["_id"]["y"], row["_id"]["m"], 1)
+            moved[source] += compact_month(db, source, row["_id"]["c"], month)
+    return moved
+
+
+def buckets_before(db, conversation_id, ts=None):
+    """Buckets that may hold messages older than ``ts``, newest first."""
+    query = {"conversation_id": conversation_id}
+    if ts is not None:
+        query["start"] = {"$lte": ts}
+    return db[COLLECTION].find(query).sort("start", -1)
+
+
+def buckets_after(db, conversation_id, ts):
+    """Buckets that may hold messages newer than ``ts``, oldest first."""
+    return db[COLLECTION].find({"conversation_id": conversation_id, "end": {"$gte": ts}}).sort("start", 1)
+
+
+def find_message(db, conversation_id, ts, oid):
+    """An archived message by timestamp and _id, or None."""
+    for bucket in db[COLLECTION].find({"conversation_id": conversation_id,
+                                       "start": {"$lte": ts}, "end": {"$gte": ts}}):
+        for m in unpack(bucket):
+            if m["_id"] == oid:
+                return m
+    return None
+
+
+def find_by_ids(db, oids):
+    """{_id: archived message} for those of ``oids`` that were archived."""
+    wanted = {}
+    for stub in db[INDEX_COLLECTION].find({"_id": {"$in": list(oids)}}, {"bucket": 1}):
+        wanted.setdefault(stub["bucket"], set()).add(stub["_id"])
+    found = {}
+    for bucket in db[COLLECTION].find({"_id": {"$in": list(wanted)}}):
+        for m in unpack(bucket):
+            if m["_id"] in wanted[bucket["_id"]]:
+                found[m["_id"]] = m
+    return found
+
+
+def _acquire_lease(db, seconds):
+    """One worker per interval runs the job, however many processes are up."""
+    now = datetime.utcnow()
+    try:
+        return db["jobs"].find_one_and_update(
+            {"_id": "archive", "$or": [{"lease_until": {"$lt": now}}, {"lease_until": {"$exists": False}}]},
+            {"$set": {"lease_until": now + timedelta(seconds=seconds)}},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        ) is not None
+    except DuplicateKeyError:
+        return False  # someone else holds the lease
+
+
+_started_pid = None
+
+
+def start_background(app):
+    """Run ``compact`` every ARCHIVE_INTERVAL seconds in a daemon thread."""
+    global _started_pid
+    if not ARCHIVE_AFTER_DAYS or _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+
+    def loop():
+        from db_config import get_db
+        while True:
+            try:
+                db = get_db()
+                if _acquire_lease(db, ARCHIVE_INTERVAL):
+                    moved = compact(db)
+                    app.logger.info(f"archived messages: {moved}")
+            except Exception:
+                app.logger.exception("message archive job failed")
+            time.sleep(ARCHIVE_INTERVAL)
+
+    threading.Thread(target=loop, name="message-archive", daemon=True).start()
@@ -0,0 +1,205 @@
+"""Fingerprinted, precompressed static assets.
+
+``python manage.py build-assets`` copies every file under static/, and the
+web fonts under public/fonts/ as fonts/..., to static/dist/ as
+``name.<hash>.ext``. Compressible files also get a ``.gz`` sibling and, when
+the optional ``brotli`` package is installed, a ``.br`` one. The mapping is
+recorded in static/dist/manifest.json. A font whose bytes do not match its
+extension is skipped rather than published.
+
+A build is written to a staging directory and moved into static/dist/ file
+by file, the manifest last. Files named by the previous manifest are kept
+and only older ones pruned, so workers still running the previous deploy
+keep serving their URLs during a rollout.
+
+Templates link ``asset_url("styles.css")``. That is the /assets/ URL when the
+manifest lists the file, else /static/<path>?v=<hash>, so a checkout without
+a build still works. /assets/ responses are cached for a year as immutable
+and served precompressed according to Accept-Encoding.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import tempfile
+
+from flask import abort, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, "static")
+FONTS_DIR = os.path.join(ROOT, "public", "fonts")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE = {".css", ".js", ".json", ".svg", ".html", ".txt", ".ttf", ".eot"}
+# Leading bytes per font extension; svg and eot are checked separately
+FONT_SIGNATURES = {
+    ".woff2": (b"wOF2",),
+    ".woff": (b"wOFF",),
+    ".ttf": (b"\x00\x01\x00\x00", b"true"),
+    ".otf": (b"OTTO",),
+}
+FONT_EXTENSIONS = set(FONT_SIGNATURES) | {".svg", ".eot"}
+
+_manifest = None
+_source_hashes = {}
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _is_font(name, data):
+    ext = os.path.splitext(name)[1].lower()
+    if ext in FONT_SIGNATURES:
+        return data.startswith(FONT_SIGNATURES[ext])
+    if ext == ".eot":
+        return data[34:36] == b"LP"  # EOT magic number
+    if ext == ".svg":
+        return b"<svg" in data[:4096]
+    return False
+
+
+def _sources():
+    """(logical path, file path) for everything that gets fingerprinted."""
+    for base, prefix in ((STATIC_DIR, ""), (FONTS_DIR, "fonts/")):
+        if not os.path.isdir(base):
+            continue
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != DIST_DIR]
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                logical = prefix + os.path.relpath(path, base).replace(os.sep, "/")
+                if prefix == "fonts/" and os.path.splitext(filename)[1].lower() not in FONT_EXTENSIONS:
+                    continue
+                yield logical, path
+
+
+def brotli_module():
+    try:
+        import brotli  # optional dependency
+        return brotli
+    except ImportError:
+        return None
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _publish(staging, dist_dir):
+    """Move every staged file into ``dist_dir``; manifest.json goes last."""
+    staged = []
+    for dirpath, _, filenames in os.walk(staging):
+        staged.extend(os.path.relpath(os.path.join(dirpath, name), staging) for name in filenames)
+    staged.sort(key=lambda rel: rel == "manifest.json")
+    for rel in staged:
+        out = os.path.join(dist_dir, rel)
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        os.replace(os.path.join(staging, rel), out)
+
+
+def _prune(dist_dir, keep):
+    """Delete built files (and their .gz/.br) whose target is not in ``keep``."""
+    for dirpath, dirnames, filenames in os.walk(dist_dir, topdown=False):
+        for name in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, name), dist_dir).replace(os.sep, "/")
+            base = rel[:-3] if rel.endswith((".gz", ".br")) else rel
+            if rel != "manifest.json" and base not in keep:
+                os.remove(os.path.join(dirpath, name))
+        if dirpath != dist_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+
+def build(dist_dir=DIST_DIR):
+    """Write fingerprinted copies and their compressed siblings; returns (manifest, skipped paths)."""
+    brotli = brotli_module()
+    os.makedirs(dist_dir, exist_ok=True)
+    previous = _read_manifest(os.path.join(dist_dir, "manifest.json"))
+    # Inside dist_dir: same filesystem for os.replace, and never walked as a source
+    staging = tempfile.mkdtemp(prefix=".build-", dir=dist_dir)
+    try:
+        manifest, skipped = {}, []
+        for logical, path in _sources():
+            with open(path, "rb") as f:
+                data = f.read()
+            if logical.startswith("fonts/") and not _is_font(logical, data):
+                skipped.append(os.path.relpath(path, ROOT))
+                continue
+            stem, ext = os.path.splitext(logical)
+            target = f"{stem}.{_digest(data)}{ext}"
+            out = os.path.join(staging, *target.split("/"))
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            with open(out, "wb") as f:
+                f.write(data)
+            if ext.lower() in COMPRESSIBLE:
+                with open(out + ".gz", "wb") as f:
+                    f.write(gzip.compress(data, 9, mtime=0))
+                if brotli is not None:
+                    with open(out + ".br", "wb") as f:
+                        f.write(brotli.compress(data, quality=11))
+            manifest[logical] = target
+
+        with open(os.path.join(staging, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        _publish(staging, dist_dir)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    _prune(dist_dir, set(manifest.values()) | set(previous.values()))
+    return manifest, skipped
+
+
+def _load_manifest():
+    global _manifest
+    if _manifest is None:
+        _manifest = _read_manifest(MANIFEST)
+    return _manifest
+
+
+def asset_url(path):
+    """URL of a static file that changes whenever its content does."""
+    target = _load_manifest().get(path)
+    if target:
+        return url_for("assets", filename=target)
+    version = _source_hashes.get(path)
+    if version is None:
+        try:
+            with open(os.path.join(STATIC_DIR, *path.split("/")), "rb") as f:
+                version = _source_hashes[path] = _digest(f.read())
+        except OSError:
+            version = ""
+    return url_for("static", filename=path, v=version or None)
+
+
+def serve_asset(filename):
+    if filename.endswith((".gz", ".br")) or filename == "manifest.json":
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encodings = request.accept_encodings
+    response = None
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        path = safe_join(DIST_DIR, filename + suffix)
+        if encodings[encoding] and path and os.path.isfile(path):
+            response = send_from_directory(DIST_DIR, filename + suffix, mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+            break
+    if response is None:
+        response = send_from_directory(DIST_DIR, filename, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    app.add_url_rule("/assets/<path:filename>", "assets", serve_asset)
+    app.add_template_global(asset_url)
@@ -0,0 +1,119 @@
+"""Storage and index size of the hot tier before and after archiving.
+
+    python -m bench.archive --db bench_chat [--conversations 200] [--per-conversation 2000] [--days 365]
+                            [--json out.json]
+
+Seeds the scratch database named by ``--db`` (see bench.scratch; dropped first)
+with synthetic direct messages spread evenly over ``--days``. It then archives
+everything older than 30 days and reports collStats for both tiers, plus the
+latency of a /history page read from each tier. Needs a reachable MongoDB
+(MONGO_URI).
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import archive
+from bench import scratch
+from history import encode_cursor, fetch_page
+from indexes import ensure_indexes
+
+WORDS = ("ok", "see you", "on my way", "lunch?", "sending the file now", "thanks!",
+         "can we move the call", "haha", "sounds good", "where are you")
+
+
+def seed(db, conversations, per_conversation, days):
+    now = datetime.utcnow()
+    span = timedelta(days=days).total_seconds()
+    for c in range(conversations):
+        a, b = f"user{c}", f"peer{c}"
+        cid = f"dm:{a}:{b}"
+        docs = []
+        for i in range(per_conversation):
+            ts = now - timedelta(seconds=span * (per_conversation - i) / per_conversation)
+            sender, receiver = (a, b) if i % 2 else (b, a)
+            docs.append({"_id": ObjectId(), "sender": sender, "receiver": receiver,
+                         "type": "text", "message": random.choice(WORDS) + f" #{i}", "status": "read",
+                         "timestamp": ts, "conversation_id": cid})
+        db["messages"].insert_many(docs, ordered=False)
+
+
+def sizes(db):
+    out = {}
+    for name in ("messages", archive.COLLECTION, archive.INDEX_COLLECTION):
+        stats = db.command("collStats", name) if name in db.list_collection_names() else {}
+        out[name] = {"count": stats.get("count", 0), "storage_bytes": stats.get("storageSize", 0),
+                     "index_bytes": stats.get("totalIndexSize", 0)}
+    return out
+
+
+def page_latency(db, conversations, rounds=200):
+    """Median ms to read a 50-message page from the hot tier and from the archive."""
+    coll = db["messages"]
+    # Cursor 300 days back: the page comes entirely from archive buckets
+    old_cursor = encode_cursor({"timestamp": datetime.utcnow() - timedelta(days=300),
+                                "_id": ObjectId("f" * 24)})
+    hot, cold = [], []
+    for _ in range(rounds):
+        c = random.randrange(conversations)
+        base = {"conversation_id": f"dm:user{c}:peer{c}"}
+        start = time.perf_counter()
+        fetch_page(coll, base)
+        hot.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        fetch_page(coll, base, before=old_cursor)
+        cold.append(time.perf_counter() - start)
+    return {"hot_page_p50_ms": round(statistics.median(hot) * 1000, 2),
+            "archived_page_p50_ms": round(statistics.median(cold) * 1000, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    scratch.add_argument(parser)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--per-conversation", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    db = scratch.use(args.db)
+    db["messages"].drop()
+    db[archive.COLLECTION].drop()
+    db[archive.INDEX_COLLECTION].drop()
+    ensure_indexes(db)
+    seed(db, args.conversations, args.per_conversation, args.days)
+    before = sizes(db)
+
+    start = time.perf_counter()
+    moved = archive.compact(db, older_than_days=30)
+    elapsed = time.perf_counter() - start
+    db.command("compact", "messages")  # release freed pages so storageSize reflects the move
+    after = sizes(db)
+
+    result = {"before": before, "after": after, "archived": moved["messages"],
+              "compaction_seconds": round(elapsed, 2), **page_latency(db, args.conversations)}
+    total_before = before["messages"]["storage_bytes"] + before["messages"]["index_bytes"]
+    total_after = sum(t["storage_bytes"] + t["index_bytes"] for t in after.values())
+    result["total_bytes_before"] = total_before
+    result["total_bytes_after"] = total_after
+
+    for label, stats in (("before", before), ("after", after)):
+        for name, s in stats.items():
+            print(f"{label:6} {name:21} docs={s['count']:>9} storage={s['storage_bytes']:>12} "
+                  f"indexes={s['index_bytes']:>12}")
+    print(f"archived {moved['messages']} messages in {elapsed:.1f}s; "
+          f"storage+indexes {total_before} -> {total_after} bytes")
+    print(f"page read p50: hot {result['hot_page_p50_ms']} ms, archived {result['archived_page_p50_ms']} ms")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Throughput of direct insert_one vs. batched ingestion.
+
+    python -m bench.ingest --db bench_chat [--messages 20000] [--concurrency 1 8 64] [--json out.json]
+
+Writes into the scratch database named by ``--db`` (see bench.scratch), whose
+messages collection is dropped before every run; needs a reachable MongoDB
+(MONGO_URI).
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from datetime import datetime
+
+from bench import scratch
+from db_config import get_db
+from ingest import BatchWriter
+
+
+def _message(i):
+    return {"sender": f"user{i % 50}", "receiver": "bench", "type": "text",
+            "message": f"message {i}", "status": "sent", "timestamp": datetime.utcnow(),
+            "conversation_id": f"dm:bench:user{i % 50}"}
+
+
+def run(mode, total, concurrency):
+    db = get_db()
+    db["messages"].drop()
+    writer = BatchWriter() if mode == "batched" else None
+    latencies = []
+    lock = threading.Lock()
+    per_thread = total // concurrency
+
+    def sender(offset):
+        mine = []
+        for i in range(per_thread):
+            doc = _message(offset + i)
+            start = time.perf_counter()
+            if writer:
+                writer.submit("messages", doc, timeout=30).result(timeout=30)
+            else:
+                db["messages"].insert_one(doc)
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=sender, args=(n * per_thread,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "mode": mode,
+        "concurrency": concurrency,
+        "messages": len(latencies),
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+    if writer:
+        result["batches"] = writer.batches
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    scratch.add_argument(parser)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+    scratch.use(args.db)
+
+    results = []
+    print(f"{'mode':8} {'conc':>5} {'msgs/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for concurrency in args.concurrency:
+        for mode in ("direct", "batched"):
+            r = run(mode, args.messages, concurrency)
+            results.append(r)
+            print(f"{r['mode']:8} {r['concurrency']:>5} {r['msgs_per_sec']:>10} {r['p50_ms']:>8} {r['p99_ms']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
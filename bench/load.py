@@ -0,0 +1,342 @@
+"""HTTP and Socket.IO load test for the chat backend.
+
+    python -m bench.load --db bench_chat [--base-url http://localhost:5001] [--concurrency 1 8 32]
+                         [--requests 200] [--scenarios ...] [--swarm 50]
+                         [--seed] [--json out.json] [--baseline previous.json]
+
+Each scenario runs at every concurrency level. Each virtual user is its own
+logged-in ``bench<i>`` account issuing ``--requests`` requests. Without
+``--base-url`` the app is driven in-process through Flask's test client. That
+works against MONGO_URI=mongomock:// as well, with no server at all.
+``--db`` names the scratch database the bench accounts live in (see
+bench.scratch); ``--seed`` refills it first (see bench.seed). Against a
+running server, that server must use the same database.
+
+The Socket.IO swarm needs ``--base-url`` and ``python-socketio[client]``.
+``--swarm`` receivers connect, and as many senders post direct messages to
+them; the latency is measured from the POST to the ``new_message`` event.
+
+Results are JSON: one row per scenario and concurrency, with throughput,
+errors and p50/p95/p99 in ms. ``--baseline`` prints the change against an
+earlier run.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+
+from bench import scratch
+from bench.seed import BENCH_PASSWORD, seed, username
+import membership
+
+GROUP_SCENARIOS = {"chat_group", "group_profile", "available_users"}
+SCENARIOS = ("login", "chat_dm", "chat_group", "thread_switch", "send_message", "forward_message",
+             "group_profile", "available_users")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None  # time the handler itself, not the page it redirects to
+
+
+class HttpClient:
+    """One browser-like session against a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar), _NoRedirect)
+
+    def request(self, method, path, form=None, json_body=None, headers=None):
+        data = None
+        headers = dict(headers or {})
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers["Content-Type"] = "application/json"
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def cookie_header(self):
+        return "; ".join(f"{c.name}={c.value}" for c in self.jar)
+
+
+class FlaskClient:
+    """The same interface over Flask's test client, in this process."""
+
+    _app = None
+
+    def __init__(self):
+        if FlaskClient._app is None:
+            from app import app
+            FlaskClient._app = app
+        self.client = FlaskClient._app.test_client()
+
+    def request(self, method, path, form=None, json_body=None, headers=None):
+        resp = self.client.open(path, method=method, data=form, json=json_body, headers=headers)
+        resp.close()
+        return resp.status_code
+
+
+def _client(args):
+    return HttpClient(args.base_url) if args.base_url else FlaskClient()
+
+
+def _login(client, name):
+    return client.request("POST", "/login", form={"username": name, "password": BENCH_PASSWORD})
+
+
+def _context(db, index, users):
+    """Per virtual user: its account, a DM peer, one of its groups (None if it has none), a message it can forward."""
+    name = username(index % users)
+    peer = username((index + 1) % users)
+    group_ids = membership.group_ids_for(db, name)
+    msg = db["messages"].find_one({"sender": name}, {"_id": 1})
+    return {"user": name, "peer": peer, "group": group_ids[0] if group_ids else None,
+            "message_id": str(msg["_id"]) if msg else None}
+
+
+def _scenario(name, client, ctx):
+    """Issue one request of the scenario; returns the status code."""
+    if name == "login":
+        return _login(client, ctx["user"])
+    if name == "chat_dm":
+        return client.request("GET", "/chat?" + urllib.parse.urlencode({"user": ctx["peer"]}))
+    if name == "chat_group":
+        return client.request("GET", "/chat?" + urllib.parse.urlencode({"group": ctx["group"]}))
+    if name == "thread_switch":
+        return client.request("GET", "/chat/thread?" + urllib.parse.urlencode({"user": ctx["peer"]}),
+                              headers={"Accept-Encoding": "gzip, br"})
+    if name == "send_message":
+        return client.request("POST", "/send_message", headers={"Accept": "application/json"},
+                              form={"receiver": ctx["peer"], "chat_type": "user", "message": "bench message"})
+    if name == "forward_message":
+        return client.request("POST", "/forward_message", json_body={
+            "message_id": ctx["message_id"], "target_id": ctx["peer"], "chat_type": "user"})
+    if name == "group_profile":
+        return client.request("GET", f"/group_profile/{ctx['group']}")
+    if name == "available_users":
+        return client.request("GET", "/available_users?" + urllib.parse.urlencode({"group_id": ctx["group"]}))
+    raise ValueError(f"unknown scenario {name}")
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+def _summarise(name, concurrency, latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": _percentile(latencies, 0.50),
+        "p95_ms": _percentile(latencies, 0.95),
+        "p99_ms": _percentile(latencies, 0.99),
+    }
+
+
+def run_scenario(args, name, concurrency, contexts):
+    """One row of results, or None when no context can run the scenario."""
+    if name in GROUP_SCENARIOS:
+        # Only members may open a group; anyone else would just measure 403s
+        contexts = [c for c in contexts if c["group"]]
+        if not contexts:
+            return None
+    latencies = []
+    errors = [0]
+    spans = []  # (first request start, last request end) per worker
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency)
+
+    def worker(ctx):
+        client = _client(args)
+        if name != "login":
+            _login(client, ctx["user"])
+        ready.wait()
+        mine, failed = [], 0
+        began = time.perf_counter()
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            try:
+                status = _scenario(name, client, ctx)
+            except Exception:
+                status = 0
+            mine.append(time.perf_counter() - start)
+            if not 200 <= status < 400:
+                failed += 1
+        ended = time.perf_counter()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+            spans.append((began, ended))
+
+    threads = [threading.Thread(target=worker, args=(contexts[i % len(contexts)],)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Wall time from the first timed request to the last, measured by the workers themselves
+    elapsed = max(end for _, end in spans) - min(start for start, _ in spans)
+    return _summarise(name, concurrency, latencies, errors[0], elapsed)
+
+
+def run_swarm(args, size, users):
+    """Send-to-receive latency over Socket.IO for ``size`` sender/receiver pairs."""
+    import socketio as python_socketio
+
+    sent = {}
+    latencies = []
+    lock = threading.Lock()
+    clients = []
+    for i in range(size):
+        web = HttpClient(args.base_url)
+        _login(web, username((2 * i + 1) % users))
+        sio = python_socketio.Client()
+
+        @sio.on("new_message")
+        def on_new_message(msg):
+            start = sent.get(msg.get("message"))
+            if start is not None:
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        sio.connect(args.base_url, headers={"Cookie": web.cookie_header()}, transports=["websocket"])
+        clients.append(sio)
+
+    senders = []
+    for i in range(size):
+        web = HttpClient(args.base_url)
+        _login(web, username((2 * i) % users))
+        senders.append((web, username((2 * i + 1) % users)))
+
+    def send(web, receiver):
+        for _ in range(args.swarm_messages):
+            marker = f"swarm:{uuid.uuid4().hex}"
+            sent[marker] = time.perf_counter()
+            web.request("POST", "/send_message", headers={"Accept": "application/json"},
+                         form={"receiver": receiver, "chat_type": "user", "message": marker})
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=send, args=s) for s in senders]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    deadline = time.monotonic() + args.swarm_timeout
+    while len(latencies) < len(sent) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    for sio in clients:
+        sio.disconnect()
+    return _summarise("socketio_delivery", size, latencies, len(sent) - len(latencies), elapsed)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    print(f"\nvs {baseline_path}:")
+    for r in results:
+        old = baseline.get((r["scenario"], r["concurrency"]))
+        if not old or not old.get("p95_ms") or not old.get("rps") or r.get("p95_ms") is None:
+            continue
+        p95 = (r["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+        rps = (r["rps"] - old["rps"]) / old["rps"] * 100
+        print(f"{r['scenario']:18} {r['concurrency']:>5}  p95 {p95:+6.1f}%  rps {rps:+6.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    scratch.add_argument(parser)
+    parser.add_argument("--base-url", help="running server; in-process test client when omitted")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per virtual user")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--seed", action="store_true", help="refill the scratch database first")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--swarm", type=int, default=0, help="Socket.IO sender/receiver pairs")
+    parser.add_argument("--swarm-messages", type=int, default=20)
+    parser.add_argument("--swarm-timeout", type=float, default=10.0)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="earlier --json output to compare against")
+    args = parser.parse_args(argv)
+
+    db = scratch.use(args.db)
+    if args.seed:
+        seed(db, args.users, args.groups, args.members, args.messages)
+    users = db["users"].count_documents({"username": {"$regex": "^bench"}})
+    if not users:
+        parser.error("no bench users; run with --seed or python -m bench.seed")
+    contexts = [_context(db, i, users) for i in range(max(args.concurrency))]
+
+    results = []
+    print(f"{'scenario':18} {'conc':>5} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    runs = [(name, c) for name in args.scenarios for c in args.concurrency]
+    for name, concurrency in runs:
+        r = run_scenario(args, name, concurrency, contexts)
+        if r is None:
+            print(f"{name:18} {concurrency:>5} skipped: no bench user in this run belongs to a group")
+            continue
+        results.append(r)
+        print(f"{r['scenario']:18} {r['concurrency']:>5} {r['rps']:>9} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['p99_ms']:>8} {r['errors']:>7}")
+    if args.swarm:
+        if not args.base_url:
+            parser.error("--swarm needs --base-url")
+        r = run_swarm(args, args.swarm, users)
+        results.append(r)
+        print(f"{r['scenario']:18} {r['concurrency']:>5} {r['rps']:>9} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['p99_ms']:>8} {r['errors']:>7}")
+
+    report = {
+        "meta": {
+            "started": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "target": args.base_url or "in-process",
+            "mongo": os.environ.get("MONGO_URI", "mongodb://").split("://")[0],  # scheme only, no credentials
+            "requests_per_user": args.requests,
+        },
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        _compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
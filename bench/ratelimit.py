@@ -0,0 +1,96 @@
+"""Cost of a rate-limit check, the work added to every send.
+
+    python -m bench.ratelimit [--calls 200000] [--keys 1 10000] [--threads 1 8]
+                              [--redis redis://localhost:6379/15] [--json out.json]
+
+Times LocalBuckets.acquire per call for each key count and thread count,
+then ``ratelimit.check`` inside a Flask request context, which is what the
+decorated routes pay. ``--redis`` adds the shared backend, one script call
+per check (use a scratch database). Limits are set high enough that every
+call is allowed, so each call does the full refill-and-take path.
+"""
+import argparse
+import json
+import platform
+import threading
+import time
+from datetime import datetime
+
+from flask import Flask, session
+
+import ratelimit
+
+UNLIMITED = (1e9, 1e9)
+
+
+def _per_call_ns(storage, calls, keys, threads):
+    names = [f"bench:user:{i}" for i in range(keys)]
+    per_thread = calls // threads
+    ready = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        acquire = storage.acquire
+        ready.wait()
+        for i in range(per_thread):
+            acquire(names[(offset + i) % keys], *UNLIMITED)
+
+    workers = [threading.Thread(target=worker, args=(t * 7919,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    ready.wait()
+    start = time.perf_counter_ns()
+    for w in workers:
+        w.join()
+    return (time.perf_counter_ns() - start) / (per_thread * threads)
+
+
+def _check_ns(calls):
+    app = Flask(__name__)
+    app.secret_key = "bench"
+    ratelimit.LIMITS["bench"] = UNLIMITED
+    with app.test_request_context("/send_message", method="POST"):
+        session["user"] = "bench0"
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            ratelimit.check("bench")
+        return (time.perf_counter_ns() - start) / calls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--keys", type=int, nargs="+", default=[1, 10000])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--redis", help="also time the shared backend against this URL")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    backends = [("memory", ratelimit.LocalBuckets(), args.calls)]
+    if args.redis:
+        # Network round trips: fewer calls give a stable figure
+        shared = ratelimit.RedisBuckets(args.redis, prefix="bench:ratelimit:")
+        shared.redis.ping()  # acquire() falls back to local buckets; fail loudly instead
+        backends.append(("redis", shared, max(args.calls // 20, 1000)))
+
+    results = []
+    print(f"{'backend':8} {'keys':>6} {'threads':>7} {'ns/call':>10}")
+    for name, storage, calls in backends:
+        for keys in args.keys:
+            for threads in args.threads:
+                ns = _per_call_ns(storage, calls, keys, threads)
+                results.append({"backend": name, "keys": keys, "threads": threads, "ns_per_call": round(ns, 1)})
+                print(f"{name:8} {keys:>6} {threads:>7} {ns:>10.1f}")
+
+    ns = _check_ns(args.calls)
+    results.append({"backend": "check()", "keys": 1, "threads": 1, "ns_per_call": round(ns, 1)})
+    print(f"{'check()':8} {1:>6} {1:>7} {ns:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"meta": {"started": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+                                "python": platform.python_version(), "calls": args.calls},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""The scratch database the bench scripts write to.
+
+Seeding and the write benchmarks drop whole collections, so they never fall
+back to MONGO_DB_NAME from the environment. Every script takes a required
+``--db``, and ``use`` refuses any name that does not start with one of
+SCRATCH_PREFIXES or that is the application's configured database.
+"""
+import os
+
+import db_config
+
+SCRATCH_PREFIXES = ("bench", "scratch")
+
+
+def add_argument(parser):
+    parser.add_argument("--db", required=True, metavar="NAME",
+                        help=f"scratch database, dropped and refilled; must start with {' or '.join(SCRATCH_PREFIXES)}")
+
+
+def check(name):
+    """Exit unless ``name`` is a dedicated scratch database."""
+    if not name.startswith(SCRATCH_PREFIXES) or name == os.environ.get("MONGO_DB_NAME"):
+        raise SystemExit(f"refusing to drop collections in {name!r}: pass --db with a scratch database "
+                         f"name starting with {' or '.join(SCRATCH_PREFIXES)} (not MONGO_DB_NAME)")
+
+
+def use(name):
+    """Make ``name`` the database get_db() returns in this process, after ``check``."""
+    check(name)
+    db_config.MONGO_DB_NAME = name
+    return db_config.get_db()
@@ -0,0 +1,111 @@
+"""Synthetic users, groups and messages for the benchmarks.
+
+    python -m bench.seed --db bench_chat [--users 500] [--groups 50] [--members 20] [--messages 50000]
+
+Drops and refills the scratch database named by ``--db`` (see bench.scratch).
+Every user is ``bench<i>`` with password BENCH_PASSWORD. Direct threads pair
+each user with the next one; messages are spread over those threads and the
+groups, and every thread gets its sidebar summary. Use MONGO_URI=mongomock://
+to seed the in-process stand-in instead of a server.
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from werkzeug.security import generate_password_hash
+
+from bench import scratch
+import membership
+from conversations import conversation_id_for, record_message
+from indexes import ensure_indexes
+
+BENCH_PASSWORD = "bench-password"
+WORDS = ("ok", "see you soon", "on my way", "lunch?", "sending the file now", "thanks!",
+         "can we move the call", "haha", "sounds good", "where are you", "meeting notes attached")
+COLLECTIONS = ("users", "groups", "group_members", "messages", "group_messages", "conversations",
+               "read_state", "message_archive")
+
+
+def username(i):
+    return f"bench{i}"
+
+
+def seed(db, users=500, groups=50, members=20, messages=50000, days=30):
+    """Fill the database; returns {"users": [...], "groups": [group ids]}."""
+    scratch.check(db.name)
+    for name in COLLECTIONS:
+        db[name].drop()
+    ensure_indexes(db)
+
+    # One hash shared by every account: seeding stays fast, login still pays the real cost
+    password = generate_password_hash(BENCH_PASSWORD)
+    names = [username(i) for i in range(users)]
+    db["users"].insert_many([
+        {"username": name, "email": f"{name}@bench.local", "password": password,
+         "profile_image": "/static/default_profile.png"}
+        for name in names
+    ])
+
+    group_ids = []
+    for i in range(groups):
+        creator = names[i % users]
+        group_id = db["groups"].insert_one({
+            "name": f"Bench group {i}", "description": "", "created_by": creator,
+            "image": "/static/default_profile.png", "member_count": 0,
+            "created_at": datetime.utcnow(),
+        }).inserted_id
+        membership.add_members(db, group_id, [creator], role=membership.ROLE_ADMIN)
+        membership.add_members(db, group_id, random.sample(names, min(members, users)))
+        group_ids.append(str(group_id))
+
+    group_members = {gid: membership.members_of(db, gid) for gid in group_ids}
+
+    # Half the messages in direct threads, half in groups
+    start = datetime.utcnow() - timedelta(days=days)
+    step = timedelta(days=days) / max(messages, 1)
+    batches = {"messages": [], "group_messages": []}
+    last = {}
+    for n in range(messages):
+        ts = start + step * n
+        if n % 2 or not group_ids:
+            i = random.randrange(users)
+            a, b = names[i], names[(i + 1) % users]
+            sender, receiver = (a, b) if random.random() < 0.5 else (b, a)
+            doc = {"_id": ObjectId(), "sender": sender, "receiver": receiver, "status": "read"}
+            collection = "messages"
+        else:
+            group_id = random.choice(group_ids)
+            doc = {"_id": ObjectId(), "sender": random.choice(group_members[group_id]),
+                   "group_id": group_id}
+            collection = "group_messages"
+        doc.update({"type": "text", "message": random.choice(WORDS), "timestamp": ts})
+        doc["conversation_id"] = conversation_id_for(doc)
+        batches[collection].append(doc)
+        last[doc["conversation_id"]] = doc
+        if len(batches[collection]) >= 5000:
+            db[collection].insert_many(batches[collection], ordered=False)
+            batches[collection] = []
+    for collection, docs in batches.items():
+        if docs:
+            db[collection].insert_many(docs, ordered=False)
+
+    for doc in last.values():
+        record_message(db, doc)
+    return {"users": names, "groups": group_ids}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    scratch.add_argument(parser)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50000)
+    args = parser.parse_args(argv)
+    seed(scratch.use(args.db), args.users, args.groups, args.members, args.messages)
+    print(f"seeded {args.users} users, {args.groups} groups, {args.messages} messages")
+
+
+if __name__ == "__main__":
+    main()
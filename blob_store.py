@@ -0,0 +1,154 @@
+"""Content-addressed storage for uploaded files.
+
+Uploads are streamed to a temporary file in fixed-size chunks while being
+hashed, then stored once under ``uploads/blobs/<aa>/<sha256>.<ext>``. The
+``blobs`` collection keeps a reference count per hash, so re-sending or
+forwarding a file only adds a reference; the file is deleted when the last
+reference is released. A blob holds one reference to its thumbnail (see
+thumbnails.py), dropped when the blob itself goes.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from datetime import datetime
+
+from pymongo import ReturnDocument
+from werkzeug.utils import secure_filename
+
+UPLOAD_FOLDER = os.environ.get(
+    "UPLOAD_FOLDER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads"))
+BLOB_DIR = "blobs"
+CHUNK_SIZE = 64 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 5 * 1024 * 1024))
+
+_BLOB_URL = re.compile(r"^/uploads/blobs/[0-9a-f]{2}/([0-9a-f]{64})(?:\.\w+)?$")
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+def blob_relpath(digest, ext=""):
+    name = f"{digest}.{ext}" if ext else digest
+    return f"{BLOB_DIR}/{digest[:2]}/{name}"
+
+
+def blob_url(relpath):
+    return f"/uploads/{relpath}"
+
+
+def hash_from_url(url):
+    """The content hash behind a blob URL, or None for legacy/static URLs."""
+    match = _BLOB_URL.match(url or "")
+    return match.group(1) if match else None
+
+
+def _spool(stream, max_bytes):
+    """Copy ``stream`` to a temp file; returns (sha256 hex, size, temp path)."""
+    tmp_dir = os.path.join(UPLOAD_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLarge(f"File exceeds {max_bytes // (1024 * 1024)} MB limit")
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return digest.hexdigest(), size, tmp_path
+
+
+def _commit(db, digest, size, tmp_path, ext, content_type):
+    """Register one reference to ``digest`` and move the temp file into place if it is new."""
+    blob = db["blobs"].find_one_and_update(
+        {"_id": digest},
+        {
+            "$inc": {"refs": 1},
+            "$setOnInsert": {
+                "path": blob_relpath(digest, ext),
+                "size": size,
+                "ext": ext,
+                "content_type": content_type,
+                "created_at": datetime.utcnow(),
+            },
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    final_path = os.path.join(UPLOAD_FOLDER, blob["path"])
+    if os.path.exists(final_path):
+        os.remove(tmp_path)  # known content: nothing to write
+    else:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+
+    blob["url"] = blob_url(blob["path"])
+    return blob
+
+
+def file_ext(filename):
+    filename = secure_filename(filename or "")
+    return filename.rsplit(".", 1)[1].lower() if "." in filename else ""
+
+
+def save_upload(db, file_storage, max_bytes=MAX_UPLOAD_BYTES):
+    """Store a Werkzeug FileStorage; returns the blob document plus its ``url``.
+
+    Raises UploadTooLarge when the upload exceeds ``max_bytes``.
+    """
+    digest, size, tmp_path = _spool(file_storage.stream, max_bytes)
+    return _commit(db, digest, size, tmp_path, file_ext(file_storage.filename),
+                   file_storage.mimetype)
+
+
+def store_bytes(db, data, ext, content_type=None):
+    """Store generated content (thumbnails, resized images) like an upload."""
+    tmp_dir = os.path.join(UPLOAD_FOLDER, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, "wb") as out:
+        out.write(data)
+    return _commit(db, hashlib.sha256(data).hexdigest(), len(data), tmp_path, ext, content_type)
+
+
+def blob_path(blob):
+    return os.path.join(UPLOAD_FOLDER, blob["path"])
+
+
+def add_ref(db, digest, count=1):
+    """Add ``count`` references to an existing blob (e.g. forwarded messages)."""
+    if digest:
+        db["blobs"].update_one({"_id": digest}, {"$inc": {"refs": count}})
+
+
+def drop_extra_ref(db, digest):
+    """Drop a reference known to be one of several; never deletes the file."""
+    if digest:
+        db["blobs"].update_one({"_id": digest, "refs": {"$gt": 1}}, {"$inc": {"refs": -1}})
+
+
+def release(db, digest):
+    """Drop one reference; deletes the file, and its thumbnail's reference, once nothing refers to it."""
+    if not digest:
+        return
+    blob = db["blobs"].find_one_and_update(
+        {"_id": digest}, {"$inc": {"refs": -1}}, return_document=ReturnDocument.AFTER)
+    if blob and blob["refs"] <= 0:
+        # Only the caller that wins the delete removes the file
+        if db["blobs"].delete_one({"_id": digest, "refs": {"$lte": 0}}).deleted_count:
+            try:
+                os.remove(blob_path(blob))
+            except FileNotFoundError:
+                pass
+            release(db, hash_from_url(blob.get("thumbnail_url")))
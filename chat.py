@@ -1,8 +1,19 @@
-from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify
-from db_config import get_db
+import re
+import time
 from functools import wraps
-from bson import ObjectId
 from datetime import datetime, timedelta
+from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify, make_response
+from bson import ObjectId
+from bson.errors import InvalidId
+from db_config import get_db
+import profile_cache
+import membership
+import images
+from conversations import dm_conversation_id, group_conversation_id, mark_read, summaries_for, unread_counts
+from history import PAGE_SIZE, MAX_PAGE_SIZE, fetch_page, fetch_after, fetch_around, serialize_message, encode_cursor
+import search
+import presence
+from receipts import receipts_since
 
 def get_ist_time():
     try:
@@ -13,6 +24,18 @@ def get_ist_time():
 
 chat_bp = Blueprint("chat", __name__)
 
+DIRECTORY_PAGE_SIZE = 50
+DIRECTORY_MAX_PAGE_SIZE = 100
+# Only what the sidebar and pickers render
+SIDEBAR_GROUP_FIELDS = {"name": 1, "image": 1, "images": 1}
+# A sync older than this many changed threads tells the client to reload instead
+SYNC_MAX_CONVERSATIONS = 200
+# Overlap between syncs covering clock skew between workers; clients drop duplicates by _id
+SYNC_SKEW_MS = 2000
+
+def now_ms():
+    return int(time.time() * 1000)
+
 # Login required decorator
 def login_required(f):
     @wraps(f)
@@ -22,64 +45,381 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def build_sidebar(db, username, groups):
+    """Sidebar entries: threads by recency (one indexed query), then groups without messages.
+
+    Contacts without a thread are not listed here; the page loads them from
+    /directory on demand.
+    """
+    groups_by_id = {str(g["_id"]): g for g in groups}
+    summaries = summaries_for(db, username, list(groups_by_id))
+    unread = unread_counts(db, username, summaries)
+    others = {c["_id"]: next((p for p in c.get("participants", []) if p != username), None)
+              for c in summaries if c.get("kind") != "group"}
+    users_by_name = profile_cache.get_users(db, [o for o in others.values() if o])
+    entries = []
+    seen = set()
+
+    for c in summaries:
+        if c.get("kind") == "group":
+            g = groups_by_id.get(c.get("group_id"))
+            if not g:
+                continue
+            entry = {"kind": "group", "id": str(g["_id"]), "name": g.get("name"),
+                     "image": images.pick(g, images.LIST_SIZE, "image")}
+        else:
+            other = others.get(c["_id"])
+            u = users_by_name.get(other)
+            if not u:
+                continue
+            entry = {"kind": "user", "id": other, "name": other, "image": images.pick(u, images.LIST_SIZE)}
+
+        entry["last_message"] = c.get("last_message", {}).get("text", "")
+        entry["unread"] = unread.get(c["_id"], 0)
+        seen.add((entry["kind"], entry["id"]))
+        entries.append(entry)
+
+    for g in groups:
+        if ("group", str(g["_id"])) not in seen:
+            entries.append({"kind": "group", "id": str(g["_id"]), "name": g.get("name"),
+                            "image": images.pick(g, images.LIST_SIZE, "image"), "last_message": "", "unread": 0})
+    return entries
+
+class ThreadError(Exception):
+    def __init__(self, error, status):
+        super().__init__(error)
+        self.error, self.status = error, status
+
+def load_thread(db, username, selected_user, selected_group_id, anchor=None):
+    """The open thread as JSON: header fields, the first page of messages and its cursors.
+
+    Opening a thread clears its unread counter. ``anchor`` (a message cursor,
+    search "jump to message") opens the thread around that message instead
+    of at the newest one. Raises ThreadError for a bad or forbidden group.
+    """
+    if selected_user:
+        mark_read(db, dm_conversation_id(username, selected_user), username)
+        thread = {"kind": "user", "id": selected_user, "name": selected_user,
+                  "image": images.pick(profile_cache.get_user(db, selected_user), images.HEADER_SIZE)}
+        source = (db["messages"], {"conversation_id": dm_conversation_id(username, selected_user)})
+    else:
+        try:
+            group_obj_id = ObjectId(selected_group_id)
+        except (InvalidId, TypeError):
+            raise ThreadError("Invalid group ID", 400)
+        if not membership.is_member(db, group_obj_id, username):
+            raise ThreadError("Not authorized", 403)
+        mark_read(db, group_conversation_id(selected_group_id), username)
+        group = profile_cache.get_group(db, group_obj_id) or {}
+        thread = {"kind": "group", "id": str(group_obj_id), "name": group.get("name"),
+                  "image": images.pick(group, images.HEADER_SIZE, "image"),
+                  "created_by": group.get("created_by")}
+        source = (db["group_messages"], {"group_id": str(group_obj_id)})
+
+    has_newer = False
+    if anchor:
+        try:
+            messages, has_more, has_newer = fetch_around(*source, anchor)
+        except ValueError:
+            anchor = None
+    if not anchor:
+        messages, has_more = fetch_page(*source)
+
+    # Cursors of the oldest / newest rendered message; the client pages from them
+    thread["history_cursor"] = encode_cursor(messages[0]) if has_more else None
+    thread["newer_cursor"] = encode_cursor(messages[-1]) if has_newer and messages else None
+    thread["anchor"] = anchor
+    thread["messages"] = [serialize_message(m) for m in messages]
+    return thread
+
+def _my_groups(db, username):
+    my_group_ids = [ObjectId(gid) for gid in membership.group_ids_for(db, username)]
+    return list(db["groups"].find({"_id": {"$in": my_group_ids}}, SIDEBAR_GROUP_FIELDS)) if my_group_ids else []
+
 @chat_bp.route("/chat")
 @login_required
 def chat_page():
+    """The page shell. Markup, styles and script are static; the sidebar and the
+    open thread are embedded as JSON and rendered by static/chat.js, which then
+    switches threads through /chat/thread without reloading the page."""
     db = get_db()
-    users_col = db["users"]
-    groups_col = db["groups"]
-
-    current_user = users_col.find_one({"username": session["user"]})
-    profile_image = current_user.get("profile_image") if current_user else None
+    username = session["user"]
+    # Watermark for /sync: changes after this are not in the rendered page
+    page_started = now_ms()
 
-    other_users = list(users_col.find({"username": {"$ne": session["user"]}}))
+    current_user = profile_cache.get_user(db, username)
+    my_groups = _my_groups(db, username)
+    for g in my_groups:
+        g["avatar"] = images.pick(g, images.LIST_SIZE, "image")
 
-    my_groups = list(groups_col.find({"members": session["user"]}))
     selected_user = request.args.get("user")
     selected_group_id = request.args.get("group")
+    thread = None
+    if selected_user or selected_group_id:
+        try:
+            thread = load_thread(db, username, selected_user, selected_group_id, request.args.get("at"))
+        except ThreadError as e:
+            return e.error, e.status
 
-    messages = []
-    selected_group = None
-    
     ist_now = get_ist_time()
-    today_ist = ist_now.strftime("%Y-%m-%d")
-    yesterday_ist = (ist_now - timedelta(days=1)).strftime("%Y-%m-%d")
+    boot = {
+        "user": username,
+        "sidebar": build_sidebar(db, username, my_groups),
+        "thread": thread,
+        "sync_since": page_started,
+        "today_ist": ist_now.strftime("%Y-%m-%d"),
+        "yesterday_ist": (ist_now - timedelta(days=1)).strftime("%Y-%m-%d"),
+        "presence_heartbeat_ms": int(presence.HEARTBEAT_SECONDS * 1000),
+        "typing_interval_ms": int(presence.TYPING_INTERVAL * 1000),
+        "urls": {
+            "chat": url_for("chat.chat_page"),
+            "thread": url_for("chat.thread_data"),
+            "sync": url_for("chat.sync"),
+            "history": url_for("chat.history"),
+            "directory": url_for("chat.directory"),
+            "search": url_for("chat.search_messages"),
+        },
+    }
+    response = make_response(render_template(
+        "chat.html",
+        user=username,
+        groups=my_groups,
+        profile_image=images.pick(current_user, images.HEADER_SIZE),
+        boot=boot,
+    ))
+    # Per-user data inside; the cacheable parts are the /assets/ files it links
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
-    if selected_user:
-        messages = list(db["messages"].find({
-            "$or": [
-                {"sender": session["user"], "receiver": selected_user},
-                {"sender": selected_user, "receiver": session["user"]}
-            ]
-        }).sort("timestamp", 1))
-        for m in messages:
-            if isinstance(m.get("timestamp"), datetime):
-                m["timestamp"] = m["timestamp"].strftime("%Y-%m-%dT%H:%M:%S")
+@chat_bp.route("/chat/thread")
+@login_required
+def thread_data():
+    """JSON for switching threads without a page load: ?user= or ?group=, optional at=.
+
+    Returns the thread (as embedded by /chat), the refreshed sidebar and the
+    ``server_time`` to continue /sync from.
+    """
+    db = get_db()
+    username = session["user"]
+    started = now_ms()
+    selected_user = request.args.get("user")
+    selected_group_id = request.args.get("group")
+    thread = None
+    if selected_user or selected_group_id:
+        try:
+            thread = load_thread(db, username, selected_user, selected_group_id, request.args.get("at"))
+        except ThreadError as e:
+            return jsonify({"error": e.error}), e.status
+    return jsonify({
+        "thread": thread,
+        "sidebar": build_sidebar(db, username, _my_groups(db, username)),
+        "server_time": started,
+    })
+
+@chat_bp.route("/history")
+@login_required
+def history():
+    db = get_db()
+    selected_user = request.args.get("user")
+    selected_group_id = request.args.get("group")
+    before = request.args.get("before")
+    after = request.args.get("after")
 
+    try:
+        limit = min(int(request.args.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    if selected_user:
+        collection = db["messages"]
+        base_filter = {"conversation_id": dm_conversation_id(session["user"], selected_user)}
     elif selected_group_id:
         try:
             group_obj_id = ObjectId(selected_group_id)
         except Exception:
-            return "Invalid group ID", 400
+            return jsonify({"error": "Invalid group ID"}), 400
+        if not membership.is_member(db, group_obj_id, session["user"]):
+            return jsonify({"error": "Not authorized"}), 403
+        collection = db["group_messages"]
+        base_filter = {"group_id": str(group_obj_id)}
+    else:
+        return jsonify({"error": "Missing user or group"}), 400
 
-        selected_group = groups_col.find_one({"_id": group_obj_id})
-        messages = list(db["group_messages"].find({
-            "group_id": str(group_obj_id)
-        }).sort("timestamp", 1))
-        for m in messages:
-            if isinstance(m.get("timestamp"), datetime):
-                m["timestamp"] = m["timestamp"].strftime("%Y-%m-%dT%H:%M:%S")
+    # "before" pages back through older messages, "after" forward to newer ones
+    try:
+        if after:
+            messages, has_more = fetch_after(collection, base_filter, after, limit=max(limit, 1))
+            next_cursor = encode_cursor(messages[-1]) if has_more else None
+        else:
+            messages, has_more = fetch_page(collection, base_filter, before=before, limit=max(limit, 1))
+            next_cursor = encode_cursor(messages[0]) if has_more else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
+    return jsonify({
+        "messages": [serialize_message(m) for m in messages],
+        "next_cursor": next_cursor
+    })
 
-    return render_template(
-        "chat.html",
-        user=session["user"],
-        users=other_users,
-        groups=my_groups,
-        selected_user=selected_user,
-        selected_group=selected_group,
-        messages=messages,
-        profile_image=profile_image,
-        today_ist=today_ist,
-        yesterday_ist=yesterday_ist
-    )
\ No newline at end of file
+@chat_bp.route("/sync")
+@login_required
+def sync():
+    """What changed since a previous page render or sync, for reconnecting clients.
+
+    Query params: since (epoch ms, the ``server_time`` of the last response)
+    and optionally the open thread (user= or group=) with ``after``, the
+    cursor of its newest rendered message. Returns changed thread summaries,
+    the open thread's new messages, receipt watermarks that moved in any
+    recent direct thread or group, and the caller's current groups.
+    ``reload`` is true when the gap is too big to patch.
+    """
+    db = get_db()
+    username = session["user"]
+    try:
+        since_ms = int(request.args.get("since", ""))
+    except ValueError:
+        return jsonify({"error": "Invalid since"}), 400
+    server_time = now_ms()
+    since = datetime.utcfromtimestamp(max(since_ms - SYNC_SKEW_MS, 0) / 1000)
+
+    group_ids = membership.group_ids_for(db, username)
+    mine = {"participants": username}
+    if group_ids:
+        mine = {"$or": [mine, {"_id": {"$in": [group_conversation_id(g) for g in group_ids]}}]}
+    changed = list(db["conversations"]
+                   .find(dict(mine, last_timestamp={"$gt": since}))
+                   .sort("last_timestamp", -1)
+                   .limit(SYNC_MAX_CONVERSATIONS + 1))
+    if len(changed) > SYNC_MAX_CONVERSATIONS:
+        return jsonify({"reload": True, "server_time": server_time})
+    unread = unread_counts(db, username, changed)
+
+    others = {c["_id"]: next((p for p in c.get("participants", []) if p != username), None)
+              for c in changed if c.get("kind") != "group"}
+    users = profile_cache.get_users(db, [o for o in others.values() if o])
+    conversations = []
+    for c in changed:
+        if c.get("kind") == "group":
+            group = profile_cache.get_group(db, c["group_id"]) or {}
+            entry = {"kind": "group", "id": c["group_id"], "name": group.get("name"),
+                     "image": images.pick(group, images.LIST_SIZE, "image")}
+        else:
+            other = others.get(c["_id"])
+            entry = {"kind": "user", "id": other, "name": other,
+                     "image": images.pick(users.get(other), images.LIST_SIZE)}
+        entry["last_message"] = c.get("last_message", {}).get("text", "")
+        entry["unread"] = unread.get(c["_id"], 0)
+        conversations.append(entry)
+
+    # Membership: the full current set, plus details of groups joined since
+    joined = []
+    for m in db["group_members"].find({"username": username, "joined_at": {"$gt": since}}, {"group_id": 1}):
+        group = profile_cache.get_group(db, m["group_id"]) or {}
+        joined.append({"id": m["group_id"], "name": group.get("name"),
+                       "image": images.pick(group, images.LIST_SIZE, "image")})
+
+    selected_user = request.args.get("user")
+    selected_group_id = request.args.get("group")
+    after = request.args.get("after")
+
+    # Receipts move without touching the summaries, so look at every recent direct thread
+    dm_threads = {c["_id"]: next((p for p in c.get("participants", []) if p != username), None)
+                  for c in db["conversations"].find({"participants": username}, {"participants": 1})
+                  .sort("last_timestamp", -1).limit(SYNC_MAX_CONVERSATIONS)}
+    if selected_user:
+        dm_threads[dm_conversation_id(username, selected_user)] = selected_user
+    receipts = receipts_since(db, username, dm_threads, group_ids, since)
+
+    response = {"server_time": server_time, "reload": False, "conversations": conversations,
+                "groups": group_ids, "joined": joined, "messages": [], "receipts": receipts}
+
+    if selected_user:
+        collection = db["messages"]
+        base_filter = {"conversation_id": dm_conversation_id(username, selected_user)}
+    elif selected_group_id and selected_group_id in group_ids:
+        collection = db["group_messages"]
+        base_filter = {"group_id": selected_group_id}
+    else:
+        return jsonify(response)
+
+    if after:
+        try:
+            messages, has_more = fetch_after(collection, base_filter, after)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        response["messages"] = [serialize_message(m) for m in messages]
+        response["reload"] = has_more
+    return jsonify(response)
+
+@chat_bp.route("/directory")
+@login_required
+def directory():
+    """One page of contacts: username and profile image only.
+
+    Query params: q (username prefix), after (last username of the previous
+    page), limit. Walks the unique username index, so no call reads more than
+    ``limit`` + 1 users.
+    """
+    db = get_db()
+    prefix = request.args.get("q", "").strip()
+    after = request.args.get("after")
+    try:
+        limit = max(min(int(request.args.get("limit", DIRECTORY_PAGE_SIZE)), DIRECTORY_MAX_PAGE_SIZE), 1)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    username_filter = {"$ne": session["user"]}
+    if prefix:
+        username_filter["$regex"] = "^" + re.escape(prefix)
+    if after:
+        username_filter["$gt"] = after
+
+    page = list(
+        db["users"].find({"username": username_filter},
+                         {"_id": 0, "username": 1, "profile_image": 1, "profile_images": 1})
+        .sort("username", 1)
+        .limit(limit + 1)
+    )
+    has_more = len(page) > limit
+    page = page[:limit]
+    return jsonify({
+        "users": [{"username": u["username"], "profile_image": images.pick(u, images.LIST_SIZE)} for u in page],
+        "next_cursor": page[-1]["username"] if has_more and page else None,
+    })
+
+@chat_bp.route("/presence")
+@login_required
+def presence_status():
+    """Online state and last_seen for many users in one call: ?users=a,b,c (or users repeated)."""
+    usernames = [u.strip() for value in request.args.getlist("users") for u in value.split(",") if u.strip()]
+    if len(usernames) > presence.MAX_QUERY:
+        return jsonify({"error": f"At most {presence.MAX_QUERY} users per call"}), 400
+    return jsonify({"presence": presence.lookup(get_db(), usernames)})
+
+@chat_bp.route("/search")
+@login_required
+def search_messages():
+    """Ranked message search across the caller's threads, or one thread (?user= / ?group=)."""
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"hits": [], "has_more": False})
+
+    try:
+        page = int(request.args.get("page", 0))
+        limit = int(request.args.get("limit", search.PAGE_SIZE))
+        hits, has_more, page = search.search_messages(
+            get_db(), session["user"], query,
+            user=request.args.get("user"),
+            group_id=request.args.get("group"),
+            page=page, limit=limit
+        )
+    except InvalidId:
+        return jsonify({"error": "Invalid group ID"}), 400
+    except ValueError:
+        return jsonify({"error": "Invalid page or limit"}), 400
+
+    for hit in hits:
+        target = {"user": hit["user"]} if hit["chat_type"] == "user" else {"group": hit["group"]}
+        hit["url"] = url_for("chat.chat_page", at=hit["cursor"], **target)
+    return jsonify({"hits": hits, "page": page, "has_more": has_more})
@@ -0,0 +1,109 @@
+"""gzip/brotli for dynamic HTML and JSON responses.
+
+An after_request hook picks responses of COMPRESS_MIMETYPES longer than
+COMPRESS_MIN_BYTES when the client accepts it, and WSGI middleware compresses
+them once the response is final. Brotli is preferred when the optional
+``brotli`` package is installed. Streamed and file responses, HEAD requests,
+partial content and responses that already carry a Content-Encoding are left
+alone; precompressed static files come from assets.py. COMPRESS_ENABLED=0
+turns it off, e.g. when the front proxy compresses instead.
+
+Compressing a body that holds a secret next to attacker-chosen text leaks
+the secret through the compressed length (BREACH). Responses that set a
+cookie, the session cookie included, are never compressed: Flask adds that
+one after the after_request hooks, so the middleware checks the final
+headers. Pages carry no CSRF or other tokens today, so the remaining
+exposure is per-user data next to reflected query text (e.g. /search). Any
+page that starts embedding a secret must opt out.
+"""
+import gzip
+import os
+
+from flask import request
+
+COMPRESS_ENABLED = os.environ.get("COMPRESS_ENABLED", "1") == "1"
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+# Cheap settings: these run on every response, unlike the build-time assets
+GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4))
+ENVIRON_KEY = "compression.encoding"
+COMPRESS_MIMETYPES = {"text/html", "application/json", "text/css", "text/javascript",
+                      "application/javascript", "text/plain", "image/svg+xml"}
+
+try:
+    import brotli  # optional dependency
+except ImportError:
+    brotli = None
+
+
+def _encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def _after_request(response):
+    if (request.method == "HEAD" or response.direct_passthrough or response.is_streamed
+            or response.status_code not in (200, 201, 400, 403, 404)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _encoding()
+    if encoding is None or (response.content_length or 0) < COMPRESS_MIN_BYTES:
+        return response
+
+    request.environ[ENVIRON_KEY] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # the bytes may differ from the identity body
+    return response
+
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+class CompressMiddleware:
+    """Compresses the responses _after_request marked, unless they set a cookie."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        deferred = []
+
+        def defer(status, headers, exc_info=None):
+            if environ.get(ENVIRON_KEY) is None or any(k.lower() == "set-cookie" for k, _ in headers):
+                return start_response(status, headers, exc_info)
+            deferred[:] = [status, headers, exc_info]
+            return chunks.append
+
+        chunks = []
+        body = self.wsgi_app(environ, defer)
+        if not deferred:
+            return body
+        try:
+            chunks.extend(body)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+        encoding = environ[ENVIRON_KEY]
+        data = _compress(b"".join(chunks), encoding)
+        status, headers, exc_info = deferred
+        headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+        headers += [("Content-Encoding", encoding), ("Content-Length", str(len(data)))]
+        start_response(status, headers, exc_info)
+        return [data]
+
+
+def init_app(app):
+    if COMPRESS_ENABLED:
+        app.after_request(_after_request)
+        app.wsgi_app = CompressMiddleware(app.wsgi_app)
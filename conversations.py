@@ -0,0 +1,155 @@
+from datetime import datetime
+from urllib.parse import quote
+
+
+def dm_conversation_id(user_a, user_b):
+    """Canonical key for a one-to-one thread, identical for both participants.
+
+    Usernames are percent-encoded so the ":" separator can never be forged by
+    a username containing it.
+    """
+    first, second = sorted([user_a, user_b])
+    return f"dm:{quote(first, safe='')}:{quote(second, safe='')}"
+
+
+def group_conversation_id(group_id):
+    return f"group:{group_id}"
+
+
+def conversation_id_for(msg_doc):
+    """Conversation key for a message document about to be stored."""
+    if msg_doc.get("group_id"):
+        return group_conversation_id(msg_doc["group_id"])
+    return dm_conversation_id(msg_doc["sender"], msg_doc["receiver"])
+
+
+# --- Conversation summaries ---------------------------------------------
+# One document per thread in the "conversations" collection:
+#   direct: {_id: conversation_id, kind: "dm", participants: [a, b],
+#            last_message: {...}, last_timestamp, unread: {<user>: n}}
+#   group:  {_id: conversation_id, kind: "group", group_id,
+#            last_message: {...}, last_timestamp}
+# A group summary is the same size however many members the group has:
+# members' unread counts come from their read_state watermarks instead
+# (read_ts from receipts, seen_ts from opening the thread).
+
+SNIPPET_LENGTH = 80
+# Group unread counts stop here, so a long-unread group costs one bounded count
+UNREAD_LIMIT = 100
+
+
+def _field_key(username):
+    # "." and "$" are not allowed in field names; "%" is escaped to stay reversible
+    return username.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def unread_field(username):
+    return f"unread.{_field_key(username)}"
+
+
+def message_snippet(msg_doc):
+    if msg_doc.get("type") == "image":
+        return "Photo"
+    if msg_doc.get("type") == "file":
+        return msg_doc.get("file_name") or "File"
+    return (msg_doc.get("message") or "")[:SNIPPET_LENGTH]
+
+
+def record_message(db, msg_doc, count=1):
+    """Upsert the thread summary for a stored message in one atomic write.
+
+    ``count`` > 1 records a batch whose newest message is ``msg_doc``.
+    """
+    summary = {
+        "last_message": {
+            "_id": msg_doc.get("_id"),
+            "sender": msg_doc["sender"],
+            "text": message_snippet(msg_doc),
+        },
+        "last_timestamp": msg_doc["timestamp"],
+    }
+    update = {"$set": summary}
+    if msg_doc.get("group_id"):
+        summary.update(kind="group", group_id=msg_doc["group_id"])
+    else:
+        summary.update(kind="dm", participants=sorted({msg_doc["sender"], msg_doc["receiver"]}))
+        if msg_doc["receiver"] != msg_doc["sender"]:
+            update["$inc"] = {unread_field(msg_doc["receiver"]): count}
+
+    db["conversations"].update_one({"_id": msg_doc["conversation_id"]}, update, upsert=True)
+
+
+def mark_read(db, conversation_id, username):
+    """Clear the user's unread count: a counter for direct threads, the seen watermark for groups.
+
+    seen_ts is separate from the receipts' read_ts, so the client's own read
+    receipt still advances read_ts and tells the senders.
+    """
+    if not conversation_id.startswith("group:"):
+        db["conversations"].update_one({"_id": conversation_id}, {"$set": {unread_field(username): 0}})
+        return
+    summary = db["conversations"].find_one({"_id": conversation_id}, {"last_timestamp": 1})
+    if summary:
+        ts = summary["last_timestamp"]
+        db["read_state"].update_one(
+            {"group_id": conversation_id[len("group:"):], "username": username},
+            {"$max": {"seen_ts": ts}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
+
+def summaries_for(db, username, group_ids=None, limit=None):
+    """The user's threads, most recent first.
+
+    Direct threads come from the participants index, groups by _id;
+    ``group_ids`` defaults to the user's memberships.
+    """
+    if group_ids is None:
+        from membership import group_ids_for
+        group_ids = group_ids_for(db, username)
+    query = {"participants": username}
+    if group_ids:
+        query = {"$or": [query, {"_id": {"$in": [group_conversation_id(g) for g in group_ids]}}]}
+    cursor = db["conversations"].find(query).sort("last_timestamp", -1)
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
+
+
+def unread_counts(db, username, summaries):
+    """{conversation_id: unread messages} for the given summaries.
+
+    Direct threads read their counter. A group counts its messages after the
+    user's latest watermark (read_ts, seen_ts or join time), only when the
+    summary shows something newer, and stops at UNREAD_LIMIT.
+    """
+    counts = {}
+    groups = {}
+    for c in summaries:
+        if c.get("kind") == "group":
+            groups[c["group_id"]] = c
+        else:
+            counts[c["_id"]] = c.get("unread", {}).get(_field_key(username), 0)
+    if not groups:
+        return counts
+
+    seen = {}
+    for m in db["group_members"].find({"username": username, "group_id": {"$in": list(groups)}},
+                                      {"_id": 0, "group_id": 1, "joined_at": 1}):
+        seen[m["group_id"]] = m.get("joined_at")
+    for r in db["read_state"].find({"username": username, "group_id": {"$in": list(groups)}},
+                                   {"_id": 0, "group_id": 1, "read_ts": 1, "seen_ts": 1}):
+        marks = [t for t in (seen.get(r["group_id"]), r.get("read_ts"), r.get("seen_ts")) if t is not None]
+        if marks:
+            seen[r["group_id"]] = max(marks)
+
+    for group_id, c in groups.items():
+        since = seen.get(group_id)
+        if since is not None and c["last_timestamp"] <= since:
+            counts[c["_id"]] = 0
+            continue
+        query = {"group_id": group_id, "sender": {"$ne": username}}
+        if since is not None:
+            query["timestamp"] = {"$gt": since}
+        counts[c["_id"]] = db["group_messages"].count_documents(query, limit=UNREAD_LIMIT)
+    return counts
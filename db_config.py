@@ -1,6 +1,117 @@
-from pymongo import MongoClient
-
-def get_db():
-    client = MongoClient("mongodb://localhost:27017/")  # Change if remote
-    db = client["whatsapp_clone_new"]
-    return db
+import atexit
+import os
+import threading
+
+from flask import g, has_app_context
+from pymongo import MongoClient
+
+# Connection settings, overridable from the environment
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME", "whatsapp_clone_new")
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _int_env(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def client_options():
+    """Keyword arguments for MongoClient, built from MONGO_* environment variables."""
+    return {
+        "maxPoolSize": _int_env("MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": _int_env("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _int_env("MONGO_MAX_IDLE_TIME_MS", 60000),
+        "serverSelectionTimeoutMS": _int_env("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": _int_env("MONGO_CONNECT_TIMEOUT_MS", 5000),
+        "socketTimeoutMS": _int_env("MONGO_SOCKET_TIMEOUT_MS", 30000),
+        "readPreference": os.environ.get("MONGO_READ_PREFERENCE", "primary"),
+        "appname": os.environ.get("MONGO_APP_NAME", "traincape-chat"),
+    }
+
+
+def get_client():
+    """Return the process-wide MongoClient, creating it on first use.
+
+    The client owns the connection pool and is shared by every request in
+    this process. A forked child never reuses the parent's client: the pid is
+    checked on every call so pre-fork servers get a fresh pool per worker.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            # Sockets inherited across fork are unusable; drop them unclosed
+            if MONGO_URI.startswith("mongomock://"):
+                # In-process stand-in for benchmarks and demos (needs ``mongomock``)
+                import mongomock
+                _client = mongomock.MongoClient()
+            else:
+                from metrics import METRICS_ENABLED, command_listener
+                listeners = [command_listener] if METRICS_ENABLED else []
+                _client = MongoClient(MONGO_URI, event_listeners=listeners, **client_options())
+            _client_pid = pid
+    return _client
+
+
+def close_client():
+    """Close the shared client and its pool. Safe to call more than once."""
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def _reset_after_fork():
+    global _client, _client_pid, _client_lock
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+atexit.register(close_client)
+
+
+def get_db():
+    """Return the application database handle.
+
+    Inside a Flask app/request context the handle is cached on ``g`` so a
+    request resolves it once; outside a context (scripts, background jobs)
+    it comes straight from the shared client.
+    """
+    if has_app_context():
+        if "db" not in g:
+            g.db = get_client()[MONGO_DB_NAME]
+        return g.db
+    return get_client()[MONGO_DB_NAME]
+
+
+def _teardown_db(exc=None):
+    g.pop("db", None)
+
+
+def init_app(app):
+    """Wire the database layer into a Flask app and bootstrap indexes."""
+    app.teardown_appcontext(_teardown_db)
+
+    if os.environ.get("MONGO_ENSURE_INDEXES", "1") != "0":
+        from indexes import ensure_indexes
+        # Serve anyway; "python manage.py ensure-indexes" reports the details
+        try:
+            _, failed = ensure_indexes(get_client()[MONGO_DB_NAME])
+        except Exception as e:
+            app.logger.warning(f"Could not ensure indexes: {e}")
+        else:
+            for collection, error in failed.items():
+                app.logger.warning(f"Could not ensure indexes on {collection}: {error}")
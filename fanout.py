@@ -0,0 +1,188 @@
+"""Cross-process pub/sub for Socket.IO fan-out and cache invalidation.
+
+SOCKETIO_MESSAGE_QUEUE selects the backend shared by every worker:
+
+- unset        single process, no queue (the default)
+- ``memory``   in-process stand-in; connects SocketIO instances in one process
+- ``mongodb``  tails a capped collection in the app database, no new dependency
+- ``redis://`` / ``rediss://`` URL of any Redis-compatible server (needs ``redis``)
+
+``listen(channel, on_gap)`` calls ``on_gap()`` when the listener may have
+missed messages, so callers holding derived state can resynchronise; only
+the MongoDB bus can tell.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import socketio as python_socketio
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from db_config import get_db
+
+MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE", "")
+ASYNC_MODE = os.environ.get("SOCKETIO_ASYNC_MODE", "threading")
+# Skip the long-polling transport so no load-balancer affinity is needed
+WEBSOCKET_ONLY = os.environ.get("SOCKETIO_WEBSOCKET_ONLY", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBus:
+    """Process-local bus; every listener on a channel sees every publish."""
+
+    _subscribers = {}
+    _lock = threading.Lock()
+
+    def publish(self, channel, data):
+        with self._lock:
+            listeners = list(self._subscribers.get(channel, []))
+        for q in listeners:
+            q.put(data)
+
+    def listen(self, channel, on_gap=None):
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(q)
+        try:
+            while True:
+                yield q.get()
+        finally:
+            with self._lock:
+                self._subscribers[channel].remove(q)
+
+
+class RedisBus:
+    def __init__(self, url):
+        import redis  # optional dependency, only needed for this backend
+        self.redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, data):
+        self.redis.publish(channel, data)
+
+    def listen(self, channel, on_gap=None):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        for message in pubsub.listen():
+            yield message["data"]
+
+
+class MongoBus:
+    """Bus over a capped collection, read with a tailable cursor.
+
+    Works on a standalone server as well as a replica set. The collection is
+    a ring buffer, so it never grows past ``size`` bytes. A listener that
+    falls so far behind that its position is overwritten has lost messages:
+    that is logged and reported to ``on_gap`` before it resumes from the
+    oldest document left.
+    """
+
+    def __init__(self, collection="socketio_bus", size=64 * 1024 * 1024):
+        self.name = collection
+        self.size = size
+        self.gaps = 0
+        self._coll = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _collection(self):
+        """The capped collection, created on first use in each process."""
+        if self._pid == os.getpid():
+            return self._coll
+        with self._lock:
+            if self._pid != os.getpid():
+                db = get_db()
+                if self.name not in db.list_collection_names(filter={"name": self.name}):
+                    try:
+                        db.create_collection(self.name, capped=True, size=self.size)
+                        # A tailable cursor on an empty capped collection dies at once
+                        db[self.name].insert_one({"channel": None})
+                    except CollectionInvalid:
+                        pass  # another worker created it first
+                self._coll = db[self.name]
+                self._pid = os.getpid()
+        return self._coll
+
+    def publish(self, channel, data):
+        self._collection().insert_one({"channel": channel, "data": data})
+
+    def listen(self, channel, on_gap=None):
+        coll = self._collection()
+        newest = coll.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+        last_id = newest["_id"] if newest else None
+
+        while True:
+            # Natural order is insertion order; skip up to the last doc seen
+            skipping = last_id is not None and coll.find_one({"_id": last_id}, {"_id": 1}) is not None
+            if last_id is not None and not skipping:
+                # Overwritten by the ring buffer: everything between it and the oldest doc is gone
+                self.gaps += 1
+                logger.warning(f"bus listener on {channel!r} fell behind {self.name}; messages were lost")
+                if on_gap is not None:
+                    on_gap()
+            cursor = coll.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                while cursor.alive:
+                    for doc in cursor:
+                        if skipping:
+                            skipping = doc["_id"] != last_id
+                            continue
+                        last_id = doc["_id"]
+                        if doc.get("channel") == channel:
+                            yield doc["data"]
+            except OperationFailure:
+                pass  # CappedPositionLost: the check above reports it
+            time.sleep(0.1)
+
+
+class BusManager(python_socketio.PubSubManager):
+    """python-socketio client manager that talks through one of the buses."""
+
+    name = "bus"
+
+    def __init__(self, bus, channel="socketio", write_only=False, logger=None):
+        self.bus = bus
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, json.dumps(data))
+
+    def _listen(self):
+        yield from self.bus.listen(self.channel)
+
+
+_bus = None
+
+
+def get_bus():
+    """The configured bus for this process, or None when running single-process."""
+    global _bus
+    if _bus is None and MESSAGE_QUEUE:
+        if MESSAGE_QUEUE == "memory":
+            _bus = MemoryBus()
+        elif MESSAGE_QUEUE == "mongodb":
+            _bus = MongoBus()
+        elif MESSAGE_QUEUE.startswith(("redis://", "rediss://")):
+            _bus = RedisBus(MESSAGE_QUEUE)
+        else:
+            raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE: {MESSAGE_QUEUE}")
+    return _bus
+
+
+def init_socketio(app, socketio):
+    """Initialise ``socketio`` for ``app`` with the configured async mode and queue."""
+    options = {"cors_allowed_origins": "*", "async_mode": ASYNC_MODE}
+    bus = get_bus()
+    if bus is not None:
+        options["client_manager"] = BusManager(bus)
+    if WEBSOCKET_ONLY:
+        options["transports"] = ["websocket"]
+    socketio.init_app(app, **options)
+
+    @app.context_processor
+    def socketio_client_options():
+        return {"socketio_options": {"transports": ["websocket"]} if WEBSOCKET_ONLY else {}}
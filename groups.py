@@ -1,15 +1,37 @@
 from flask import Blueprint, request, redirect, url_for, session, abort, jsonify
-from werkzeug.utils import secure_filename
 from functools import wraps
-from datetime import datetime
-import os, secrets
+import re, secrets
 from bson import ObjectId
+from bson.errors import InvalidId
 from chat import get_ist_time
 
 from db_config import get_db
+import profile_cache
+import membership
+from blob_store import UploadTooLarge
+import images
+import ratelimit
 
 groups_bp = Blueprint("groups", __name__)
 
+AVAILABLE_USERS_PAGE_SIZE = 50
+AVAILABLE_USERS_MAX_PAGE_SIZE = 200
+GROUP_MEMBERS_PAGE_SIZE = 50
+GROUP_MEMBERS_MAX_PAGE_SIZE = 200
+
+def member_profiles(db, usernames):
+    """[{username, profile_image}] for the given usernames, in their order, from the profile cache."""
+    users = profile_cache.get_users(db, usernames)
+    return [
+        {"username": username, "profile_image": images.pick(users.get(username), images.LIST_SIZE)}
+        for username in usernames
+    ]
+
+def members_page(db, group_id, after=None, limit=GROUP_MEMBERS_PAGE_SIZE):
+    """{members, members_next_cursor}: one page of member profiles from group_members."""
+    usernames, next_cursor = membership.members_page(db, group_id, after, limit)
+    return {"members": member_profiles(db, usernames), "members_next_cursor": next_cursor}
+
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -19,6 +41,7 @@ def login_required(f):
     return decorated
 
 @groups_bp.route("/groups/create", methods=["POST"])
+@ratelimit.limit("group")
 def create_group():
     try:
         db = get_db()
@@ -31,14 +54,14 @@ def create_group():
         if not creator:
             return jsonify({"error": "Login required"}), 401
 
-        image_url = "/static/default_profile.png"
+        image_url, image_urls = "/static/default_profile.png", {}
         file = request.files.get("image")
         if file and file.filename:
-            uploads = os.path.join(os.getcwd(), "uploads")
-            os.makedirs(uploads, exist_ok=True)
-            fname = f"group_{int(datetime.utcnow().timestamp())}_{secure_filename(file.filename)}"
-            file.save(os.path.join(uploads, fname))
-            image_url = f"/uploads/{fname}"
+            denied = ratelimit.check("upload")
+            if denied is not None:
+                ratelimit.refund("group")
+                return denied
+            image_url, image_urls = images.save_avatar(db, file)
 
         doc = {
             "name": name,
@@ -46,18 +69,30 @@ def create_group():
             "created_by": creator,
             "invite_code": secrets.token_hex(6),
             "image": image_url,
-            "members": list(set(members + [creator])),
+            "images": image_urls,
+            "member_count": 0,
             "created_at": get_ist_time()
         }
 
-        db["groups"].insert_one(doc)
+        group_id = db["groups"].insert_one(doc).inserted_id
+        membership.add_members(db, group_id, [creator], role=membership.ROLE_ADMIN)
+        membership.add_members(db, group_id, members)
         return jsonify({"success": True})
+    except UploadTooLarge as e:
+        ratelimit.refund("group")
+        ratelimit.refund("upload")
+        return jsonify({"error": str(e)}), 413
+    except images.InvalidImage as e:
+        ratelimit.refund("group")
+        ratelimit.refund("upload")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         # Show the error directly for debugging
         return jsonify({"error": str(e)}), 500
 
 @groups_bp.route("/update_group", methods=["POST"])
 @login_required
+@ratelimit.limit("group")
 def update_group():
     try:
         db = get_db()
@@ -73,27 +108,43 @@ def update_group():
         
         image = request.files.get("image")
         if image and image.filename:
-            filename = f"group_{int(datetime.utcnow().timestamp())}_{secure_filename(image.filename)}"
-            save_path = os.path.join(os.getcwd(), "uploads", filename)
-            image.save(save_path)
-            update["image"] = f"/uploads/{filename}"
+            denied = ratelimit.check("upload")
+            if denied is not None:
+                ratelimit.refund("group")
+                return denied
+            update["image"], update["images"] = images.save_avatar(db, image)
         
-        db["groups"].update_one(
+        previous = db["groups"].find_one_and_update(
             {"_id": ObjectId(group_id)}, 
-            {"$set": update}
+            {"$set": update},
+            projection={"image": 1, "images": 1}
         )
+        profile_cache.invalidate_group(group_id)
+
+        # The replaced image loses this group's reference
+        if previous and "image" in update:
+            images.release_avatar(db, previous.get("image"), previous.get("images"),
+                                  update["image"], update["images"])
         
         return jsonify({"success": True})
     
+    except UploadTooLarge as e:
+        ratelimit.refund("group")
+        ratelimit.refund("upload")
+        return jsonify({"error": str(e)}), 413
+    except images.InvalidImage as e:
+        ratelimit.refund("group")
+        ratelimit.refund("upload")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error updating group: {e}")
         return jsonify({"error": str(e)}), 500
     
 @groups_bp.route("/update_group_members", methods=["POST"])
 @login_required
+@ratelimit.limit("group")
 def update_group_members():
     db = get_db()
-    groups_col = db["groups"]
     
     data = request.json
     group_id = data.get("group_id")
@@ -104,28 +155,16 @@ def update_group_members():
         return jsonify({"error": "Missing group ID"}), 400
     
     try:
-        group = groups_col.find_one({"_id": ObjectId(group_id)})
-        if not group:
-            return jsonify({"error": "Group not found"}), 404
-        
         # Allow any member to edit
-        if session["user"] not in group["members"]:
+        if not membership.is_member(db, group_id, session["user"]):
+            if not db["groups"].find_one({"_id": ObjectId(group_id)}, {"_id": 1}):
+                return jsonify({"error": "Group not found"}), 404
             return jsonify({"error": "Not authorized"}), 403
         
-        current_members = group.get("members", [])
-        
-        for username in members_to_remove:
-            if username in current_members and username != session["user"]:
-                current_members.remove(username)
-        
-        for username in members_to_add:
-            if username not in current_members:
-                current_members.append(username)
-        
-        groups_col.update_one(
-            {"_id": ObjectId(group_id)},
-            {"$set": {"members": current_members}}
-        )
+        # Each change is its own atomic write, so concurrent edits all apply
+        membership.remove_members(db, group_id, [u for u in members_to_remove if u != session["user"]])
+        membership.add_members(db, group_id, members_to_add)
+        profile_cache.invalidate_group(group_id)
         
         return jsonify({"success": True}), 200
     except Exception as e:
@@ -136,78 +175,107 @@ def update_group_members():
 @login_required
 def group_profile(group_id):
     db = get_db()
-    groups_col = db["groups"]
-    users_col = db["users"]
 
-    group = groups_col.find_one({"_id": ObjectId(group_id)})
+    try:
+        group = profile_cache.get_group(db, group_id)
+    except Exception:
+        return {"error": "Invalid group ID"}, 400
     if not group:
         return {"error": "Group not found"}, 404
 
-    members_data = []
-    for username in group.get("members", []):
-        user = users_col.find_one({"username": username})
-        profile_image = "/static/default_profile.png"
-        
-        if user and "profile_image" in user:
-            profile_image = user["profile_image"]
-        
-        members_data.append({
-            "username": username,
-            "profile_image": profile_image
-        })
-
     return {
         "_id": str(group["_id"]),
         "name": group.get("name"),
         "description": group.get("description"),
-        "image": group.get("image") or "/static/default_profile.png",
+        "image": images.pick(group, images.PROFILE_SIZE, "image"),
+        "images": group.get("images") or {},
         "created_by": group.get("created_by"),
-        "members": members_data,
+        "member_count": group.get("member_count", 0),
+        **members_page(db, group["_id"]),
         "can_edit": (group.get("created_by") == session.get("user"))
     }
 
+@groups_bp.route("/group_members/<group_id>", methods=["GET"])
+@login_required
+def group_members(group_id):
+    """Further pages of a group's members: ?after=<last username>&limit=."""
+    try:
+        limit = max(min(int(request.args.get("limit", GROUP_MEMBERS_PAGE_SIZE)), GROUP_MEMBERS_MAX_PAGE_SIZE), 1)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    db = get_db()
+    try:
+        group_id = ObjectId(group_id)
+    except InvalidId:
+        return jsonify({"error": "Invalid group ID"}), 400
+    if not profile_cache.get_group(db, group_id):
+        return jsonify({"error": "Group not found"}), 404
+    if not membership.is_member(db, group_id, session["user"]):
+        return jsonify({"error": "Not authorized"}), 403
+    return jsonify(members_page(db, group_id, request.args.get("after"), limit))
+
 @groups_bp.route("/available_users", methods=["GET"])
 @login_required
 def available_users():
+    """Group members plus one page of users that can still be added.
+
+    Query params: group_id, q (username prefix), after (last username of the
+    previous page), limit. Members are only sent with the first page.
+    """
     db = get_db()
     group_id = request.args.get("group_id")
+    prefix = request.args.get("q", "").strip()
+    after = request.args.get("after")
     
     if not group_id:
         return jsonify({"error": "Missing group ID"}), 400
+    try:
+        limit = max(min(int(request.args.get("limit", AVAILABLE_USERS_PAGE_SIZE)), AVAILABLE_USERS_MAX_PAGE_SIZE), 1)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
     
     try:
-        group = db.groups.find_one({"_id": ObjectId(group_id)})
-        if not group:
+        if not db.groups.find_one({"_id": ObjectId(group_id)}, {"_id": 1}):
             return jsonify({"error": "Group not found"}), 404
+
+        # Anchored, case-sensitive prefix match walks the unique username index.
+        # Members are dropped per batch with one group_members lookup, so the
+        # query never carries the whole member list.
+        username_filter = {}
+        if prefix:
+            username_filter["$regex"] = "^" + re.escape(prefix)
+        page = []
+        exhausted = False
+        while len(page) <= limit and not exhausted:
+            if after:
+                username_filter["$gt"] = after
+            batch = list(
+                db.users.find({"username": username_filter} if username_filter else {},
+                              {"_id": 0, "username": 1, "profile_image": 1, "profile_images": 1})
+                .sort("username", 1)
+                .limit(limit + 1)
+            )
+            exhausted = len(batch) <= limit
+            if not batch:
+                break
+            after = batch[-1]["username"]
+            taken = set(membership.members_of(db, group_id, [u["username"] for u in batch]))
+            page.extend(u for u in batch if u["username"] not in taken)
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        available = [
+            {"username": u["username"], "profile_image": images.pick(u, images.LIST_SIZE)}
+            for u in page
+        ]
         
-        current_members = group.get("members", [])
-        all_users = list(db.users.find({}, {"username": 1, "profile_image": 1}))
-        
-        members = []
-        for username in current_members:
-            user = next((u for u in all_users if u["username"] == username), None)
-            profile_image = "/static/default_profile.png"
-            if user and "profile_image" in user:
-                profile_image = user["profile_image"]
-            
-            members.append({
-                "username": username,
-                "profile_image": profile_image
-            })
-        
-        available = []
-        for user in all_users:
-            if user["username"] not in current_members:
-                profile_image = user.get("profile_image", "/static/default_profile.png")
-                available.append({
-                    "username": user["username"],
-                    "profile_image": profile_image
-                })
-        
-        return jsonify({
-            "members": members,
-            "available": available
-        })
+        response = {
+            "available": available,
+            "next_cursor": page[-1]["username"] if has_more and page else None
+        }
+        if not request.args.get("after"):
+            response.update(members_page(db, group_id))
+        return jsonify(response)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -216,14 +284,18 @@ def available_users():
 @login_required
 def user_profile(username):
     db = get_db()
-    user = db["users"].find_one({"username": username})
+    user = profile_cache.get_user(db, username)
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    profile_image = user.get("profile_image", "/static/default_profile.png")
-    
     return jsonify({
         "username": user["username"],
         "email": user.get("email", ""),
-        "profile_image": profile_image
-    })
\ No newline at end of file
+        "profile_image": images.pick(user, images.PROFILE_SIZE),
+        "profile_images": user.get("profile_images") or {}
+    })
+
+@groups_bp.route("/profile_cache_stats", methods=["GET"])
+@login_required
+def profile_cache_stats():
+    return jsonify(profile_cache.stats())
\ No newline at end of file
@@ -0,0 +1,151 @@
+import os
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import archive
+from conversations import group_conversation_id
+
+# Messages rendered with the page and returned per /history call
+PAGE_SIZE = int(os.environ.get("CHAT_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = 200
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(msg):
+    """Opaque keyset cursor "<epoch ms>-<ObjectId>" for a stored message."""
+    ts = msg["timestamp"]
+    if ts.tzinfo is not None:
+        ts = ts.replace(tzinfo=None) - ts.utcoffset()
+    millis = (ts - _EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}-{msg['_id']}"
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Raises ValueError on malformed input."""
+    try:
+        millis, oid = cursor.split("-", 1)
+        return _EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def _sort_key(m):
+    return m["timestamp"], m["_id"]
+
+
+def _archive_key(base_filter):
+    """conversation_id of the thread a history filter selects, for the archive tier."""
+    if "conversation_id" in base_filter:
+        return base_filter["conversation_id"]
+    if "group_id" in base_filter:
+        return group_conversation_id(base_filter["group_id"])
+    return None
+
+
+def _archived_before(collection, base_filter, before, wanted):
+    """Up to ``wanted`` archived messages older than ``before`` (newest first)."""
+    key = _archive_key(base_filter)
+    if not key:
+        return []
+    bound = decode_cursor(before) if before else None
+    found = []
+    for bucket in archive.buckets_before(collection.database, key, bound[0] if bound else None):
+        found.extend(m for m in reversed(archive.unpack(bucket)) if bound is None or _sort_key(m) < bound)
+        if len(found) >= wanted:
+            break
+    return found[:wanted]
+
+
+def _archived_after(collection, base_filter, after, wanted):
+    """Up to ``wanted`` archived messages newer than ``after`` (oldest first)."""
+    key = _archive_key(base_filter)
+    if not key:
+        return []
+    bound = decode_cursor(after)
+    found = []
+    for bucket in archive.buckets_after(collection.database, key, bound[0]):
+        found.extend(m for m in archive.unpack(bucket) if _sort_key(m) > bound)
+        if len(found) >= wanted:
+            break
+    return found[:wanted]
+
+
+def fetch_page(collection, base_filter, before=None, limit=PAGE_SIZE):
+    """Newest ``limit`` messages strictly older than the ``before`` cursor.
+
+    Returns (messages in chronological order, has_more). The query walks the
+    (thread key, timestamp, _id) index backwards, so cost depends on the page
+    size and not on how long the thread is. A short page continues into the
+    archive tier (see archive.py).
+    """
+    query = dict(base_filter)
+    if before:
+        ts, oid = decode_cursor(before)
+        query["$or"] = [
+            {"timestamp": {"$lt": ts}},
+            {"timestamp": ts, "_id": {"$lt": oid}},
+        ]
+
+    docs = list(collection.find(query)
+                .sort([("timestamp", -1), ("_id", -1)])
+                .limit(limit + 1))
+    if len(docs) <= limit:
+        docs.extend(_archived_before(collection, base_filter, before, limit + 1 - len(docs)))
+        docs.sort(key=_sort_key, reverse=True)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    docs.reverse()
+    return docs, has_more
+
+
+def fetch_after(collection, base_filter, after, limit=PAGE_SIZE):
+    """Oldest ``limit`` messages strictly newer than the ``after`` cursor.
+
+    Returns (messages in chronological order, has_more).
+    """
+    ts, oid = decode_cursor(after)
+    query = dict(base_filter)
+    query["$or"] = [
+        {"timestamp": {"$gt": ts}},
+        {"timestamp": ts, "_id": {"$gt": oid}},
+    ]
+    docs = list(collection.find(query)
+                .sort([("timestamp", 1), ("_id", 1)])
+                .limit(limit + 1))
+    # One (conversation_id, end) index probe; it finds buckets only when the
+    # cursor lies inside the archived months
+    archived = _archived_after(collection, base_filter, after, limit + 1)
+    if archived:
+        docs = sorted(docs + archived, key=_sort_key)
+    return docs[:limit], len(docs) > limit
+
+
+def fetch_around(collection, base_filter, at, limit=PAGE_SIZE):
+    """A page centred on the message at cursor ``at`` (jump-to-message).
+
+    Returns (messages, has_older, has_newer); the anchor is included when it
+    belongs to ``base_filter``.
+    """
+    ts, oid = decode_cursor(at)
+    half = max(limit // 2, 1)
+    older, has_older = fetch_page(collection, base_filter, before=at, limit=half)
+    anchor = collection.find_one(dict(base_filter, _id=oid))
+    if anchor is None and _archive_key(base_filter):
+        anchor = archive.find_message(collection.database, _archive_key(base_filter), ts, oid)
+    newer, has_newer = fetch_after(collection, base_filter, at, limit=half)
+    return older + ([anchor] if anchor else []) + newer, has_older, has_newer
+
+
+def serialize_message(m):
+    """JSON/template-friendly copy of a message document."""
+    out = dict(m)
+    out["_id"] = str(m["_id"])
+    if isinstance(m.get("timestamp"), datetime):
+        out["cursor"] = encode_cursor(m)
+        out["timestamp"] = m["timestamp"].strftime("%Y-%m-%dT%H:%M:%S")
+    reply = m.get("replyTo")
+    if reply and reply.get("messageId") is not None:
+        out["replyTo"] = dict(reply, messageId=str(reply["messageId"]))
+    return out
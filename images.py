@@ -0,0 +1,113 @@
+"""Avatars and group images: validated, metadata-free square WEBP variants.
+
+An uploaded picture is decoded, checked, rotated by its EXIF orientation,
+centre-cropped to a square and re-encoded at each of SIZES. Re-encoding
+drops EXIF, GPS and other metadata. Each variant goes into the blob store, so
+identical pictures are stored once. Documents keep ``{size: url}`` next to
+the legacy single-URL field, which now points at the largest variant:
+
+    users.profile_image / users.profile_images
+    groups.image        / groups.images
+
+Views ask ``pick`` for the size they draw. Pillow is optional, as it is for
+thumbnails: without it the upload is stored unchanged as before.
+"""
+import io
+
+import blob_store
+
+SIZES = (40, 96, 256)
+LIST_SIZE = 40       # sidebar, member and picker rows
+HEADER_SIZE = 96     # chat header and own avatar
+PROFILE_SIZE = 256   # profile modals
+WEBP_QUALITY = 80
+ACCEPTED_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+MAX_PIXELS = 40_000_000  # refuse decompression bombs before decoding them
+
+DEFAULT_IMAGE = "/static/default_profile.png"
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def _square_variants(data):
+    """{size: WEBP bytes} for every size in SIZES."""
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(io.BytesIO(data)) as probe:
+            if probe.format not in ACCEPTED_FORMATS:
+                raise InvalidImage("Unsupported image format")
+            if probe.width * probe.height > MAX_PIXELS:
+                raise InvalidImage("Image dimensions are too large")
+            probe.verify()
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+        raise InvalidImage("Not a valid image")
+
+    img = ImageOps.exif_transpose(img)
+    img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+    side = min(img.size)
+    left, top = (img.width - side) // 2, (img.height - side) // 2
+    img = img.crop((left, top, left + side, top + side))
+
+    variants = {}
+    for size in SIZES:
+        out = io.BytesIO()
+        img.resize((size, size), Image.LANCZOS).save(out, "WEBP", quality=WEBP_QUALITY, method=6)
+        variants[size] = out.getvalue()
+    return variants
+
+
+def save_avatar(db, file_storage, max_bytes=blob_store.MAX_UPLOAD_BYTES):
+    """Store an uploaded picture; returns (url of the largest variant, {size: url}).
+
+    Raises UploadTooLarge or InvalidImage. Without Pillow the original is
+    stored as is and the map is empty.
+    """
+    data = file_storage.stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise blob_store.UploadTooLarge(f"File exceeds {max_bytes // (1024 * 1024)} MB limit")
+    try:
+        return store_variants(db, data)
+    except ImportError:
+        file_storage.stream = io.BytesIO(data)
+        return blob_store.save_upload(db, file_storage, max_bytes)["url"], {}
+
+
+def store_variants(db, data):
+    """Encode and store every size of an image; returns (largest url, {size: url})."""
+    urls = {str(size): blob_store.store_bytes(db, body, "webp", "image/webp")["url"]
+            for size, body in _square_variants(data).items()}
+    return urls[str(max(SIZES))], urls
+
+
+def _hashes(url, urls):
+    return {blob_store.hash_from_url(u) for u in {url, *(urls or {}).values()}} - {None}
+
+
+def release_avatar(db, url, urls=None, keep_url=None, keep_urls=None):
+    """Drop the references held by a replaced picture and its variants.
+
+    Files shared with the replacement (``keep_url``/``keep_urls``), as when
+    the same picture is uploaded again, are never released: the upload just
+    added a reference, and the surplus one is dropped without the delete path.
+    """
+    old, new = _hashes(url, urls), _hashes(keep_url, keep_urls)
+    for digest in old - new:
+        blob_store.release(db, digest)
+    for digest in old & new:
+        blob_store.drop_extra_ref(db, digest)
+
+
+def pick(doc, size, field="profile_image"):
+    """URL of the smallest variant at least ``size`` px, the original, or the default."""
+    if not doc:
+        return DEFAULT_IMAGE
+    variants = doc.get(field + "s") or {}
+    for s in SIZES:
+        if s >= size and variants.get(str(s)):
+            return variants[str(s)]
+    return doc.get(field) or DEFAULT_IMAGE
@@ -0,0 +1,78 @@
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+# Every index the application relies on, per collection. create_indexes is
+# idempotent, so this runs at startup and from manage.py.
+# Text indexes lead with conversation_id, so a search reads only the index
+# entries of the thread it names.
+INDEXES = {
+    "messages": [
+        IndexModel([("conversation_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="conversation_timestamp"),
+        IndexModel([("conversation_id", ASCENDING), ("message", TEXT)], name="conversation_message_text"),
+        # /sync's receipt catch-up: a sender's messages whose status moved recently
+        IndexModel([("conversation_id", ASCENDING), ("sender", ASCENDING), ("status_at", ASCENDING)],
+                   name="conversation_sender_status"),
+    ],
+    "group_messages": [
+        IndexModel([("group_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+                   name="group_timestamp"),
+        IndexModel([("conversation_id", ASCENDING), ("message", TEXT)], name="conversation_message_text"),
+    ],
+    "message_archive": [
+        IndexModel([("conversation_id", ASCENDING), ("start", DESCENDING)], name="conversation_start"),
+        IndexModel([("conversation_id", ASCENDING), ("end", ASCENDING)], name="conversation_end"),
+    ],
+    "message_archive_index": [
+        IndexModel([("conversation_id", ASCENDING), ("message", TEXT)], name="conversation_message_text"),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        # Only string emails must be unique: legacy accounts without one don't block the build
+        IndexModel([("email", ASCENDING)], name="email_unique_string", unique=True,
+                   partialFilterExpression={"email": {"$type": "string"}}),
+    ],
+    "group_members": [
+        IndexModel([("group_id", ASCENDING), ("username", ASCENDING)], name="group_member", unique=True),
+        IndexModel([("username", ASCENDING), ("group_id", ASCENDING)], name="member_groups"),
+    ],
+    "read_state": [
+        IndexModel([("group_id", ASCENDING), ("username", ASCENDING)], name="group_reader", unique=True),
+        IndexModel([("group_id", ASCENDING), ("updated_at", ASCENDING)], name="group_updated"),
+    ],
+    "presence": [
+        # Leases of workers that died are cleaned up once they run out
+        IndexModel([("expires_at", ASCENDING)], name="expires", expireAfterSeconds=0),
+    ],
+    "conversations": [
+        IndexModel([("participants", ASCENDING), ("last_timestamp", DESCENDING)],
+                   name="participants_recent"),
+    ],
+}
+
+
+# Replaced indexes, dropped before INDEXES are created (a collection has one text index)
+RETIRED = {
+    "messages": ["message_text"],
+    "group_messages": ["message_text"],
+    "users": ["email_unique"],
+}
+
+
+def ensure_indexes(db):
+    """Create any missing indexes; returns ({collection: [index names]}, {collection: error}).
+
+    A collection whose indexes cannot be built (e.g. duplicates under a unique
+    index) is reported in the second dict and the others are still created.
+    """
+    created, failed = {}, {}
+    for collection, models in INDEXES.items():
+        try:
+            existing = db[collection].index_information()
+            for name in RETIRED.get(collection, ()):
+                if name in existing:
+                    db[collection].drop_index(name)
+            created[collection] = db[collection].create_indexes(models)
+        except OperationFailure as e:
+            failed[collection] = str(e)
+    return created, failed
@@ -0,0 +1,242 @@
+"""Message writes, optionally coalesced into insert_many batches.
+
+MESSAGE_INGEST=direct (default) keeps one insert_one per message on the
+request thread. MESSAGE_INGEST=batched routes messages through a bounded
+in-process queue drained by one writer thread. The writer collects up to
+INGEST_BATCH_SIZE messages or waits INGEST_BATCH_WINDOW_MS, whichever comes
+first, and writes each collection's share with a single insert_many. Senders
+block until their batch is acknowledged, so a send is only acked once the
+message is stored.
+
+Every failure to store raises an IngestUnavailable and the route answers 503
+with Retry-After: IngestQueueFull when the queue is full, IngestFailed when
+the write errors or is not acknowledged within INGEST_WRITE_TIMEOUT. A
+message still waiting in the queue at the timeout is cancelled, so a retry
+never produces a duplicate; one already being written is waited for.
+``insert_messages`` stores several documents the same way and reports which
+of them landed, so a partly failed bulk write can still be accounted for:
+documents named in writeErrors failed, and a batch that only reports
+writeConcernErrors was applied and counts as stored. After any other error
+the documents' _ids are looked up to see which were written.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.write_concern import WriteConcern
+
+from db_config import get_db
+
+INGEST_MODE = os.environ.get("MESSAGE_INGEST", "direct")
+BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 256))
+BATCH_WINDOW = float(os.environ.get("INGEST_BATCH_WINDOW_MS", 5)) / 1000
+QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+ENQUEUE_TIMEOUT = float(os.environ.get("INGEST_ENQUEUE_TIMEOUT", 0.5))
+WRITE_TIMEOUT = float(os.environ.get("INGEST_WRITE_TIMEOUT", 10))
+# INGEST_JOURNAL=1 waits for the journal before acknowledging a batch
+WRITE_CONCERN = WriteConcern(w=1, j=os.environ.get("INGEST_JOURNAL", "0") == "1")
+
+RETRY_AFTER_SECONDS = 1
+
+logger = logging.getLogger(__name__)
+
+
+class IngestUnavailable(Exception):
+    pass
+
+
+class IngestQueueFull(IngestUnavailable):
+    pass
+
+
+class IngestFailed(IngestUnavailable):
+    pass
+
+
+def _written(coll, docs):
+    """Indexes of ``docs`` found in ``coll`` after an inconclusive bulk write, or None."""
+    try:
+        found = {d["_id"] for d in coll.find({"_id": {"$in": [doc["_id"] for doc in docs]}}, {"_id": 1})}
+    except PyMongoError:
+        return None
+    return {index for index, doc in enumerate(docs) if doc["_id"] in found}
+
+
+def _write_errors(e, collection):
+    """Indexes that failed in a BulkWriteError; write concern errors alone fail nothing."""
+    failed = {err["index"]: err for err in e.details.get("writeErrors", [])}
+    if not failed:
+        logger.warning(f"insert into {collection} applied with write concern errors: "
+                       f"{e.details.get('writeConcernErrors')}")
+    return failed
+
+
+class BatchWriter:
+    def __init__(self, batch_size=BATCH_SIZE, window=BATCH_WINDOW, maxsize=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.window = window
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batches = 0
+        self.documents = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked child inherits the queue object but not the thread
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                self._thread = threading.Thread(target=self._run, name="message-ingest", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, collection, doc, timeout=ENQUEUE_TIMEOUT):
+        """Queue ``doc`` for ``collection``; returns a Future resolving to its _id."""
+        self._ensure_started()
+        doc.setdefault("_id", ObjectId())
+        future = Future()
+        try:
+            self.queue.put((collection, doc, future), timeout=timeout)
+        except queue.Full:
+            raise IngestQueueFull("Message queue is full, retry shortly")
+        return future
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                by_collection = {}
+                for collection, doc, future in batch:
+                    # False when the sender gave up waiting: the message must not be written
+                    if future.set_running_or_notify_cancel():
+                        by_collection.setdefault(collection, []).append((doc, future))
+                for collection, items in by_collection.items():
+                    self._write(collection, items)
+            except Exception as e:
+                # Never let one bad batch stop the writer; fail whoever is still waiting
+                for _, _, future in batch:
+                    if future.running():
+                        future.set_exception(e)
+
+    def _write(self, collection, items):
+        failed = {}
+        coll = get_db()[collection].with_options(write_concern=WRITE_CONCERN)
+        docs = [doc for doc, _ in items]
+        try:
+            coll.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = _write_errors(e, collection)
+        except Exception as e:
+            written = _written(coll, docs) if isinstance(e, PyMongoError) else None
+            if written is None:
+                for _, future in items:
+                    future.set_exception(e)
+                return
+            failed = {index: {"errmsg": str(e)} for index in range(len(docs)) if index not in written}
+
+        self.batches += 1
+        self.documents += len(items) - len(failed)
+        for index, (doc, future) in enumerate(items):
+            if index in failed:
+                future.set_exception(RuntimeError(failed[index].get("errmsg", "write failed")))
+            else:
+                future.set_result(doc["_id"])
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "batches": self.batches, "documents": self.documents}
+
+
+_writer = BatchWriter()
+
+
+def _wait(future):
+    try:
+        try:
+            return future.result(timeout=WRITE_TIMEOUT)
+        except FutureTimeout:
+            if future.cancel():
+                raise IngestFailed("Message store is slow, retry shortly")
+        # Already being written: its outcome is bounded by the driver's own timeouts
+        return future.result()
+    except IngestUnavailable:
+        raise
+    except Exception as e:
+        raise IngestFailed(f"Message could not be stored, retry shortly ({e.__class__.__name__})")
+
+
+def insert_message(db, collection, doc):
+    """Store one message document and return its _id, by the configured mode.
+
+    Raises IngestUnavailable when the message was not stored.
+    """
+    if INGEST_MODE == "batched":
+        return _wait(_writer.submit(collection, doc))
+    try:
+        return db[collection].insert_one(doc).inserted_id
+    except PyMongoError as e:
+        raise IngestFailed(f"Message could not be stored, retry shortly ({e.__class__.__name__})")
+
+
+def insert_messages(db, collection, docs):
+    """Store several message documents; returns (stored docs, IngestUnavailable or None).
+
+    Each document is written independently, so some may be stored when
+    others are not; the error describes the first failure.
+    """
+    if INGEST_MODE == "batched":
+        pending, error = [], None
+        for doc in docs:
+            try:
+                pending.append((doc, _writer.submit(collection, doc)))
+            except IngestUnavailable as e:
+                error = e
+                break
+        stored = []
+        for doc, future in pending:
+            try:
+                _wait(future)
+                stored.append(doc)
+            except IngestUnavailable as e:
+                error = error or e
+        return stored, error
+    for doc in docs:
+        doc.setdefault("_id", ObjectId())
+    try:
+        db[collection].insert_many(docs, ordered=False)
+        return list(docs), None
+    except BulkWriteError as e:
+        failed = _write_errors(e, collection)
+    except PyMongoError as e:
+        written = _written(db[collection], docs)
+        if written is None:
+            return [], IngestFailed(f"Messages could not be stored, retry shortly ({e.__class__.__name__})")
+        failed = set(range(len(docs))) - written
+    stored = [doc for index, doc in enumerate(docs) if index not in failed]
+    if len(stored) == len(docs):
+        return stored, None
+    return stored, IngestFailed(f"{len(docs) - len(stored)} of {len(docs)} messages could not be stored, retry shortly")
+
+
+def stats():
+    return dict(_writer.stats(), mode=INGEST_MODE)
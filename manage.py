@@ -0,0 +1,252 @@
+"""Maintenance commands: python manage.py <command> [options]"""
+import argparse
+import http.cookiejar
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+from pymongo import UpdateOne
+from werkzeug.security import safe_join
+
+from conversations import dm_conversation_id, group_conversation_id, record_message
+from db_config import get_db
+from indexes import ensure_indexes
+import membership
+import archive
+import assets
+import blob_store
+import images
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def cmd_ensure_indexes(args):
+    created, failed = ensure_indexes(get_db())
+    for collection, names in created.items():
+        print(f"{collection}: {', '.join(names)}")
+    for collection, error in failed.items():
+        print(f"{collection}: FAILED: {error}", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def cmd_backfill_conversation_ids(args):
+    db = get_db()
+    missing = {"conversation_id": {"$exists": False}}
+
+    # Direct messages: the key is derived in Python, written in batches
+    ops = []
+    updated = 0
+    for m in db["messages"].find(missing, {"sender": 1, "receiver": 1}):
+        if not m.get("sender") or not m.get("receiver"):
+            continue
+        ops.append(UpdateOne({"_id": m["_id"]},
+                             {"$set": {"conversation_id": dm_conversation_id(m["sender"], m["receiver"])}}))
+        if len(ops) >= args.batch_size:
+            updated += db["messages"].bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += db["messages"].bulk_write(ops, ordered=False).modified_count
+    print(f"messages: {updated} updated")
+
+    # Group messages: one key per group, one update_many per group
+    updated = 0
+    for group_id in db["group_messages"].distinct("group_id", missing):
+        result = db["group_messages"].update_many(
+            {"group_id": group_id, **missing},
+            {"$set": {"conversation_id": group_conversation_id(group_id)}}
+        )
+        updated += result.modified_count
+    print(f"group_messages: {updated} updated")
+
+
+def cmd_backfill_conversations(args):
+    """Build a summary for every thread from its newest message (unread counts start at 0)."""
+    db = get_db()
+    # Group summaries written before read watermarks carried per-member fields
+    result = db["conversations"].update_many({"kind": "group", "participants": {"$exists": True}},
+                                             {"$unset": {"participants": "", "unread": ""}})
+    print(f"group summaries: {result.modified_count} trimmed")
+    for name in ("messages", "group_messages"):
+        pipeline = [
+            {"$match": {"conversation_id": {"$exists": True}}},
+            {"$sort": {"conversation_id": 1, "timestamp": -1}},
+            {"$group": {"_id": "$conversation_id", "last": {"$first": "$$ROOT"}}},
+        ]
+        count = 0
+        for row in db[name].aggregate(pipeline, allowDiskUse=True):
+            last = row["last"]
+            if db["conversations"].find_one({"_id": row["_id"]}, {"_id": 1}):
+                continue
+            record_message(db, last)
+            if last.get("group_id"):
+                # Group unread counts run from each member's read watermark
+                ts = last["timestamp"]
+                ops = [UpdateOne({"group_id": last["group_id"], "username": u},
+                                 {"$max": {"seen_ts": ts}}, upsert=True)
+                       for u in membership.members_of(db, last["group_id"])]
+                if ops:
+                    db["read_state"].bulk_write(ops, ordered=False)
+            else:
+                # The upsert counted the message as unread for the receiver
+                db["conversations"].update_one({"_id": row["_id"]}, {"$set": {"unread": {}}})
+            count += 1
+        print(f"{name}: {count} summaries created")
+
+
+def cmd_migrate_group_members(args):
+    count = membership.migrate(get_db(), args.batch_size)
+    print(f"groups: {count} migrated to group_members")
+
+
+def cmd_archive_messages(args):
+    moved = archive.compact(get_db(), args.older_than_days)
+    for source, count in moved.items():
+        print(f"{source}: {count} messages archived")
+
+
+def _picture_bytes(db, url):
+    """Bytes of a stored picture: a blob, or a legacy /uploads/ or /static/ file."""
+    if blob_store.hash_from_url(url):
+        blob = db["blobs"].find_one({"_id": blob_store.hash_from_url(url)})
+        path = blob_store.blob_path(blob)
+    elif url.startswith("/uploads/"):
+        path = safe_join(blob_store.UPLOAD_FOLDER, url[len("/uploads/"):])
+    else:
+        path = safe_join(ROOT, url.lstrip("/"))
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def cmd_resize_images(args):
+    """Give existing avatars and group images their square variants.
+
+    Pictures stored before the blob store (``/uploads/<file>`` or
+    ``/static/...`` paths) are ingested into it as they are resized; their
+    old files are left where they are.
+    """
+    db = get_db()
+    for collection, field in (("users", "profile_image"), ("groups", "image")):
+        done = failed = 0
+        query = {field + "s": {"$in": [None, {}]},
+                 field: {"$regex": "^/(uploads|static)/", "$ne": images.DEFAULT_IMAGE}}
+        for doc in db[collection].find(query, {field: 1}):
+            try:
+                url, urls = images.store_variants(db, _picture_bytes(db, doc[field]))
+            except (TypeError, OSError, images.InvalidImage):
+                failed += 1
+                continue
+            db[collection].update_one({"_id": doc["_id"]}, {"$set": {field: url, field + "s": urls}})
+            if blob_store.hash_from_url(doc[field]):
+                images.release_avatar(db, doc[field], keep_url=url, keep_urls=urls)
+            done += 1
+        print(f"{collection}: {done} resized, {failed} skipped")
+
+
+def _login(base_url, username, password):
+    """Log in over HTTP; returns (opener carrying the session, Cookie header)."""
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    opener.open(base_url.rstrip("/") + "/login", form)
+    return opener, "; ".join(f"{c.name}={c.value}" for c in jar)
+
+
+def cmd_build_assets(args):
+    manifest, skipped = assets.build()
+    for path in skipped:
+        print(f"skipped {path}: contents do not match the font type")
+    brotli = "gzip and brotli" if assets.brotli_module() else "gzip only, brotli not installed"
+    print(f"fingerprinted {len(manifest)} files into {os.path.relpath(assets.DIST_DIR)} ({brotli})")
+
+
+def cmd_check_fanout(args):
+    """Send a DM through worker A and wait for it on a socket held by worker B."""
+    import socketio as python_socketio
+
+    marker = f"fanout-check-{uuid.uuid4().hex}"
+    received = threading.Event()
+
+    _, cookie = _login(args.worker_b, args.receiver, args.receiver_password)
+    client = python_socketio.Client()
+
+    @client.on("new_message")
+    def on_new_message(msg):
+        if msg.get("message") == marker:
+            received.set()
+
+    client.connect(args.worker_b, headers={"Cookie": cookie}, transports=["websocket"])
+    try:
+        opener, _ = _login(args.worker_a, args.sender, args.sender_password)
+        form = urllib.parse.urlencode({"receiver": args.receiver, "chat_type": "user", "message": marker}).encode()
+        req = urllib.request.Request(args.worker_a.rstrip("/") + "/send_message", data=form,
+                                     headers={"Accept": "application/json"})
+        start = time.perf_counter()
+        opener.open(req)
+        ok = received.wait(args.timeout)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    finally:
+        client.disconnect()
+
+    if ok:
+        print(f"OK: {args.worker_a} -> {args.worker_b} in {elapsed_ms:.1f} ms")
+    else:
+        print(f"FAILED: no message on {args.worker_b} within {args.timeout}s")
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("ensure-indexes", help="create all application indexes")
+    p.set_defaults(func=cmd_ensure_indexes)
+
+    p = commands.add_parser("backfill-conversation-ids",
+                            help="set conversation_id on messages stored before it existed")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_backfill_conversation_ids)
+
+    p = commands.add_parser("backfill-conversations",
+                            help="create sidebar summaries for threads that predate them")
+    p.set_defaults(func=cmd_backfill_conversations)
+
+    p = commands.add_parser("migrate-group-members",
+                            help="move group member arrays into the group_members collection")
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.set_defaults(func=cmd_migrate_group_members)
+
+    p = commands.add_parser("archive-messages",
+                            help="compact whole months of old messages into archive buckets")
+    p.add_argument("--older-than-days", type=int, default=archive.ARCHIVE_AFTER_DAYS or 90)
+    p.set_defaults(func=cmd_archive_messages)
+
+    p = commands.add_parser("resize-images",
+                            help="create square WEBP variants for avatars and group images uploaded earlier")
+    p.set_defaults(func=cmd_resize_images)
+
+    p = commands.add_parser("build-assets",
+                            help="fingerprint and precompress static files into static/dist")
+    p.set_defaults(func=cmd_build_assets)
+
+    p = commands.add_parser("check-fanout",
+                            help="verify a message sent via worker A reaches a socket on worker B")
+    p.add_argument("--worker-a", required=True, help="base URL of the sending worker")
+    p.add_argument("--worker-b", required=True, help="base URL of the receiving worker")
+    p.add_argument("--sender", required=True)
+    p.add_argument("--sender-password", required=True)
+    p.add_argument("--receiver", required=True)
+    p.add_argument("--receiver-password", required=True)
+    p.add_argument("--timeout", type=float, default=5.0)
+    p.set_defaults(func=cmd_check_fanout)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
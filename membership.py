@@ -0,0 +1,118 @@
+"""Group membership, one document per (group, member) in ``group_members``.
+
+Membership checks and "my groups" are single index lookups on
+``group_members`` however large a group grows. Edits are bulk upserts and
+deletes, so concurrent adds and removes never overwrite each other. The
+group document only keeps ``member_count`` (``$inc``); member lists are read
+a page at a time with ``members_page``. Existing groups are copied over, and
+their old ``members`` arrays removed, by ``python manage.py migrate-group-members``.
+"""
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import DeleteOne, UpdateOne
+
+ROLE_ADMIN = "admin"
+ROLE_MEMBER = "member"
+
+
+def _group_key(group_id):
+    return str(group_id)
+
+
+def add_members(db, group_id, usernames, role=ROLE_MEMBER):
+    """Add usernames to a group; returns how many were not members yet."""
+    usernames = list(dict.fromkeys(u for u in usernames if u))
+    if not usernames:
+        return 0
+    key = _group_key(group_id)
+    now = datetime.utcnow()
+    ops = [
+        UpdateOne({"group_id": key, "username": username},
+                  {"$setOnInsert": {"role": role, "joined_at": now}},
+                  upsert=True)
+        for username in usernames
+    ]
+    added = db["group_members"].bulk_write(ops, ordered=False).upserted_count
+    if added:
+        db["groups"].update_one({"_id": ObjectId(key)}, {"$inc": {"member_count": added}})
+    return added
+
+
+def remove_members(db, group_id, usernames):
+    """Remove usernames from a group; returns how many were members."""
+    usernames = list(dict.fromkeys(u for u in usernames if u))
+    if not usernames:
+        return 0
+    key = _group_key(group_id)
+    ops = [DeleteOne({"group_id": key, "username": username}) for username in usernames]
+    removed = db["group_members"].bulk_write(ops, ordered=False).deleted_count
+    if removed:
+        db["groups"].update_one({"_id": ObjectId(key)}, {"$inc": {"member_count": -removed}})
+    return removed
+
+
+def is_member(db, group_id, username):
+    return db["group_members"].find_one(
+        {"group_id": _group_key(group_id), "username": username}, {"_id": 1}) is not None
+
+
+def member_group_ids(db, username, group_ids):
+    """The subset of ``group_ids`` the user belongs to, in one query."""
+    keys = list({_group_key(g) for g in group_ids})
+    if not keys:
+        return set()
+    return {m["group_id"] for m in
+            db["group_members"].find({"username": username, "group_id": {"$in": keys}}, {"_id": 0, "group_id": 1})}
+
+
+def group_ids_for(db, username):
+    """Ids (strings) of every group the user belongs to."""
+    return [m["group_id"] for m in db["group_members"].find({"username": username}, {"_id": 0, "group_id": 1})]
+
+
+def members_of(db, group_id, usernames=None):
+    """Member usernames of a group, sorted; ``usernames`` restricts the check to those."""
+    query = {"group_id": _group_key(group_id)}
+    if usernames is not None:
+        query["username"] = {"$in": list(usernames)}
+    return [m["username"] for m in
+            db["group_members"].find(query, {"_id": 0, "username": 1}).sort("username", 1)]
+
+
+def members_page(db, group_id, after=None, limit=100):
+    """One page of member usernames in username order; returns (usernames, next cursor or None)."""
+    query = {"group_id": _group_key(group_id)}
+    if after:
+        query["username"] = {"$gt": after}
+    page = [m["username"] for m in
+            db["group_members"].find(query, {"_id": 0, "username": 1}).sort("username", 1).limit(limit + 1)]
+    return page[:limit], (page[limit - 1] if len(page) > limit else None)
+
+
+def migrate(db, batch_size=1000):
+    """Move every group's ``members`` array into group_members; safe to re-run.
+
+    The array is removed once copied and member_count is recounted from
+    group_members, so groups migrated earlier are left as they are.
+    """
+    groups = 0
+    for group in db["groups"].find({"members": {"$exists": True}}, {"members": 1, "created_by": 1, "created_at": 1}):
+        key = _group_key(group["_id"])
+        joined_at = group.get("created_at") or group["_id"].generation_time
+        ops = []
+        for username in set(group.get("members") or []):
+            role = ROLE_ADMIN if username == group.get("created_by") else ROLE_MEMBER
+            ops.append(UpdateOne({"group_id": key, "username": username},
+                                 {"$setOnInsert": {"role": role, "joined_at": joined_at}},
+                                 upsert=True))
+            if len(ops) >= batch_size:
+                db["group_members"].bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            db["group_members"].bulk_write(ops, ordered=False)
+        db["groups"].update_one({"_id": group["_id"]},
+                                {"$unset": {"members": ""},
+                                 "$set": {"member_count": db["group_members"].count_documents({"group_id": key})}})
+        groups += 1
+    return groups
@@ -0,0 +1,245 @@
+"""Process-local metrics in the Prometheus text format, served on /metrics.
+
+- every Flask route: a latency histogram and an error counter, labelled by
+  endpoint (``blueprint.view``), method and status
+- MongoDB: a pymongo CommandListener times every command by collection and
+  command name and counts the documents it returned or touched
+- Socket.IO: connected sockets and user/group rooms on this worker
+
+Each worker keeps its own numbers; scrape every worker. Requests slower than
+SLOW_REQUEST_MS (0 disables) are logged with their timings.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, g, has_request_context, request
+from pymongo import monitoring
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))
+
+# Seconds; covers an index hit through a slow upload
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    pairs = ",".join('{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.label_names = name, help_text, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help_text, labels
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ("le",)
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Value computed at scrape time by ``fn`` returning {labels tuple: value}."""
+
+    def __init__(self, name, help_text, labels=(), fn=None):
+        self.name, self.help, self.label_names = name, help_text, labels
+        self.fn = fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.fn() if self.fn else {}
+        except Exception:
+            values = {}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+http_latency = Histogram("http_request_duration_seconds", "Flask request latency",
+                         ("endpoint", "method", "status"))
+http_errors = Counter("http_request_errors_total", "Requests answered with a 5xx or raising",
+                      ("endpoint", "method"))
+mongo_latency = Histogram("mongodb_command_duration_seconds", "MongoDB command latency",
+                          ("collection", "command"))
+mongo_documents = Counter("mongodb_command_documents_total", "Documents returned or written by MongoDB commands",
+                          ("collection", "command"))
+mongo_failures = Counter("mongodb_command_failures_total", "MongoDB commands that failed",
+                         ("collection", "command"))
+_registry = [http_latency, http_errors, mongo_latency, mongo_documents, mongo_failures]
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _reply_documents(reply):
+    """Documents a command reply returned (cursor batches) or affected (n)."""
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    n = reply.get("n")
+    return n if isinstance(n, int) else 0
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every command the client sends; register via MongoClient(event_listeners=[...])."""
+
+    # Commands whose first value is not a collection name
+    _NO_COLLECTION = {"getMore", "ping", "hello", "isMaster", "ismaster", "endSessions",
+                      "saslStart", "saslContinue", "buildInfo", "listCollections", "killCursors"}
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        elif event.command_name in self._NO_COLLECTION or not isinstance(collection, str):
+            collection = ""
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event):
+        with self._lock:
+            return self._pending.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event):
+        collection = self._finish(event)
+        mongo_latency.observe(event.duration_micros / 1e6, collection, event.command_name)
+        documents = _reply_documents(event.reply)
+        if documents:
+            mongo_documents.inc(collection, event.command_name, amount=documents)
+        timings = g.get("mongo_timings") if has_request_context() else None
+        if timings is not None:
+            timings.append((event.command_name, collection, event.duration_micros / 1000))
+
+    def failed(self, event):
+        collection = self._finish(event)
+        mongo_latency.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongo_failures.inc(collection, event.command_name)
+
+
+command_listener = CommandTimer()
+
+
+def _socket_rooms(socketio):
+    """(connected sockets, {kind: rooms}) on this worker's Socket.IO server."""
+    rooms = getattr(getattr(socketio, "server", None), "manager", None)
+    rooms = rooms.rooms.get("/", {}) if rooms else {}
+    connected = len(rooms.get(None, {}))
+    kinds = {"user": 0, "group": 0}
+    for name in rooms:
+        if isinstance(name, str) and ":" in name:
+            kind = name.split(":", 1)[0]
+            if kind in kinds:
+                kinds[kind] += 1
+    return connected, kinds
+
+
+def init_socketio(socketio):
+    register(Gauge("socketio_connected_clients", "Sockets connected to this worker",
+                   fn=lambda: {(): _socket_rooms(socketio)[0]}))
+    register(Gauge("socketio_rooms", "User and group rooms with members on this worker", ("kind",),
+                   fn=lambda: {(kind,): count for kind, count in _socket_rooms(socketio)[1].items()}))
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    if SLOW_REQUEST_MS:
+        g.mongo_timings = []
+
+
+def _after_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    http_latency.observe(elapsed, endpoint, request.method, response.status_code)
+    if response.status_code >= 500:
+        http_errors.inc(endpoint, request.method)
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        timings = g.get("mongo_timings") or []
+        db_ms = sum(t[2] for t in timings)
+        slowest = ", ".join(f"{cmd} {coll} {ms:.1f}ms" for cmd, coll, ms in
+                            sorted(timings, key=lambda t: -t[2])[:5])
+        current_app.logger.warning(
+            f"slow request {request.method} {request.path} ({endpoint}) {elapsed * 1000:.1f}ms, "
+            f"{len(timings)} mongo commands {db_ms:.1f}ms: {slowest}")
+    return response
+
+
+def _teardown_request(exc=None):
+    # Unhandled exceptions skip after_request
+    if exc is not None and g.pop("request_started", None) is not None:
+        http_errors.inc(request.endpoint or "unmatched", request.method)
+
+
+def metrics_view():
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app, socketio=None):
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    if socketio is not None:
+        init_socketio(socketio)
@@ -0,0 +1,376 @@
+"""Online/typing state kept in memory, broadcast as batched diffs.
+
+A user is online while at least one of their sockets is registered, so
+several tabs count as one presence. Sockets heartbeat every
+HEARTBEAT_SECONDS; one silent for PRESENCE_TIMEOUT_SECONDS is dropped even if
+its disconnect never arrived. Changes are not emitted as they happen. Every
+PRESENCE_FLUSH_MS one loop:
+
+- expires silent sockets;
+- sends each socket that watches some users one "presence" event with the
+  users that went online or offline since the last flush;
+- sends each room one "typing" event listing who started or stopped typing.
+
+Typing starts are debounced per (user, thread) to one every
+TYPING_INTERVAL_SECONDS, so a room gets at most one typing event per flush
+however many members type. Clients drop an indicator that is not refreshed
+within TYPING_TTL_SECONDS.
+
+Each worker registers only its own sockets. When a message bus is
+configured (several workers, see fanout.py), presence is also shared:
+
+- every worker holds a lease per online user in the ``presence`` collection
+  (``workers.<worker id>``), renewed every LEASE_REFRESH_SECONDS and valid
+  for PRESENCE_TIMEOUT_SECONDS, so a crashed worker's users age out;
+- a user goes offline, and their ``last_seen`` is saved, only when no
+  worker holds a live lease for them any more;
+- those global transitions are published on the ``presence`` channel, so
+  watchers on every worker get the diff, and ``lookup`` consults the leases
+  for users that are not online locally.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument, UpdateOne
+
+from db_config import get_db
+import fanout
+import metrics
+
+HEARTBEAT_SECONDS = float(os.environ.get("PRESENCE_HEARTBEAT_SECONDS", 25))
+PRESENCE_TIMEOUT = float(os.environ.get("PRESENCE_TIMEOUT_SECONDS", 70))
+FLUSH_INTERVAL = float(os.environ.get("PRESENCE_FLUSH_MS", 1000)) / 1000
+TYPING_INTERVAL = float(os.environ.get("TYPING_INTERVAL_SECONDS", 3))
+TYPING_TTL = TYPING_INTERVAL * 2
+MAX_WATCHED = 500  # users one socket may follow
+MAX_QUERY = 500    # users one bulk query may ask about
+LEASE_REFRESH = float(os.environ.get("PRESENCE_LEASE_REFRESH_SECONDS", PRESENCE_TIMEOUT / 3))
+COLLECTION = "presence"
+CHANNEL = "presence"
+
+emitted = metrics.register(metrics.Counter("presence_events_total", "Presence and typing events emitted",
+                                           ("event",)))
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class PresenceRegistry:
+    def __init__(self):
+        self._sockets = {}     # username -> {sid: last heartbeat (monotonic)}
+        self._owner = {}       # sid -> username
+        self._last_seen = {}   # username -> epoch ms, for users gone offline here
+        self._changed = {}     # username -> online?, since the last flush
+        self._remote = {}      # username -> online?, reported by other workers since the last flush
+        self._resync = False   # the bus lost messages: re-read every watched user's status
+        self._watchers = {}    # username -> {sid watching them}
+        self._watching = {}    # sid -> {usernames}
+        self._typing = {}      # (username, chat_type, target) -> monotonic time of the last start sent
+        self._typing_out = {}  # (room_kind, room_key, chat_type, thread id) -> {username: typing?}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self._refreshed = 0.0
+
+    # Sockets
+
+    def connect(self, username, sid):
+        with self._lock:
+            sockets = self._sockets.setdefault(username, {})
+            if not sockets:
+                self._mark(username, True)
+            sockets[sid] = time.monotonic()
+            self._owner[sid] = username
+
+    def heartbeat(self, sid):
+        with self._lock:
+            username = self._owner.get(sid)
+            if username is None:
+                return False
+            self._sockets[username][sid] = time.monotonic()
+            return True
+
+    def disconnect(self, sid):
+        with self._lock:
+            self._drop(sid)
+
+    def _drop(self, sid):
+        username = self._owner.pop(sid, None)
+        for target in self._watching.pop(sid, ()):
+            watchers = self._watchers.get(target)
+            if watchers is not None:
+                watchers.discard(sid)
+                if not watchers:
+                    del self._watchers[target]
+        if username is None:
+            return
+        sockets = self._sockets.get(username, {})
+        sockets.pop(sid, None)
+        if not sockets:
+            self._sockets.pop(username, None)
+            self._last_seen[username] = _now_ms()
+            self._mark(username, False)
+            for key in [k for k in self._typing if k[0] == username]:
+                del self._typing[key]
+
+    def _mark(self, username, online):
+        # Online then offline within one flush cancels out
+        if self._changed.get(username) is (not online):
+            del self._changed[username]
+        else:
+            self._changed[username] = online
+
+    def expire(self, now=None):
+        """Drop sockets whose heartbeat is older than PRESENCE_TIMEOUT; returns their sids."""
+        cutoff = (now or time.monotonic()) - PRESENCE_TIMEOUT
+        with self._lock:
+            stale = [sid for sockets in self._sockets.values() for sid, seen in sockets.items() if seen < cutoff]
+            for sid in stale:
+                self._drop(sid)
+        return stale
+
+    # Queries
+
+    def is_online(self, username):
+        with self._lock:
+            return username in self._sockets
+
+    def online_count(self):
+        with self._lock:
+            return len(self._sockets)
+
+    def online_users(self):
+        with self._lock:
+            return list(self._sockets)
+
+    def status(self, usernames):
+        """{username: {"online": bool, "last_seen": epoch ms or None}} from memory only."""
+        with self._lock:
+            return {u: {"online": u in self._sockets, "last_seen": self._last_seen.get(u)} for u in usernames}
+
+    def watch(self, sid, usernames):
+        """Replace the users ``sid`` gets presence diffs for; returns the usernames kept."""
+        usernames = list(dict.fromkeys(u for u in usernames if isinstance(u, str) and u))[:MAX_WATCHED]
+        with self._lock:
+            for target in self._watching.pop(sid, ()):
+                watchers = self._watchers.get(target)
+                if watchers is not None:
+                    watchers.discard(sid)
+                    if not watchers:
+                        del self._watchers[target]
+            if sid in self._owner:
+                self._watching[sid] = set(usernames)
+                for target in usernames:
+                    self._watchers.setdefault(target, set()).add(sid)
+        return usernames
+
+    # Typing
+
+    def typing(self, username, chat_type, target, room_kind, room_key, thread_id, active):
+        """Queue a typing start/stop; starts within TYPING_INTERVAL of the last one are dropped."""
+        key = (username, chat_type, target)
+        now = time.monotonic()
+        with self._lock:
+            if active:
+                last = self._typing.get(key)
+                if last is not None and now - last < TYPING_INTERVAL:
+                    return False
+                self._typing[key] = now
+            elif self._typing.pop(key, None) is None:
+                return False  # no start was sent, nothing to take back
+            self._typing_out.setdefault((room_kind, room_key, chat_type, thread_id), {})[username] = active
+        return True
+
+    # Other workers
+
+    def remote_change(self, username, online, last_seen=None):
+        """Queue a transition another worker published; ignored while the user has sockets here."""
+        with self._lock:
+            if username in self._sockets:
+                return
+            if not online and last_seen:
+                self._last_seen[username] = last_seen
+            self._remote[username] = online
+
+    def request_resync(self):
+        with self._lock:
+            self._resync = True
+
+    # Flush
+
+    def drain(self):
+        """(local changes, remote changes, watched users to re-read or None, typing per room) since the last call."""
+        with self._lock:
+            changed, self._changed = self._changed, {}
+            remote, self._remote = self._remote, {}
+            resync = list(self._watchers) if self._resync else None
+            self._resync = False
+            typing, self._typing_out = self._typing_out, {}
+        return changed, remote, resync, typing
+
+    def diffs(self, changes):
+        """{sid: {username: status}} for the sockets watching the changed users."""
+        diffs = {}
+        with self._lock:
+            for username, online in changes.items():
+                for sid in self._watchers.get(username, ()):
+                    diffs.setdefault(sid, {})[username] = {"online": online,
+                                                           "last_seen": None if online else self._last_seen.get(username)}
+        return diffs
+
+    def flush(self, emit):
+        """Send everything pending; ``emit(event, payload, room_kind, room_key)`` sends one event."""
+        self.expire()
+        changed, remote, resync, typing = self.drain()
+        bus = fanout.get_bus()
+        if bus is None:
+            gone = [u for u, online in changed.items() if not online]
+            if gone:
+                _persist_last_seen(get_db(), {u: self._last_seen[u] for u in gone if u in self._last_seen})
+        else:
+            db = get_db()
+            changed = _share(db, bus, changed, self._last_seen)
+            if time.monotonic() - self._refreshed >= LEASE_REFRESH:
+                _renew_leases(db, self.online_users())
+                self._refreshed = time.monotonic()
+            for i in range(0, len(resync or ()), MAX_QUERY):
+                remote.update((u, s["online"]) for u, s in lookup(db, resync[i:i + MAX_QUERY]).items())
+        for sid, users in self.diffs({**remote, **changed}).items():
+            emit("presence", users, "sid", sid)
+            emitted.inc("presence")
+        for (room_kind, room_key, chat_type, thread_id), users in typing.items():
+            emit("typing", {"chat_type": chat_type, "id": thread_id,
+                            "typing": sorted(u for u, on in users.items() if on),
+                            "stopped": sorted(u for u, on in users.items() if not on),
+                            "ttl": TYPING_TTL}, room_kind, room_key)
+            emitted.inc("typing")
+
+    def start(self, socketio, emit):
+        """Run the periodic flush as a Socket.IO background task, once per process.
+
+        With a bus configured, also listen for other workers' transitions.
+        """
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+
+        def loop():
+            while True:
+                socketio.sleep(FLUSH_INTERVAL)
+                try:
+                    self.flush(emit)
+                except Exception:
+                    socketio.server.logger.exception("presence flush failed")
+
+        socketio.start_background_task(loop)
+        bus = fanout.get_bus()
+        if bus is not None:
+            threading.Thread(target=_listen, args=(bus, self), name="presence-listener", daemon=True).start()
+
+
+_worker = {}
+
+
+def _worker_id():
+    """Random per-process id; a forked worker gets its own."""
+    if _worker.get("pid") != os.getpid():
+        _worker.update(pid=os.getpid(), id=uuid.uuid4().hex)
+    return _worker["id"]
+
+
+def _lease(now):
+    return now + timedelta(seconds=PRESENCE_TIMEOUT)
+
+
+def _live(doc, now):
+    return any(until > now for until in ((doc or {}).get("workers") or {}).values())
+
+
+def _share(db, bus, changed, last_seen):
+    """Apply this worker's transitions to the leases; returns (and publishes) the global ones."""
+    now = datetime.utcnow()
+    key = f"workers.{_worker_id()}"
+    result = {}
+    for username, online in changed.items():
+        if online:
+            before = db[COLLECTION].find_one_and_update(
+                {"_id": username}, {"$set": {key: _lease(now)}, "$max": {"expires_at": _lease(now)}},
+                projection={"workers": 1}, upsert=True, return_document=ReturnDocument.BEFORE)
+            if not _live(before, now):
+                result[username] = True
+        else:
+            after = db[COLLECTION].find_one_and_update(
+                {"_id": username}, {"$unset": {key: ""}},
+                projection={"workers": 1}, return_document=ReturnDocument.AFTER)
+            if not _live(after, now):
+                result[username] = False
+    gone = {u: last_seen[u] for u, online in result.items() if not online and u in last_seen}
+    _persist_last_seen(db, gone)
+    if result:
+        bus.publish(CHANNEL, json.dumps({"w": _worker_id(), "changes": {
+            u: {"online": online, "last_seen": None if online else gone.get(u)} for u, online in result.items()}}))
+    return result
+
+
+def _renew_leases(db, usernames):
+    if usernames:
+        until = _lease(datetime.utcnow())
+        key = f"workers.{_worker_id()}"
+        db[COLLECTION].bulk_write([UpdateOne({"_id": u}, {"$set": {key: until}, "$max": {"expires_at": until}},
+                                             upsert=True) for u in usernames], ordered=False)
+
+
+def _listen(bus, registry):
+    me = _worker_id()
+    for raw in bus.listen(CHANNEL, on_gap=registry.request_resync):
+        try:
+            event = json.loads(raw)
+            if event["w"] == me:
+                continue
+            for username, status in event["changes"].items():
+                registry.remote_change(username, status["online"], status.get("last_seen"))
+        except Exception:
+            continue
+
+
+def _online_elsewhere(db, usernames):
+    now = datetime.utcnow()
+    return {d["_id"] for d in db[COLLECTION].find({"_id": {"$in": usernames}, "expires_at": {"$gt": now}},
+                                                  {"workers": 1})
+            if _live(d, now)}
+
+
+def _persist_last_seen(db, last_seen):
+    if last_seen:
+        db["users"].bulk_write([UpdateOne({"username": u}, {"$max": {"last_seen": ms}})
+                                for u, ms in last_seen.items()], ordered=False)
+
+
+def lookup(db, usernames):
+    """Bulk presence for the sidebar: online from memory or other workers' leases,
+    last_seen from memory or users."""
+    usernames = list(dict.fromkeys(usernames))[:MAX_QUERY]
+    result = registry.status(usernames)
+    if fanout.get_bus() is not None:
+        offline = [u for u, s in result.items() if not s["online"]]
+        for u in _online_elsewhere(db, offline) if offline else ():
+            result[u] = {"online": True, "last_seen": None}
+    missing = [u for u, s in result.items() if not s["online"] and s["last_seen"] is None]
+    if missing:
+        for u in db["users"].find({"username": {"$in": missing}, "last_seen": {"$exists": True}},
+                                  {"_id": 0, "username": 1, "last_seen": 1}):
+            result[u["username"]]["last_seen"] = u["last_seen"]
+    return result
+
+
+registry = PresenceRegistry()
+metrics.register(metrics.Gauge("presence_online_users", "Users with a live socket on this worker",
+                               fn=lambda: {(): registry.online_count()}))
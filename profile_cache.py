@@ -0,0 +1,171 @@
+"""In-process cache for the small, rarely-changing user and group documents.
+
+Entries expire after PROFILE_CACHE_TTL seconds and the least recently used
+entry is evicted past PROFILE_CACHE_SIZE. Every write path calls
+invalidate_user / invalidate_group; when a message bus is configured (see
+fanout.py) invalidations are broadcast so every worker drops its copy.
+
+Cached documents are shared between requests: callers must not mutate them.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from bson import ObjectId
+
+import fanout
+
+CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", 300))
+INVALIDATION_CHANNEL = "profile-cache"
+
+USER_FIELDS = {"_id": 0, "username": 1, "email": 1, "profile_image": 1, "profile_images": 1}
+GROUP_FIELDS = {"name": 1, "description": 1, "image": 1, "images": 1, "created_by": 1, "member_count": 1}
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (found, value)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+_users = TTLCache(CACHE_SIZE, CACHE_TTL)
+_groups = TTLCache(CACHE_SIZE, CACHE_TTL)
+_caches = {"user": _users, "group": _groups}
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _clear_all():
+    # Invalidations may have been lost: nothing cached can be trusted
+    for cache in _caches.values():
+        cache.clear()
+
+
+def _listen(bus):
+    for raw in bus.listen(INVALIDATION_CHANNEL, on_gap=_clear_all):
+        try:
+            event = json.loads(raw)
+            _caches[event["kind"]].invalidate(event["key"])
+        except Exception:
+            continue
+
+
+def _ensure_listener():
+    """Start the invalidation listener once per process, if a bus is configured."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        bus = fanout.get_bus()
+        if bus is not None:
+            threading.Thread(target=_listen, args=(bus,), daemon=True).start()
+        _listener_pid = os.getpid()
+
+
+def _invalidate(kind, key):
+    _caches[kind].invalidate(key)
+    bus = fanout.get_bus()
+    if bus is not None:
+        bus.publish(INVALIDATION_CHANNEL, json.dumps({"kind": kind, "key": key}))
+
+
+def get_user(db, username):
+    """{username, email, profile_image} for ``username``, or None."""
+    _ensure_listener()
+    found, user = _users.get(username)
+    if not found:
+        user = db["users"].find_one({"username": username}, USER_FIELDS)
+        if user is not None:
+            _users.set(username, user)
+    return user
+
+
+def get_users(db, usernames):
+    """{username: user doc} for every existing user in ``usernames``, one query for the misses."""
+    _ensure_listener()
+    result = {}
+    missing = []
+    for username in set(usernames):
+        found, user = _users.get(username)
+        if found:
+            result[username] = user
+        else:
+            missing.append(username)
+
+    if missing:
+        for user in db["users"].find({"username": {"$in": missing}}, USER_FIELDS):
+            _users.set(user["username"], user)
+            result[user["username"]] = user
+    return result
+
+
+def get_group(db, group_id):
+    """Group document (GROUP_FIELDS plus _id), or None. Raises on a malformed id."""
+    _ensure_listener()
+    key = str(group_id)
+    found, group = _groups.get(key)
+    if not found:
+        group = db["groups"].find_one({"_id": ObjectId(key)}, GROUP_FIELDS)
+        if group is not None:
+            _groups.set(key, group)
+    return group
+
+
+def invalidate_user(username):
+    _invalidate("user", username)
+
+
+def invalidate_group(group_id):
+    _invalidate("group", str(group_id))
+
+
+def stats():
+    return {"users": _users.stats(), "groups": _groups.stats(), "ttl": CACHE_TTL, "maxsize": CACHE_SIZE}
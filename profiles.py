@@ -1,8 +1,11 @@
 from flask import Blueprint, request, jsonify, session, current_app
 from werkzeug.security import generate_password_hash
 from db_config import get_db
+import profile_cache
+from blob_store import UploadTooLarge, hash_from_url
+import images
+import ratelimit
 import os
-from bson import ObjectId
 
 profile_bp = Blueprint("profile", __name__)
 
@@ -36,60 +39,36 @@ def update_profile():
     if "profile_pic" in request.files:
         file = request.files["profile_pic"]
         if file and file.filename != "":
-            # Define upload folder inside the function
-            upload_folder = os.path.join(current_app.root_path, "uploads", "profile_pic")
-            os.makedirs(upload_folder, exist_ok=True)
-
-            # Save the new file
-            filename = file.filename
-            filepath = os.path.join(upload_folder, filename)
-            file.save(filepath)
+            denied = ratelimit.check("upload")
+            if denied is not None:
+                return denied
+            try:
+                url, urls = images.save_avatar(db, file)
+            except UploadTooLarge as e:
+                ratelimit.refund("upload")
+                return jsonify({"error": str(e)}), 413
+            except images.InvalidImage as e:
+                ratelimit.refund("upload")
+                return jsonify({"error": str(e)}), 400
 
             # Update the profile_image URL in the database (not profile_pic)
-            update_data["profile_image"] = f"/uploads/profile_pic/{filename}"  # store URL
+            update_data["profile_image"] = url  # largest square variant
+            update_data["profile_images"] = urls
 
-            # Optionally, remove the old profile image from the server
+            # Drop our reference to the old picture; the files go when unused
             old_profile_image = user.get("profile_image")
             if old_profile_image:
-                old_file_path = os.path.join(current_app.root_path, old_profile_image.lstrip('/'))
-                if os.path.exists(old_file_path):
-                    os.remove(old_file_path)
+                if hash_from_url(old_profile_image):
+                    images.release_avatar(db, old_profile_image, user.get("profile_images"), url, urls)
+                elif old_profile_image != images.DEFAULT_IMAGE:
+                    old_file_path = os.path.join(current_app.root_path, old_profile_image.lstrip('/'))
+                    if os.path.exists(old_file_path):
+                        os.remove(old_file_path)
 
     if update_data:
         users_col.update_one({"_id": user["_id"]}, {"$set": update_data})
+        profile_cache.invalidate_user(username)
+        if update_data.get("username", username) != username:
+            profile_cache.invalidate_user(update_data["username"])
 
     return jsonify({"success": True, "message": "Profile updated"})
-
-@profile_bp.route("/user_profile/<username>", methods=["GET"])
-def view_user_profile(username):
-    db = get_db()
-    users_col = db["users"]
-    user = users_col.find_one({"username": username}, {"_id":0, "username":1, "email":1, "profile_image":1})
-    if not user:
-        return jsonify({"error": "User not found"}), 404
-
-    if not user.get("profile_image"):
-        from flask import url_for
-        user["profile_image"] = url_for("static", filename="default_profile.png")
-    return jsonify(user)
-
-
-
-@profile_bp.route("/group_profile/<group_id>", methods=["GET"])
-def view_group_profile(group_id):
-    db = get_db()
-    groups_col = db["groups"]
-
-    try:
-        group = groups_col.find_one(
-            {"_id": ObjectId(group_id)},
-            {"_id": 0, "name": 1, "description": 1, "image": 1, "members": 1}
-        )
-    except Exception:
-        return jsonify({"error": "Invalid group ID"}), 400
-
-    if not group:
-        return jsonify({"error": "Group not found"}), 404
-
-    return jsonify(group)
-
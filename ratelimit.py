@@ -0,0 +1,199 @@
+"""Per-user token buckets for the write endpoints.
+
+Every endpoint class in LIMITS has its own bucket per user (per client
+address when logged out): ``burst`` tokens, refilled at ``rate`` per second,
+one token per request. Override a class with RATE_LIMIT_<CLASS>="rate/burst",
+e.g. RATE_LIMIT_SEND=10/40. A request that finds its bucket empty gets a 429
+with Retry-After set to when the next token is due; one that costs more than
+the whole burst gets a 400, since waiting would never help. ``refund`` gives
+back a token taken for a request that was rejected further on.
+
+Buckets live in process memory by default. With several workers set
+RATE_LIMIT_STORAGE=redis://host:6379/0 (needs ``redis``) so all workers
+share them; each check is then one atomic script call. If Redis is
+unreachable the worker falls back to its own buckets rather than refusing
+writes, and skips Redis for RATE_LIMIT_REDIS_RETRY_SECONDS so checks do not
+each wait out the socket timeout. RATE_LIMIT_ENABLED=0 turns limiting off.
+``python -m bench.ratelimit`` measures the cost of a check.
+"""
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, request, session
+
+import metrics
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_STORAGE = os.environ.get("RATE_LIMIT_STORAGE", "memory")
+
+# class -> (tokens per second, burst)
+DEFAULT_LIMITS = {
+    "send": (5, 20),       # send_message
+    "forward": (2, 20),    # forward_message, forward_messages; burst covers MAX_FORWARD_TARGETS
+    "group": (0.2, 5),     # create, edit and membership changes
+    "upload": (0.5, 10),   # attachments, profile and group pictures
+}
+MAX_LOCAL_KEYS = 100_000  # buckets kept before full ones are dropped
+REDIS_RETRY_SECONDS = float(os.environ.get("RATE_LIMIT_REDIS_RETRY_SECONDS", 5))
+
+rejections = metrics.register(metrics.Counter("ratelimit_rejections_total", "Requests refused with 429",
+                                              ("limit",)))
+
+
+def _parse_limit(value, default):
+    """(rate, burst) from a "rate/burst" string; unset, malformed, non-positive or infinite values give ``default``."""
+    try:
+        rate, burst = (float(v) for v in value.split("/"))
+    except (AttributeError, ValueError):
+        return default
+    if not (0 < rate < math.inf and 0 < burst < math.inf):  # also rejects nan
+        return default
+    return rate, burst
+
+
+LIMITS = {name: _parse_limit(os.environ.get(f"RATE_LIMIT_{name.upper()}"), default)
+          for name, default in DEFAULT_LIMITS.items()}
+
+
+class LocalBuckets:
+    """Token buckets in a dict; state is (tokens, monotonic time of last refill)."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, rate, burst, cost=1):
+        """Take ``cost`` tokens; returns 0 when allowed, else the seconds until they are there.
+
+        A negative cost puts tokens back, never past ``burst``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= cost:
+                self._buckets[key] = (min(burst, tokens - cost), now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (cost - tokens) / rate
+            if len(self._buckets) > MAX_LOCAL_KEYS:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # A bucket that would be full again carries no state worth keeping
+        longest = max(b / r for r, b in LIMITS.values())
+        for key in [k for k, (_, last) in self._buckets.items() if now - last > longest]:
+            del self._buckets[key]
+
+
+# Refill and take in one step on the server clock, so workers never disagree
+_REDIS_SCRIPT = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+  tokens = math.min(burst, tokens - cost)
+else
+  wait = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    def __init__(self, url, prefix="ratelimit:"):
+        import redis  # optional dependency, only needed for this backend
+        self.redis = redis.Redis.from_url(url, socket_timeout=0.25)
+        self.script = self.redis.register_script(_REDIS_SCRIPT)
+        self.prefix = prefix
+        self.fallback = LocalBuckets()
+        self._down_until = 0.0
+
+    def acquire(self, key, rate, burst, cost=1):
+        # Circuit breaker: after a failure, stay local instead of timing out on every call
+        if time.monotonic() < self._down_until:
+            return self.fallback.acquire(key, rate, burst, cost)
+        try:
+            return float(self.script(keys=[self.prefix + key], args=[rate, burst, cost]))
+        except Exception:
+            self._down_until = time.monotonic() + REDIS_RETRY_SECONDS
+            return self.fallback.acquire(key, rate, burst, cost)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if RATE_LIMIT_STORAGE.startswith(("redis://", "rediss://")):
+                    _storage = RedisBuckets(RATE_LIMIT_STORAGE)
+                elif RATE_LIMIT_STORAGE == "memory":
+                    _storage = LocalBuckets()
+                else:
+                    raise ValueError(f"Unsupported RATE_LIMIT_STORAGE: {RATE_LIMIT_STORAGE}")
+    return _storage
+
+
+def _client_key():
+    user = session.get("user")
+    return "user:" + user if user else "addr:" + (request.remote_addr or "")
+
+
+def too_many_requests(wait):
+    response = jsonify({"error": "Too many requests, slow down", "retry_after": round(wait, 3)})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def check(name, cost=1):
+    """Take tokens from the caller's ``name`` bucket; returns a 429/400 response, or None if allowed."""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    rate, burst = LIMITS[name]
+    if cost > burst:
+        rejections.inc(name)
+        response = jsonify({"error": f"Too large: this request counts as {cost:g}, at most {burst:g} allowed"})
+        response.status_code = 400
+        return response
+    wait = get_storage().acquire(f"{name}:{_client_key()}", rate, burst, cost)
+    if wait:
+        rejections.inc(name)
+        return too_many_requests(wait)
+    return None
+
+
+def refund(name, cost=1):
+    """Give back tokens taken by ``check``/``limit`` for a request rejected afterwards."""
+    if RATE_LIMIT_ENABLED:
+        rate, burst = LIMITS[name]
+        get_storage().acquire(f"{name}:{_client_key()}", rate, burst, -cost)
+
+
+def limit(name):
+    """Decorator: one token from the caller's ``name`` bucket per request."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            denied = check(name)
+            if denied is not None:
+                return denied
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,194 @@
+"""Delivered/read receipts reported as high-water marks.
+
+Clients report the cursor (see history.encode_cursor) of the newest message
+they have received or read in a thread, never per-message acks. Reports are
+merged per (thread, reader, status) in a ReceiptBuffer and flushed every
+RECEIPT_FLUSH_MS. A flush applies:
+
+- direct messages: one update_many advancing ``status`` on the other
+  participant's messages up to the mark, then one "status" event to them;
+- groups: one $max on the reader's watermark document in ``read_state``,
+  then one event to the personal rooms of whoever sent the messages it
+  newly covers (at most RECEIPT_SENDER_SCAN of them are looked at), never
+  to the whole group. Per-message state is never touched, so the cost does
+  not grow with members x messages. The read watermark is also what the
+  sidebar's group unread count is measured from.
+
+``receipts_since`` replays both kinds as "status" events for /sync, so a
+reconnecting client catches up on ticks it missed.
+"""
+import os
+import threading
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from conversations import dm_conversation_id, mark_read
+from db_config import get_db
+from history import decode_cursor, encode_cursor
+
+FLUSH_INTERVAL = float(os.environ.get("RECEIPT_FLUSH_MS", 250)) / 1000
+SENDER_SCAN = int(os.environ.get("RECEIPT_SENDER_SCAN", 500))
+STATUSES = ("delivered", "read")
+# Messages a given status may advance from
+_ADVANCES_FROM = {"delivered": ["sent"], "read": ["sent", "delivered"]}
+
+
+def _upto_filter(cursor):
+    ts, oid = decode_cursor(cursor)
+    return {"$or": [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lte": oid}}]}
+
+
+def apply_dm_receipt(db, reader, other, status, cursor):
+    """Advance ``other``'s messages to ``reader`` up to ``cursor``; returns the event or None."""
+    conversation_id = dm_conversation_id(reader, other)
+    query = {
+        "conversation_id": conversation_id,
+        "sender": other,
+        "status": {"$in": _ADVANCES_FROM[status]},
+        **_upto_filter(cursor),
+    }
+    result = db["messages"].update_many(query, {"$set": {"status": status, "status_at": datetime.utcnow()}})
+    if status == "read":
+        mark_read(db, conversation_id, reader)
+    if not result.modified_count:
+        return None
+    return {"chat_type": "user", "conversation_id": conversation_id, "reader": reader,
+            "status": status, "up_to": cursor}
+
+
+def apply_group_receipt(db, reader, group_id, status, cursor):
+    """Raise the reader's watermark for a group; returns (event, senders to tell) or None."""
+    ts, _ = decode_cursor(cursor)
+    fields = {f"{status}_ts": ts}
+    if status == "read":
+        fields["delivered_ts"] = ts  # reading implies delivery
+    before = db["read_state"].find_one_and_update(
+        {"group_id": group_id, "username": reader},
+        {"$max": fields, "$set": {"updated_at": datetime.utcnow()}},
+        projection={f"{status}_ts": 1}, upsert=True, return_document=ReturnDocument.BEFORE,
+    )
+    previous = (before or {}).get(f"{status}_ts")
+    if previous is not None and previous >= ts:
+        return None
+
+    # Only the senders of the newly covered messages show ticks for them
+    window = {"$lte": ts} if previous is None else {"$gt": previous, "$lte": ts}
+    senders = {m["sender"] for m in
+               db["group_messages"].find({"group_id": group_id, "timestamp": window}, {"_id": 0, "sender": 1})
+               .sort("timestamp", -1).limit(SENDER_SCAN)}
+    senders.discard(reader)
+    if not senders:
+        return None
+    event = {"chat_type": "group", "group_id": group_id, "reader": reader,
+             "status": status, "up_to": cursor}
+    return event, sorted(senders)
+
+
+# Sorts after every real _id, so a cursor built from a bare timestamp covers all messages at it
+_LAST_OID = ObjectId("f" * 24)
+
+
+def receipts_since(db, username, dm_threads, group_ids, since, limit=200):
+    """Receipt watermarks that moved after ``since``, as "status" events.
+
+    ``dm_threads`` maps direct conversation ids to the other participant;
+    each contributes its newest delivered/read message sent by ``username``
+    (one query over the (conversation_id, sender, status_at) index). Groups
+    contribute the other members' read_state watermarks updated since then,
+    newest first, at most ``limit`` readers.
+    """
+    events = []
+    if dm_threads:
+        pipeline = [
+            {"$match": {"conversation_id": {"$in": list(dm_threads)}, "sender": username,
+                        "status_at": {"$gt": since}, "status": {"$in": list(STATUSES)}}},
+            {"$sort": {"timestamp": -1, "_id": -1}},
+            {"$group": {"_id": {"c": "$conversation_id", "s": "$status"},
+                        "timestamp": {"$first": "$timestamp"}, "oid": {"$first": "$_id"}}},
+        ]
+        for row in db["messages"].aggregate(pipeline):
+            events.append({"chat_type": "user", "conversation_id": row["_id"]["c"],
+                           "reader": dm_threads[row["_id"]["c"]], "status": row["_id"]["s"],
+                           "up_to": encode_cursor({"timestamp": row["timestamp"], "_id": row["oid"]})})
+    if group_ids:
+        for r in (db["read_state"]
+                  .find({"group_id": {"$in": list(group_ids)}, "updated_at": {"$gt": since},
+                         "username": {"$ne": username}},
+                        {"_id": 0, "group_id": 1, "username": 1, "delivered_ts": 1, "read_ts": 1})
+                  .sort("updated_at", -1).limit(limit)):
+            for status in STATUSES:
+                if r.get(f"{status}_ts") is not None:
+                    events.append({"chat_type": "group", "group_id": r["group_id"], "reader": r["username"],
+                                   "status": status,
+                                   "up_to": encode_cursor({"timestamp": r[f"{status}_ts"], "_id": _LAST_OID})})
+    return events
+
+
+def group_watermarks(db, group_id):
+    """{username: {"delivered_ts", "read_ts"}} for one group, one indexed query."""
+    return {
+        r["username"]: {"delivered_ts": r.get("delivered_ts"), "read_ts": r.get("read_ts")}
+        for r in db["read_state"].find({"group_id": group_id},
+                                       {"_id": 0, "username": 1, "delivered_ts": 1, "read_ts": 1})
+    }
+
+
+class ReceiptBuffer:
+    """Coalesces receipt reports; only the highest cursor per key is written."""
+
+    def __init__(self, interval=FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+
+    def add(self, chat_type, target, reader, status, cursor):
+        decode_cursor(cursor)  # reject malformed input at the edge
+        key = (chat_type, target, reader, status)
+        with self._lock:
+            current = self._pending.get(key)
+            if current is None or decode_cursor(cursor) > decode_cursor(current):
+                self._pending[key] = cursor
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self, emit):
+        """Apply everything pending; ``emit(event, usernames)`` sends an event to those users."""
+        db = get_db()
+        for (chat_type, target, reader, status), cursor in self.drain().items():
+            if chat_type == "group":
+                applied = apply_group_receipt(db, reader, target, status, cursor)
+                if applied:
+                    emit(*applied)
+            else:
+                event = apply_dm_receipt(db, reader, target, status, cursor)
+                if event:
+                    emit(event, [target])
+
+    def start(self, socketio, emit):
+        """Run the periodic flush as a Socket.IO background task, once per process."""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+
+        def loop():
+            while True:
+                socketio.sleep(self.interval)
+                try:
+                    self.flush(emit)
+                except Exception:
+                    socketio.server.logger.exception("receipt flush failed")
+
+        socketio.start_background_task(loop)
+
+
+buffer = ReceiptBuffer()
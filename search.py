@@ -0,0 +1,81 @@
+"""Full-text message search over the threads a user belongs to.
+
+Backed by the (conversation_id, message) text indexes on messages,
+group_messages and the archive stubs in message_archive_index (see
+indexes.py and archive.py), so archived months stay searchable. Each
+collection gets one $text query over every thread the user may search
+(conversation_id $in ...); the archive stubs are only queried when archiving
+is enabled. Hits are ranked by text score, newest first on ties, and carry a
+history cursor so the client can open the thread at that message.
+"""
+from bson import ObjectId
+
+import archive
+from conversations import dm_conversation_id, group_conversation_id
+from history import encode_cursor
+import membership
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+MAX_PAGES = 10
+SNIPPET_LENGTH = 160
+
+
+def _scopes(db, username, user=None, group_id=None):
+    """{collection name: [conversation_id, ...]} the user may search."""
+    if user:
+        return {"messages": [dm_conversation_id(username, user)]}
+    if group_id:
+        group_id = str(ObjectId(group_id))
+        if not membership.is_member(db, group_id, username):
+            return {}
+        return {"group_messages": [group_conversation_id(group_id)]}
+
+    scopes = {
+        "messages": [c["_id"] for c in db["conversations"].find({"participants": username}, {"_id": 1})],
+        "group_messages": [group_conversation_id(g) for g in membership.group_ids_for(db, username)],
+    }
+    return {name: ids for name, ids in scopes.items() if ids}
+
+
+def _hit(m, chat_type, username):
+    hit = {
+        "_id": str(m["_id"]),
+        "chat_type": chat_type,
+        "sender": m.get("sender"),
+        "snippet": (m.get("message") or "")[:SNIPPET_LENGTH],
+        "timestamp": m["timestamp"].strftime("%Y-%m-%dT%H:%M:%S"),
+        "score": round(m.get("score", 0), 4),
+        "cursor": encode_cursor(m),
+    }
+    if chat_type == "group":
+        hit["group"] = m.get("group_id")
+    else:
+        hit["user"] = m.get("receiver") if m.get("sender") == username else m.get("sender")
+    return hit
+
+
+def search_messages(db, username, query, user=None, group_id=None, page=0, limit=PAGE_SIZE):
+    """Returns (hits, has_more, page), ``page`` clamped to the pages served."""
+    page = min(max(page, 0), MAX_PAGES - 1)
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    wanted = (page + 1) * limit + 1
+
+    scopes = _scopes(db, username, user, group_id)
+    tiers = list(scopes.items())
+    if scopes and archive.ARCHIVE_AFTER_DAYS:
+        tiers.append((archive.INDEX_COLLECTION, [c for ids in scopes.values() for c in ids]))
+
+    candidates = []
+    for tier, conversation_ids in tiers:
+        cursor = db[tier].find(
+            {"conversation_id": {"$in": conversation_ids}, "$text": {"$search": query}},
+            {"score": {"$meta": "textScore"}, "message": 1, "sender": 1, "receiver": 1,
+             "group_id": 1, "timestamp": 1},
+        ).sort([("score", {"$meta": "textScore"}), ("timestamp", -1)]).limit(wanted)
+        candidates.extend(cursor)
+
+    candidates.sort(key=lambda m: (m.get("score", 0), m["timestamp"]), reverse=True)
+    page_hits = candidates[page * limit:(page + 1) * limit]
+    has_more = len(candidates) > (page + 1) * limit and page + 1 < MAX_PAGES
+    return [_hit(m, "group" if m.get("group_id") else "user", username) for m in page_hits], has_more, page
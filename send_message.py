@@ -1,20 +1,45 @@
 import os
-from flask import Blueprint, session, request, redirect, url_for, send_from_directory, jsonify
+import mimetypes
+from flask import Blueprint, session, request, redirect, url_for, send_from_directory, jsonify, abort, make_response
+from werkzeug.security import safe_join
 from db_config import get_db
 from functools import wraps
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from bson import ObjectId
+from conversations import conversation_id_for, record_message
+from sockets import broadcast_message, broadcast_messages
+import archive
+import membership
+import profile_cache
+from blob_store import UPLOAD_FOLDER, UploadTooLarge, save_upload, add_ref, hash_from_url, release
+import thumbnails
+from ingest import IngestUnavailable, RETRY_AFTER_SECONDS, insert_message, insert_messages
+import ratelimit
 
 send_bp = Blueprint("send", __name__)
 
-UPLOAD_FOLDER = "uploads"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "pdf", "docx", "txt", "zip"}
+
+# Content-addressed blobs never change, so browsers may keep them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# e.g. "/protected-uploads/": let the front proxy send the bytes (nginx internal location)
+ACCEL_REDIRECT_PREFIX = os.environ.get("UPLOAD_ACCEL_REDIRECT_PREFIX", "")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def wants_json():
+    return request.accept_mimetypes.best == "application/json" \
+        or request.headers.get("X-Requested-With") == "XMLHttpRequest"
+
+def busy_response(error, **extra):
+    response = jsonify({"error": error, **extra})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(RETRY_AFTER_SECONDS)
+    return response
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -25,6 +50,7 @@ def login_required(f):
 
 @send_bp.route("/send_message", methods=["POST"])
 @login_required
+@ratelimit.limit("send")
 def send_message():
     db = get_db()
     sender = session["user"]
@@ -37,15 +63,37 @@ def send_message():
     reply_message_id = request.form.get("reply_message_id")
     reply_message_text = request.form.get("reply_message_text")
 
+    # Checked before any upload is stored, so a bad request holds no blob reference
+    if chat_type not in ("user", "group"):
+        if wants_json():
+            return jsonify({"error": "Invalid chat type"}), 400
+        return redirect(url_for("chat.chat_page"))
+    if chat_type == "group" and not membership.is_member(db, receiver, sender):
+        return jsonify({"error": "Not a member of this group"}), 403
+
     file_name = ""
     file_url = ""
+    file_hash = None
+    blob = None
     file_type = "text"
 
     if file and allowed_file(file.filename):
+        denied = ratelimit.check("upload")
+        if denied is not None:
+            ratelimit.refund("send")
+            return denied
         filename = secure_filename(file.filename)
-        file.save(os.path.join(UPLOAD_FOLDER, filename))
+        try:
+            blob = save_upload(db, file)
+        except UploadTooLarge as e:
+            ratelimit.refund("send")
+            ratelimit.refund("upload")
+            if wants_json():
+                return jsonify({"error": str(e)}), 413
+            return redirect(url_for("chat.chat_page"))
         file_name = filename
-        file_url = url_for("send.uploaded_file", filename=filename)
+        file_url = blob["url"]
+        file_hash = blob["_id"]
         ext = filename.rsplit(".", 1)[1].lower()
         file_type = "image" if ext in ["png", "jpg", "jpeg", "gif"] else "file"
 
@@ -55,6 +103,7 @@ def send_message():
         "message": message,
         "file_name": file_name,
         "file_url": file_url,
+        "file_hash": file_hash,
         "status": "sent",
         "timestamp": datetime.utcnow()
     }
@@ -74,52 +123,245 @@ def send_message():
 
     if chat_type == "user":
         msg_doc["receiver"] = receiver
-        db["messages"].insert_one(msg_doc)
-        return redirect(url_for("chat.chat_page", user=receiver))
+        collection = db["messages"]
+        fallback = url_for("chat.chat_page", user=receiver)
 
-    elif chat_type == "group":
+    else:
         msg_doc["group_id"] = receiver
-        db["group_messages"].insert_one(msg_doc)
-        return redirect(url_for("chat.chat_page", group=receiver))
+        collection = db["group_messages"]
+        fallback = url_for("chat.chat_page", group=receiver)
 
-    return redirect(url_for("chat.chat_page"))
+    msg_doc["conversation_id"] = conversation_id_for(msg_doc)
+    needs_thumbnail = blob is not None and thumbnails.prepare(msg_doc, blob)
+    try:
+        insert_message(db, collection.name, msg_doc)
+    except IngestUnavailable as e:
+        release(db, file_hash)
+        return busy_response(str(e))
+    record_message(db, msg_doc)
+    payload = broadcast_message(msg_doc)
+    if needs_thumbnail:
+        thumbnails.schedule(collection.name, msg_doc)
+
+    # Script clients get an ack; plain form posts keep the old redirect
+    if wants_json():
+        return jsonify({"success": True, "message": payload})
+    return redirect(fallback)
 
 @send_bp.route("/uploads/<path:filename>")
 def uploaded_file(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    """Serve an upload with validators, Range support and long-lived caching for blobs.
 
-@send_bp.route("/forward_message", methods=["POST"])
-@login_required
-def forward_message():
-    db = get_db()
-    data = request.get_json()
-    msg_id = data.get("message_id")
-    target_id = data.get("target_id")
-    chat_type = data.get("chat_type")
+    Blob URLs embed the SHA-256 of their content, which doubles as a strong
+    ETag: a matching If-None-Match is answered without touching the disk.
+    Legacy names can be overwritten, so those are always revalidated.
+    """
+    digest = hash_from_url(f"/uploads/{filename}")
 
-    try:
-        original = db["messages"].find_one({"_id": ObjectId(msg_id)}) \
-                 or db["group_messages"].find_one({"_id": ObjectId(msg_id)})
-    except Exception:
-        return jsonify({"error": "Invalid message ID"}), 400
+    if digest and request.if_none_match.contains(digest):
+        response = make_response("", 304)
+    elif ACCEL_REDIRECT_PREFIX:
+        if safe_join(UPLOAD_FOLDER, filename) is None:
+            abort(404)
+        # The proxy handles Range and the body; we only set the headers
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + filename
+        response.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        if digest:
+            response.set_etag(digest)
+    elif digest:
+        # conditional=True answers If-None-Match/If-Range and serves byte ranges (206)
+        response = send_from_directory(UPLOAD_FOLDER, filename, etag=digest,
+                                       max_age=IMMUTABLE_MAX_AGE, conditional=True)
+    else:
+        response = send_from_directory(UPLOAD_FOLDER, filename, max_age=0, conditional=True)
+
+    if digest:
+        response.set_etag(digest)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+MAX_FORWARD_MESSAGES = 50
+MAX_FORWARD_TARGETS = 20
+SOURCE_FIELDS = {"sender": 1, "receiver": 1, "group_id": 1, "message": 1, "type": 1, "file_url": 1,
+                 "file_name": 1, "file_hash": 1, "thumbnail_url": 1, "thumbnail_status": 1, "timestamp": 1}
 
-    if not original:
-        return jsonify({"error": "Message not found"}), 404
+class ForwardError(Exception):
+    def __init__(self, error, status, forwarded=0):
+        super().__init__(error)
+        self.error, self.status, self.forwarded = error, status, forwarded
 
-    new_msg = {
-        "sender": session["user"],
+def _forward_error_response(e):
+    if e.status == 503:
+        return busy_response(e.error, forwarded=e.forwarded)
+    return jsonify({"error": e.error}), e.status
+
+def _forward_copy(original, sender, timestamp):
+    copy = {
+        "sender": sender,
         "message": original.get("message"),
         "type": original.get("type", "text"),
         "file_url": original.get("file_url"),
         "file_name": original.get("file_name"),
-        "timestamp": datetime.utcnow(),
+        "file_hash": original.get("file_hash"),
+        "status": "sent",
+        "timestamp": timestamp,
     }
+    # Thumbnails belong to the file, so the copy can reuse a finished one
+    if original.get("thumbnail_status") == "ready":
+        copy["thumbnail_url"] = original.get("thumbnail_url")
+        copy["thumbnail_status"] = "ready"
+    return copy
 
-    if chat_type == "user":
-        new_msg["receiver"] = target_id
-        db["messages"].insert_one(new_msg)
-    else:
-        new_msg["group_id"] = target_id
-        db["group_messages"].insert_one(new_msg)
+def check_forward(db, username, message_ids, targets):
+    """Validate a forward; returns the sources as [(_id, message)] in request order.
 
+    Sources are resolved with one $in per collection and permissions with one
+    query per kind, whatever the number of messages and targets.
+    Raises ForwardError.
+    """
+    try:
+        oids = list(dict.fromkeys(ObjectId(m) for m in message_ids))
+    except Exception:
+        raise ForwardError("Invalid message ID", 400)
+    if not oids or not targets:
+        raise ForwardError("Nothing to forward", 400)
+    if len(oids) > MAX_FORWARD_MESSAGES or len(targets) > MAX_FORWARD_TARGETS:
+        raise ForwardError(f"At most {MAX_FORWARD_MESSAGES} messages and {MAX_FORWARD_TARGETS} targets", 400)
+
+    found = {}
+    for name in ("messages", "group_messages"):
+        for m in db[name].find({"_id": {"$in": oids}}, SOURCE_FIELDS):
+            found[m["_id"]] = m
+    if len(found) < len(oids):
+        # Old months live compressed in the archive tier
+        found.update(archive.find_by_ids(db, [oid for oid in oids if oid not in found]))
+    if len(found) < len(oids):
+        raise ForwardError("Message not found", 404)
+
+    # The caller must be able to read every source and post to every target
+    source_groups = {m["group_id"] for m in found.values() if m.get("group_id")}
+    target_groups = {t["id"] for t in targets if t["chat_type"] == "group"}
+    target_users = {t["id"] for t in targets if t["chat_type"] == "user"}
+    allowed_groups = membership.member_group_ids(db, username, source_groups | target_groups)
+    for m in found.values():
+        if m.get("group_id"):
+            readable = m["group_id"] in allowed_groups
+        else:
+            readable = username in (m.get("sender"), m.get("receiver"))
+        if not readable:
+            raise ForwardError("Not authorized", 403)
+    if not target_groups <= allowed_groups:
+        raise ForwardError("Not authorized", 403)
+    if target_users and len(profile_cache.get_users(db, list(target_users))) < len(target_users):
+        raise ForwardError("User not found", 404)
+    return [(oid, found[oid]) for oid in oids]
+
+def forward(db, username, sources, targets):
+    """Copy sources from check_forward to every target chat; returns {collection: [docs]}.
+
+    Copies are stored through the ingest layer; when some are not, the ones
+    that were still get their refs and summaries and ForwardError(503)
+    reports them.
+    """
+    now = datetime.utcnow()
+    by_collection = {"messages": [], "group_messages": []}
+    threads = []
+    for target in targets:
+        docs = []
+        for _, source in sources:
+            copy = _forward_copy(source, username, now)
+            copy["_id"] = ObjectId()  # ascending ids keep the batch in order
+            if target["chat_type"] == "user":
+                copy["receiver"] = target["id"]
+                by_collection["messages"].append(copy)
+            else:
+                copy["group_id"] = target["id"]
+                by_collection["group_messages"].append(copy)
+            copy["conversation_id"] = conversation_id_for(copy)
+            docs.append(copy)
+        threads.append(docs)
+
+    stored, error = set(), None
+    for name, docs in by_collection.items():
+        if docs:
+            landed, failure = insert_messages(db, name, docs)
+            stored.update(copy["_id"] for copy in landed)
+            by_collection[name] = landed
+            error = error or failure
+    threads = [[copy for copy in docs if copy["_id"] in stored] for docs in threads]
+    threads = [docs for docs in threads if docs]
+
+    # The copies share the originals' stored files
+    refs = {}
+    for docs in threads:
+        for copy in docs:
+            if copy.get("file_hash"):
+                refs[copy["file_hash"]] = refs.get(copy["file_hash"], 0) + 1
+    for digest, count in refs.items():
+        add_ref(db, digest, count)
+
+    for docs in threads:
+        record_message(db, docs[-1], count=len(docs))
+        broadcast_messages(docs)
+    if error is not None:
+        raise ForwardError(str(error), 503, forwarded=len(stored))
+    return by_collection
+
+def _targets(data):
+    targets = []
+    for t in data.get("targets") or []:
+        if not isinstance(t, dict) or t.get("chat_type") not in ("user", "group") or not t.get("id"):
+            raise ForwardError("Invalid target", 400)
+        targets.append({"id": str(t["id"]), "chat_type": t["chat_type"]})
+    # The same chat twice would deliver everything twice
+    return list({(t["chat_type"], t["id"]): t for t in targets}.values())
+
+def _forward(message_ids, targets):
+    """Validate, then charge one forward token per target chat, then copy."""
+    db = get_db()
+    try:
+        sources = check_forward(db, session["user"], message_ids, targets)
+    except ForwardError as e:
+        return None, _forward_error_response(e)
+    # One token per target chat: each is a batch insert and a broadcast
+    denied = ratelimit.check("forward", cost=len(targets))
+    if denied is not None:
+        return None, denied
+    try:
+        return forward(db, session["user"], sources, targets), None
+    except ForwardError as e:
+        return None, _forward_error_response(e)
+
+@send_bp.route("/forward_message", methods=["POST"])
+@login_required
+def forward_message():
+    data = request.get_json() or {}
+    target = {"id": data.get("target_id"), "chat_type": "user" if data.get("chat_type") == "user" else "group"}
+    try:
+        targets = _targets({"targets": [target]})
+    except ForwardError as e:
+        return _forward_error_response(e)
+    _, error = _forward([data.get("message_id")], targets)
+    if error is not None:
+        return error
     return jsonify({"success": True})
+
+@send_bp.route("/forward_messages", methods=["POST"])
+@login_required
+def forward_messages():
+    """Bulk forward: {"message_ids": [...], "targets": [{"id", "chat_type": "user"|"group"}]}."""
+    data = request.get_json() or {}
+    try:
+        targets = _targets(data)
+    except ForwardError as e:
+        return _forward_error_response(e)
+    written, error = _forward(data.get("message_ids") or [], targets)
+    if error is not None:
+        return error
+    return jsonify({"success": True, "forwarded": sum(len(docs) for docs in written.values())})
@@ -1,8 +1,8 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash
 from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
 from db_config import get_db
-import os
+from blob_store import UploadTooLarge
+import images
 
 signup_bp = Blueprint("signup", __name__)
 
@@ -29,21 +29,21 @@ def signup():
         hashed_password = generate_password_hash(password, method="pbkdf2:sha256")
 
         # handle profile image
-        image_path = None
+        image_path, image_urls = None, {}
         if profile_image and profile_image.filename != "":
-            filename = secure_filename(profile_image.filename)
-            upload_folder = os.path.join(current_app.root_path, "uploads")
-            os.makedirs(upload_folder, exist_ok=True)
-            save_path = os.path.join(upload_folder, filename)
-            profile_image.save(save_path)
-            image_path = f"/uploads/profile_pic/{filename}"
+            try:
+                image_path, image_urls = images.save_avatar(db, profile_image)
+            except (UploadTooLarge, images.InvalidImage) as e:
+                flash(str(e), "danger")
+                return redirect(url_for("signup.signup"))
 
         # save user
         users_col.insert_one({
             "username": username,
             "email": email,
             "password": hashed_password,
-            "profile_image": image_path
+            "profile_image": image_path,
+            "profile_images": image_urls
         })
 
         flash("Signup successful! Please login.", "success")
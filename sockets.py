@@ -0,0 +1,178 @@
+from flask import request, session
+from flask_socketio import SocketIO, join_room, rooms
+
+from db_config import get_db
+from history import serialize_message
+import membership
+import presence
+import receipts
+
+socketio = SocketIO()
+
+
+def user_room(username):
+    return f"user:{username}"
+
+
+def group_room(group_id):
+    return f"group:{group_id}"
+
+
+@socketio.on("connect")
+def on_connect():
+    username = session.get("user")
+    if not username:
+        return False  # reject anonymous sockets
+
+    # One indexed query puts the socket in every room it should hear from
+    join_room(user_room(username))
+    for group_id in membership.group_ids_for(get_db(), username):
+        join_room(group_room(group_id))
+    presence.registry.connect(username, request.sid)
+    presence.registry.start(socketio, _emit_presence)
+
+
+@socketio.on("disconnect")
+def on_disconnect():
+    presence.registry.disconnect(request.sid)
+
+
+@socketio.on("heartbeat")
+def on_heartbeat():
+    username = session.get("user")
+    if not username:
+        return {"success": False}
+    # Expired after missed heartbeats but still connected: register again
+    if not presence.registry.heartbeat(request.sid):
+        presence.registry.connect(username, request.sid)
+    return {"success": True}
+
+
+@socketio.on("watch_presence")
+def on_watch_presence(data):
+    """Follow {usernames: [...]}; the ack is their current status, diffs follow as "presence"."""
+    username = session.get("user")
+    usernames = data.get("usernames") if isinstance(data, dict) else None
+    if not username or not isinstance(usernames, list):
+        return {"success": False}
+    watched = presence.registry.watch(request.sid, usernames)
+    return {"success": True, "presence": presence.lookup(get_db(), watched)}
+
+
+@socketio.on("typing")
+def on_typing(data):
+    """{chat_type, id, typing: bool}; starts are debounced and sent in batches."""
+    username = session.get("user")
+    if not username or not isinstance(data, dict):
+        return {"success": False}
+
+    chat_type = data.get("chat_type")
+    target = data.get("id")
+    if chat_type == "group":
+        if group_room(target) not in rooms():
+            return {"success": False}
+        # Group members see the group as the thread
+        room_kind, room_key, thread_id = "group", target, target
+    elif chat_type == "user" and target and isinstance(target, str) and target != username:
+        # The peer sees the typist as the thread
+        room_kind, room_key, thread_id = "user", target, username
+    else:
+        return {"success": False}
+
+    presence.registry.typing(username, chat_type, target, room_kind, room_key, thread_id,
+                             bool(data.get("typing")))
+    return {"success": True}
+
+
+def _emit_presence(event, payload, room_kind, key):
+    if room_kind == "sid":
+        socketio.emit(event, payload, to=key)
+    elif room_kind == "group":
+        socketio.emit(event, payload, to=group_room(key))
+    else:
+        socketio.emit(event, payload, to=user_room(key))
+
+
+@socketio.on("join")
+def on_join(data):
+    """Join a group room, e.g. after being added to a group mid-session."""
+    username = session.get("user")
+    group_id = data.get("group_id") if isinstance(data, dict) else None
+    if not username or not group_id:
+        return {"success": False}
+
+    if not membership.is_member(get_db(), group_id, username):
+        return {"success": False}
+
+    join_room(group_room(group_id))
+    return {"success": True}
+
+
+@socketio.on("receipt")
+def on_receipt(data):
+    """High-water mark report: {chat_type, id, status: delivered|read, cursor}."""
+    username = session.get("user")
+    if not username or not isinstance(data, dict) or data.get("status") not in receipts.STATUSES:
+        return {"success": False}
+
+    chat_type = data.get("chat_type")
+    target = data.get("id")
+    if chat_type == "group":
+        # Membership was checked when the socket joined the room
+        if group_room(target) not in rooms():
+            return {"success": False}
+    elif chat_type != "user" or not target or target == username:
+        return {"success": False}
+
+    try:
+        receipts.buffer.add(chat_type, target, username, data["status"], data.get("cursor") or "")
+    except ValueError:
+        return {"success": False}
+    receipts.buffer.start(socketio, _emit_receipt)
+    return {"success": True}
+
+
+def _emit_receipt(event, usernames):
+    socketio.emit("status", event, to=[user_room(u) for u in usernames])
+
+
+def message_payload(msg_doc):
+    payload = serialize_message(msg_doc)
+    payload["chat_type"] = "group" if msg_doc.get("group_id") else "user"
+    return payload
+
+
+def broadcast_message(msg_doc):
+    """Deliver a stored message to every socket that should render it."""
+    payload = message_payload(msg_doc)
+    if msg_doc.get("group_id"):
+        socketio.emit("new_message", payload, to=group_room(msg_doc["group_id"]))
+    else:
+        # The sender's own room too, so their other tabs stay in step
+        socketio.emit("new_message", payload, to=[user_room(msg_doc["receiver"]),
+                                                  user_room(msg_doc["sender"])])
+    return payload
+
+
+def broadcast_messages(msg_docs):
+    """Deliver stored messages of one thread with a single "new_messages" emit."""
+    if not msg_docs:
+        return []
+    payloads = [message_payload(m) for m in msg_docs]
+    first = msg_docs[0]
+    if first.get("group_id"):
+        rooms = group_room(first["group_id"])
+    else:
+        rooms = [user_room(first["receiver"]), user_room(first["sender"])]
+    socketio.emit("new_messages", payloads, to=rooms)
+    return payloads
+
+
+def broadcast_message_update(msg_doc, fields):
+    """Push changed fields of an already delivered message to its thread."""
+    payload = dict(fields, _id=str(msg_doc["_id"]))
+    if msg_doc.get("group_id"):
+        socketio.emit("message_updated", payload, to=group_room(msg_doc["group_id"]))
+    else:
+        socketio.emit("message_updated", payload, to=[user_room(msg_doc["receiver"]),
+                                                      user_room(msg_doc["sender"])])
@@ -0,0 +1,1255 @@
+// Chat page script. The page embeds its data as JSON (#chatBoot); switching
+// threads fetches /chat/thread and re-renders instead of loading a new page.
+const BOOT = JSON.parse(document.getElementById("chatBoot").textContent);
+const URLS = BOOT.urls;
+const CURRENT_USER = BOOT.user;
+var socket = io(BOOT.socketio_options);
+
+// The open thread: { user: name } or { group: id }, null when none is open
+let HISTORY_QUERY = null;
+let currentThread = null;
+
+socket.on("new_message", handleNewMessage);
+// Bulk forwards arrive as one event per thread
+socket.on("new_messages", function (msgs) {
+  msgs.forEach(handleNewMessage);
+});
+
+function handleNewMessage(msg) {
+  updateSidebar(msg);
+  if (typingUsers[msg.sender]) {
+    delete typingUsers[msg.sender];
+    renderChatStatus();
+  }
+  let isOpen = false;
+  if (msg.chat_type === "user" && HISTORY_QUERY && HISTORY_QUERY.user) {
+    if ((msg.sender === HISTORY_QUERY.user && msg.receiver === CURRENT_USER) ||
+      (msg.sender === CURRENT_USER && msg.receiver === HISTORY_QUERY.user)) {
+      addMessageToChat(msg);
+      isOpen = true;
+    }
+  } else if (msg.chat_type === "group" && HISTORY_QUERY && HISTORY_QUERY.group) {
+    if (msg.group_id === HISTORY_QUERY.group) {
+      addMessageToChat(msg);
+      isOpen = true;
+    }
+  }
+  if (msg.sender !== CURRENT_USER && msg.cursor) {
+    const id = msg.chat_type === "group" ? msg.group_id : msg.sender;
+    reportReceipt(msg.chat_type, id, "delivered", msg.cursor);
+    if (isOpen && document.visibilityState === "visible") {
+      reportReceipt(msg.chat_type, id, "read", msg.cursor);
+    }
+  }
+}
+
+// Receipts are high-water marks: "everything up to this cursor". Reports
+// are merged per thread and status and sent at most every 500ms.
+const pendingReceipts = {};
+let receiptTimer = null;
+
+function compareCursors(a, b) {
+  const [msA, idA] = a.split("-");
+  const [msB, idB] = b.split("-");
+  return (Number(msA) - Number(msB)) || (idA < idB ? -1 : idA > idB ? 1 : 0);
+}
+
+function reportReceipt(chatType, id, status, cursor) {
+  const key = [chatType, id, status].join("|");
+  const current = pendingReceipts[key];
+  if (!current || compareCursors(cursor, current.cursor) > 0) {
+    pendingReceipts[key] = { chat_type: chatType, id: id, status: status, cursor: cursor };
+  }
+  if (!receiptTimer) receiptTimer = setTimeout(flushReceipts, 500);
+}
+
+function flushReceipts() {
+  receiptTimer = null;
+  Object.keys(pendingReceipts).forEach(key => {
+    socket.emit("receipt", pendingReceipts[key]);
+    delete pendingReceipts[key];
+  });
+}
+
+// Mark the open thread read up to its newest incoming message
+function reportThreadRead() {
+  if (!HISTORY_QUERY || newerCursor || document.visibilityState !== "visible") return;
+  const incoming = document.querySelectorAll(".chat-messages .message.incoming[data-cursor]");
+  const last = incoming[incoming.length - 1];
+  if (!last || !last.dataset.cursor) return;
+  const chatType = HISTORY_QUERY.group ? "group" : "user";
+  reportReceipt(chatType, HISTORY_QUERY.group || HISTORY_QUERY.user, "read", last.dataset.cursor);
+}
+
+document.addEventListener("visibilitychange", reportThreadRead);
+
+const STATUS_RANK = { sent: 0, delivered: 1, read: 2 };
+
+// The other side advanced its watermark: update ticks on our messages up to it
+socket.on("status", applyReceipt);
+
+function applyReceipt(event) {
+  if (event.chat_type !== "user" || !HISTORY_QUERY || HISTORY_QUERY.user !== event.reader) return;
+  document.querySelectorAll(".chat-messages .message.outgoing[data-cursor]").forEach(el => {
+    const tick = el.querySelector(".msg-status");
+    if (!tick || compareCursors(el.dataset.cursor, event.up_to) > 0) return;
+    if (STATUS_RANK[event.status] > (STATUS_RANK[tick.dataset.status] || 0)) {
+      tick.dataset.status = event.status;
+    }
+  });
+}
+
+// Move the message's thread to the top of the sidebar with a fresh preview
+function updateSidebar(m) {
+  const kind = m.chat_type;
+  const id = kind === "group" ? m.group_id : (m.sender === CURRENT_USER ? m.receiver : m.sender);
+  const item = document.querySelector(`.chat-list .chat-item[data-kind="${kind}"][data-id="${CSS.escape(id)}"]`);
+  if (!item) return;
+
+  const preview = item.querySelector(".chat-item-preview");
+  if (preview) {
+    preview.textContent = m.type === "image" ? "Photo" : m.type === "file" ? (m.file_name || "File") : m.message;
+  }
+  const isOpen = HISTORY_QUERY && (kind === "group" ? HISTORY_QUERY.group === id : HISTORY_QUERY.user === id);
+  const badge = item.querySelector(".unread-badge");
+  if (badge && !isOpen && m.sender !== CURRENT_USER) {
+    badge.textContent = (parseInt(badge.textContent, 10) || 0) + 1;
+    badge.style.display = "";
+  }
+  const search = item.parentNode.querySelector(".sidebar-search");
+  item.parentNode.insertBefore(item, search ? search.nextSibling : item.parentNode.firstChild);
+}
+
+// Catch up after a dropped connection: one /sync call instead of a reload
+let syncSince = BOOT.sync_since;
+let syncing = false;
+
+socket.io.on("reconnect", syncAfterReconnect);
+
+function syncAfterReconnect() {
+  if (syncing) return;
+  syncing = true;
+  const params = { since: syncSince };
+  const query = HISTORY_QUERY;
+  const rendered = document.querySelectorAll(".chat-messages .message[data-cursor]");
+  if (HISTORY_QUERY && !newerCursor && rendered.length) {
+    Object.assign(params, HISTORY_QUERY, { after: rendered[rendered.length - 1].dataset.cursor });
+  }
+  $.ajax({
+    url: URLS.sync,
+    type: "GET",
+    data: params,
+    success: function (res) {
+      if (res.reload) {
+        window.location.reload();
+        return;
+      }
+      syncSince = res.server_time;
+      // Oldest first, so the most recent thread ends up on top
+      res.conversations.slice().reverse().forEach(applyConversation);
+      applyGroups(res.groups, res.joined);
+      if (query === HISTORY_QUERY) res.messages.forEach(m => addMessageToChat(m));
+      res.receipts.forEach(applyReceipt);
+      reportThreadRead();
+    },
+    complete: function () {
+      syncing = false;
+    }
+  });
+}
+
+// Presence: the server sends the status of the users in the sidebar and
+// header when asked, then only changes, batched, as "presence" events
+const presenceState = {};
+const typingUsers = {};  // username -> ms when the indicator lapses
+let watchTimer = null;
+
+function watchPresence() {
+  const names = new Set();
+  document.querySelectorAll(".chat-list .presence-dot[data-presence]").forEach(dot => names.add(dot.dataset.presence));
+  if (HISTORY_QUERY && HISTORY_QUERY.user) names.add(HISTORY_QUERY.user);
+  socket.emit("watch_presence", { usernames: Array.from(names) }, function (res) {
+    if (res && res.success) applyPresence(res.presence);
+  });
+}
+
+function scheduleWatchPresence() {
+  clearTimeout(watchTimer);
+  watchTimer = setTimeout(watchPresence, 500);
+}
+
+function applyPresence(users) {
+  Object.assign(presenceState, users);
+  Object.keys(users).forEach(name => {
+    document.querySelectorAll(`.presence-dot[data-presence="${CSS.escape(name)}"]`).forEach(dot => {
+      dot.classList.toggle("online", !!users[name].online);
+    });
+  });
+  renderChatStatus();
+}
+
+socket.on("connect", watchPresence);
+socket.on("presence", applyPresence);
+setInterval(function () {
+  if (socket.connected) socket.emit("heartbeat");
+}, BOOT.presence_heartbeat_ms);
+
+// Typing: at most one start per interval per thread from here; the
+// server debounces again and sends one batched event per room
+let typingSentAt = 0;
+
+function sendTyping(active) {
+  if (!HISTORY_QUERY) return;
+  const now = Date.now();
+  if (active && now - typingSentAt < BOOT.typing_interval_ms) return;
+  if (!active && !typingSentAt) return;
+  typingSentAt = active ? now : 0;
+  socket.emit("typing", {
+    chat_type: HISTORY_QUERY.group ? "group" : "user",
+    id: HISTORY_QUERY.group || HISTORY_QUERY.user,
+    typing: active
+  });
+}
+
+$(".message-box").on("input", function () {
+  sendTyping(this.value.trim() !== "");
+});
+
+socket.on("typing", function (event) {
+  if (!HISTORY_QUERY) return;
+  const open = event.chat_type === "group" ? HISTORY_QUERY.group === event.id : HISTORY_QUERY.user === event.id;
+  if (!open) return;
+  event.typing.forEach(u => { if (u !== CURRENT_USER) typingUsers[u] = Date.now() + event.ttl * 1000; });
+  event.stopped.forEach(u => { delete typingUsers[u]; });
+  renderChatStatus();
+});
+
+function renderChatStatus() {
+  const el = document.getElementById("chatStatus");
+  if (!el) return;
+  const now = Date.now();
+  Object.keys(typingUsers).forEach(u => { if (typingUsers[u] < now) delete typingUsers[u]; });
+  const typing = Object.keys(typingUsers);
+  if (typing.length === 1) {
+    el.textContent = HISTORY_QUERY.group ? `${typing[0]} is typing…` : "typing…";
+  } else if (typing.length) {
+    el.textContent = typing.length > 3 ? `${typing.length} people are typing…` : `${typing.join(", ")} are typing…`;
+  } else if (HISTORY_QUERY && HISTORY_QUERY.user && presenceState[HISTORY_QUERY.user]) {
+    const p = presenceState[HISTORY_QUERY.user];
+    el.textContent = p.online ? "online" : p.last_seen ? "last seen " + new Date(p.last_seen).toLocaleString() : "";
+  } else {
+    el.textContent = "";
+  }
+}
+setInterval(renderChatStatus, 1000);
+
+function sidebarItem(kind, id) {
+  return document.querySelector(`.chat-list .chat-item:not(.directory-item)[data-kind="${kind}"][data-id="${CSS.escape(id)}"]`);
+}
+
+function createSidebarItem(entry) {
+  const item = document.createElement("div");
+  item.className = "chat-item";
+  item.dataset.kind = entry.kind;
+  item.dataset.id = entry.id;
+  const name = entry.kind === "group" ? `<strong>${escapeHtml(entry.name || "")}</strong>` : `<span>${escapeHtml(entry.name || "")}</span>`;
+  const dot = entry.kind === "user" ? `<span class="presence-dot" data-presence="${escapeHtml(entry.id)}"></span>` : "";
+  item.innerHTML = `<img src="${escapeHtml(entry.image || "/static/default_profile.png")}" alt="" class="user-list-pic">${dot}
+    <div class="chat-item-text">${name}<small class="chat-item-preview"></small></div>
+    <span class="unread-badge" style="display:none;">0</span>`;
+  item.querySelector("img").onclick = () => entry.kind === "group" ? openGroupProfile(entry.id) : openUserProfile(entry.id);
+  item.querySelector(".chat-item-text").onclick = () => switchThread({ [entry.kind]: entry.id });
+  const directoryEntry = document.querySelector(`#directoryList .chat-item[data-id="${CSS.escape(entry.id)}"]`);
+  if (directoryEntry && entry.kind === "user") directoryEntry.remove();
+  if (entry.kind === "user") scheduleWatchPresence();
+  return item;
+}
+
+function moveToTop(item) {
+  const list = document.querySelector(".chat-list");
+  const search = list.querySelector(".sidebar-search");
+  list.insertBefore(item, search ? search.nextSibling : list.firstChild);
+}
+
+function applyConversation(c) {
+  const item = sidebarItem(c.kind, c.id) || createSidebarItem(c);
+  item.querySelector(".chat-item-preview").textContent = c.last_message;
+  const isOpen = HISTORY_QUERY && (c.kind === "group" ? HISTORY_QUERY.group === c.id : HISTORY_QUERY.user === c.id);
+  const badge = item.querySelector(".unread-badge");
+  if (badge) {
+    badge.textContent = c.unread;
+    badge.style.display = c.unread && !isOpen ? "" : "none";
+  }
+  moveToTop(item);
+}
+
+function applyGroups(groupIds, joined) {
+  const current = new Set(groupIds);
+  document.querySelectorAll('.chat-list .chat-item[data-kind="group"]').forEach(item => {
+    if (!current.has(item.dataset.id)) item.remove();
+  });
+  if (HISTORY_QUERY && HISTORY_QUERY.group && !current.has(HISTORY_QUERY.group)) {
+    switchThread({});
+    return;
+  }
+  joined.forEach(g => {
+    if (!sidebarItem("group", g.id)) moveToTop(createSidebarItem(Object.assign({ kind: "group" }, g)));
+  });
+}
+
+function addMessageToChatKeepScroll(m) {
+  addMessageToChat(m, true);
+}
+
+function addMessageToChat(m, keepScroll) {
+  let container = document.querySelector(".chat-messages");
+  if (!container) return;
+  // Viewing an older window: live messages arrive with the newer pages
+  if (newerCursor) return;
+  // The send ack and the socket broadcast both deliver our own messages
+  if (m._id && container.querySelector(`.message[data-id="${m._id}"]`)) return;
+
+  const date = m.timestamp.slice(0, 10);
+  const labels = container.querySelectorAll(".date-label");
+  const lastLabel = labels[labels.length - 1];
+  if (!lastLabel || lastLabel.dataset.date !== date) {
+    container.appendChild(buildDateLabel(date));
+  }
+  container.appendChild(buildMessageElement(m));
+  if (!keepScroll) container.scrollTop = container.scrollHeight;
+}
+
+// Send without reloading: one POST, rendered from the ack / broadcast
+$(".chat-input").on("submit", function (e) {
+  e.preventDefault();
+  const form = this;
+  const formData = new FormData(form);
+  const hasFile = form.querySelector('input[type="file"]').files.length > 0;
+  if (!hasFile && !String(formData.get("message") || "").trim()) return;
+
+  $.ajax({
+    url: $(form).attr("action"),
+    type: "POST",
+    data: formData,
+    processData: false,
+    contentType: false,
+    headers: { Accept: "application/json" },
+    success: function (res) {
+      form.querySelector('input[name="message"]').value = "";
+      sendTyping(false);
+      removeSelectedFile(form);
+      cancelReply();
+      if (res.message) addMessageToChat(res.message);
+    },
+    error: function (xhr) {
+      alert("Error sending message: " + (xhr.responseJSON && xhr.responseJSON.error || xhr.statusText));
+    }
+  });
+});
+
+function escapeHtml(text) {
+  return String(text == null ? "" : text).replace(/[&<>"']/g, c => ({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"
+  }[c]));
+}
+
+// Timestamps are stored in UTC ("YYYY-MM-DDTHH:MM:SS"); show them in IST
+function formatIstTime(ts) {
+  let hour = parseInt(ts.slice(11, 13), 10);
+  let min = parseInt(ts.slice(14, 16), 10) + 30;
+  hour = (hour + Math.floor(min / 60) + 5) % 24;
+  min = min % 60;
+  const ampm = hour < 12 ? "AM" : "PM";
+  const hour12 = (hour % 12) || 12;
+  return `${String(hour12).padStart(2, "0")}:${String(min).padStart(2, "0")} ${ampm}`;
+}
+
+function buildDateLabel(date) {
+  let div = document.createElement("div");
+  div.className = "date-label";
+  div.dataset.date = date;
+  div.style.cssText = "text-align:center;color:#888;font-size:12px;margin:20px 0 8px;";
+  div.textContent = date === TODAY_IST ? "Today" : date === YESTERDAY_IST ? "Yesterday"
+    : `${date.slice(8, 10)}/${date.slice(5, 7)}/${date.slice(0, 4)}`;
+  return div;
+}
+
+// Thumbnail when ready, a placeholder while pending, the original otherwise;
+// the full-size file is only fetched from the viewer
+function imageMarkup(m) {
+  const full = escapeHtml(m.file_url);
+  if (m.thumbnail_url) {
+    return `<img src="${escapeHtml(m.thumbnail_url)}" alt="Image" class="msg-image" loading="lazy" data-full="${full}" onclick="openImageModal(this.dataset.full)">`;
+  }
+  if (m.thumbnail_status === "pending") {
+    return `<div class="msg-image-pending" data-full="${full}" onclick="openImageModal(this.dataset.full)">${escapeHtml(m.file_name || "Image")}</div>`;
+  }
+  return `<img src="${full}" alt="Image" class="msg-image" loading="lazy" data-full="${full}" onclick="openImageModal(this.dataset.full)">`;
+}
+
+socket.on("message_updated", function (update) {
+  const el = document.querySelector(`.chat-messages .message[data-id="${update._id}"]`);
+  if (!el || !update.thumbnail_url) return;
+  const pending = el.querySelector(".msg-image-pending");
+  if (pending) {
+    pending.outerHTML = imageMarkup({ file_url: pending.dataset.full, thumbnail_url: update.thumbnail_url });
+  } else if (!el.querySelector(".msg-image, .msg-file-preview")) {
+    const link = el.querySelector("a[download]");
+    if (link) link.insertAdjacentHTML("beforebegin",
+      `<img src="${escapeHtml(update.thumbnail_url)}" alt="Preview" class="msg-file-preview" loading="lazy">`);
+  }
+});
+
+function buildMessageElement(m) {
+  let div = document.createElement("div");
+  div.classList.add("message", m.sender === CURRENT_USER ? "outgoing" : "incoming");
+  if (m._id) div.dataset.id = m._id;
+  if (m.cursor) div.dataset.cursor = m.cursor;
+
+  let html = `<div class="msg-content">`;
+  if (m.type === "text") {
+    html += `<p>${escapeHtml(m.message)}</p>`;
+  } else if (m.type === "image") {
+    html += imageMarkup(m);
+  } else if (m.type === "file") {
+    if (m.thumbnail_url) {
+      html += `<img src="${escapeHtml(m.thumbnail_url)}" alt="Preview" class="msg-file-preview" loading="lazy">`;
+    }
+    html += `<a href="${escapeHtml(m.file_url)}" download>${escapeHtml(m.file_name)}</a>`;
+  }
+  const direct = m.chat_type ? m.chat_type === "user" : !m.group_id;
+  const tick = direct && m.sender === CURRENT_USER
+    ? `<span class="msg-status" data-status="${escapeHtml(m.status || "sent")}"></span>` : "";
+  html += `<small class="msg-time">${formatIstTime(m.timestamp)}${tick}</small></div>`;
+  div.innerHTML = html;
+  return div;
+}
+
+// Older history is fetched page by page as the user scrolls up
+const TODAY_IST = BOOT.today_ist;
+const YESTERDAY_IST = BOOT.yesterday_ist;
+let historyCursor = null;
+let newerCursor = null;
+let loadingHistory = false;
+
+function loadOlderMessages() {
+  const container = document.querySelector(".chat-messages");
+  if (!container || !HISTORY_QUERY || !historyCursor || loadingHistory) return;
+  loadingHistory = true;
+  const query = HISTORY_QUERY;
+
+  $.ajax({
+    url: URLS.history,
+    type: "GET",
+    data: Object.assign({ before: historyCursor }, HISTORY_QUERY),
+    success: function (res) {
+      if (query !== HISTORY_QUERY) return;  // switched threads meanwhile
+      const previousHeight = container.scrollHeight;
+      const fragment = document.createDocumentFragment();
+      let lastDate = null;
+      res.messages.forEach(m => {
+        const date = m.timestamp.slice(0, 10);
+        if (date !== lastDate) {
+          fragment.appendChild(buildDateLabel(date));
+          lastDate = date;
+        }
+        fragment.appendChild(buildMessageElement(m));
+      });
+
+      // The page continues the day already shown at the top
+      const first = container.firstElementChild;
+      if (first && first.classList.contains("date-label") && first.dataset.date === lastDate) {
+        first.remove();
+      }
+      container.insertBefore(fragment, container.firstChild);
+      container.scrollTop += container.scrollHeight - previousHeight;
+      historyCursor = res.next_cursor;
+    },
+    complete: function () {
+      loadingHistory = false;
+    }
+  });
+}
+
+// After jumping to an older message, newer pages load when scrolling down
+function loadNewerMessages() {
+  const container = document.querySelector(".chat-messages");
+  if (!container || !HISTORY_QUERY || !newerCursor || loadingHistory) return;
+  loadingHistory = true;
+  const query = HISTORY_QUERY;
+
+  $.ajax({
+    url: URLS.history,
+    type: "GET",
+    data: Object.assign({ after: newerCursor }, HISTORY_QUERY),
+    success: function (res) {
+      if (query !== HISTORY_QUERY) return;
+      const next = res.next_cursor;
+      newerCursor = null;  // let addMessageToChat append this page
+      res.messages.forEach(addMessageToChatKeepScroll);
+      newerCursor = next;
+    },
+    complete: function () {
+      loadingHistory = false;
+    }
+  });
+}
+
+(function initHistory() {
+  const container = document.querySelector(".chat-messages");
+  container.addEventListener("scroll", function () {
+    if (container.scrollTop < 200) loadOlderMessages();
+    if (container.scrollHeight - container.scrollTop - container.clientHeight < 200) loadNewerMessages();
+  });
+})();
+
+// Threads: the first one comes embedded in the page, later ones from /chat/thread
+function renderThread(thread) {
+  currentThread = thread;
+  HISTORY_QUERY = thread ? { [thread.kind]: thread.id } : null;
+  historyCursor = thread ? thread.history_cursor : null;
+  newerCursor = null;
+  typingSentAt = 0;
+  Object.keys(typingUsers).forEach(u => { delete typingUsers[u]; });
+
+  const container = document.querySelector(".chat-messages");
+  const form = document.querySelector(".chat-input");
+  container.innerHTML = "";
+  $("#noThread").toggle(!thread);
+  $("#threadHeader, .chat-messages, .chat-input").toggle(!!thread);
+  $("#chatSearch").val("");
+  $("#chatSearchResults").hide().empty();
+  cancelReply();
+  removeSelectedFile(form);
+  form.querySelector(".message-box").value = "";
+  renderChatStatus();
+  if (!thread) return;
+
+  const image = document.getElementById("threadImage");
+  image.src = thread.image;
+  image.alt = thread.kind === "group" ? "Group" : "Profile";
+  document.getElementById("threadTitle").textContent = thread.name || "";
+  document.getElementById("threadReceiver").value = thread.id;
+  document.getElementById("threadChatType").value = thread.kind;
+  // The server joins a socket to its rooms on connect; this covers groups added since
+  if (thread.kind === "group") socket.emit("join", { group_id: thread.id });
+
+  thread.messages.forEach(m => addMessageToChat(m, true));
+  newerCursor = thread.newer_cursor;
+  const anchor = thread.anchor && container.querySelector(`.message[data-cursor="${CSS.escape(thread.anchor)}"]`);
+  if (anchor) {
+    anchor.classList.add("anchor");
+    anchor.scrollIntoView({ block: "center" });
+  } else {
+    container.scrollTop = container.scrollHeight;
+  }
+
+  const item = sidebarItem(thread.kind, thread.id);
+  if (item) item.querySelector(".unread-badge").style.display = "none";
+  scheduleWatchPresence();
+  reportThreadRead();
+  // A first page that does not fill the pane never scrolls; fetch more now
+  if (container.scrollHeight <= container.clientHeight) loadOlderMessages();
+}
+
+function renderSidebar(entries) {
+  document.querySelectorAll(".chat-list .chat-item:not(.directory-item)").forEach(item => item.remove());
+  const directory = document.getElementById("directoryList");
+  entries.forEach(entry => {
+    const item = createSidebarItem(entry);
+    item.querySelector(".chat-item-preview").textContent = entry.last_message || "";
+    const badge = item.querySelector(".unread-badge");
+    badge.textContent = entry.unread;
+    badge.style.display = entry.unread ? "" : "none";
+    directory.parentNode.insertBefore(item, directory);
+  });
+}
+
+// Switch threads without a page load; the URL still names the open thread
+let threadRequest = null;
+
+function switchThread(query, fromHistory) {
+  if (threadRequest) threadRequest.abort();
+  const search = $.param(query);
+  const url = URLS.chat + (search ? "?" + search : "");
+  threadRequest = $.ajax({
+    url: URLS.thread,
+    type: "GET",
+    data: query,
+    success: function (res) {
+      syncSince = res.server_time;
+      renderSidebar(res.sidebar);
+      renderThread(res.thread);
+      if (!fromHistory) history.pushState(query, "", url);
+    },
+    error: function (xhr) {
+      if (xhr.statusText !== "abort") window.location.href = url;
+    },
+    complete: function () {
+      threadRequest = null;
+    }
+  });
+}
+
+window.addEventListener("popstate", function () {
+  switchThread(Object.fromEntries(new URLSearchParams(window.location.search)), true);
+});
+
+function openThreadProfile() {
+  if (!currentThread) return;
+  if (currentThread.kind === "group") openGroupProfile(currentThread.id);
+  else openUserProfile(currentThread.id);
+}
+
+function openSearchHit(link) {
+  switchThread(Object.fromEntries(new URL(link.href, window.location.href).searchParams));
+  return false;
+}
+
+// Image modal
+function openImageModal(src) {
+  document.getElementById("imageModal").style.display = "block";
+  document.getElementById("modalImage").src = src;
+}
+function closeImageModal() {
+  document.getElementById("imageModal").style.display = "none";
+}
+
+// Profile modals
+function openProfileModal() { $("#profileModal").show(); }
+function closeProfileModal() { $("#profileModal").hide(); }
+
+function openUserProfile(username) {
+  $.ajax({
+    url: "/user_profile/" + username,
+    type: "GET",
+    success: function (res) {
+      $("#userProfilePic").attr("src", res.profile_image);
+      $("#userProfileName").text(res.username);
+      $("#userProfileEmail").text(res.email || "No email provided");
+      $("#userProfileModal").show();
+    }
+  });
+}
+function closeUserProfile() { $("#userProfileModal").hide(); }
+
+// Member variables
+let membersToAdd = [];
+let membersToRemove = [];
+
+function showMemberManagement() {
+  $("#groupProfileView").hide();
+  $("#memberManagement").show();
+
+  membersToAdd = [];
+  membersToRemove = [];
+  $("#availableUsersSearch").val("");
+  loadAvailableUsers(false);
+}
+
+// Available users come one page at a time, filtered by username prefix
+let availableUsersCursor = null;
+let availableSearchTimer = null;
+
+function loadAvailableUsers(append) {
+  const groupId = $("#editGroupId").val();
+  const params = { group_id: groupId, q: $("#availableUsersSearch").val() };
+  if (append && availableUsersCursor) params.after = availableUsersCursor;
+
+  $.ajax({
+    url: "/available_users",
+    type: "GET",
+    data: params,
+    success: function(data) {
+      if (data.members) {
+        renderCurrentMembers(data.members, false);
+        setMembersCursor("manage", data.members_next_cursor);
+      }
+      renderAvailableUsers(data.available || [], append);
+      availableUsersCursor = data.next_cursor;
+      $("#availableUsersMore").toggle(!!data.next_cursor);
+    },
+    error: function(xhr) {
+      alert("Could not load members: " + xhr.responseText);
+    }
+  });
+}
+
+function searchAvailableUsers() {
+  clearTimeout(availableSearchTimer);
+  availableSearchTimer = setTimeout(() => loadAvailableUsers(false), 250);
+}
+
+// Member lists come one page at a time from /group_members
+const membersCursors = { profile: null, manage: null };
+
+function setMembersCursor(target, cursor) {
+  membersCursors[target] = cursor;
+  $(target === "profile" ? "#groupMembersMore" : "#currentMembersMore").toggle(!!cursor);
+}
+
+function loadMoreMembers(target) {
+  const groupId = $("#editGroupId").val();
+  if (!membersCursors[target]) return;
+  $.ajax({
+    url: "/group_members/" + groupId,
+    type: "GET",
+    data: { after: membersCursors[target] },
+    success: function(data) {
+      if (target === "profile") renderGroupMembers(data.members, true);
+      else renderCurrentMembers(data.members, true);
+      setMembersCursor(target, data.members_next_cursor);
+    }
+  });
+}
+
+// Render current members of the group
+function renderCurrentMembers(members, append) {
+  const list = $("#currentMembersList");
+  if (!append) list.empty();
+  
+  if (!append && (!members || members.length === 0)) {
+    list.append("<div style='padding:8px;color:#666;'>No members</div>");
+    return;
+  }
+
+  members.forEach(m => {
+    const img = m.profile_image;
+    const username = m.username;
+    
+    list.append(`
+      <div class="member-item" data-username="${username}" style="display:flex;align-items:center;justify-content:space-between;padding:8px;border-bottom:1px solid #eee;">
+        <div style="display:flex;align-items:center;gap:8px;">
+          <img src="${img}" alt="${username}" style="width:32px;height:32px;border-radius:50%;object-fit:cover;">
+          <span>${username}</span>
+        </div>
+        <button type="button" class="remove-btn" onclick="removeMember('${username}')" ${username === CURRENT_USER ? 'disabled' : ''}>
+          ${username === CURRENT_USER ? 'You' : '×'}
+        </button>
+      </div>
+    `);
+  });
+}
+
+// Render users available to add
+function renderAvailableUsers(users, append) {
+  const list = $("#availableUsersList");
+  if (!append) list.empty();
+
+  if (!append && (!users || users.length === 0)) {
+    list.append("<div style='padding:8px;color:#666;'>No users available</div>");
+    return;
+  }
+
+  users.forEach(u => {
+    if (membersToAdd.includes(u.username)) return;
+    const img = u.profile_image;
+    list.append(`
+      <div class="member-item" data-username="${u.username}" style="display:flex;align-items:center;justify-content:space-between;padding:8px;border-bottom:1px solid #eee;">
+        <div style="display:flex;align-items:center;gap:8px;">
+          <img src="${img}" alt="${u.username}" style="width:32px;height:32px;border-radius:50%;object-fit:cover;">
+          <span>${u.username}</span>
+        </div>
+        <button type="button" class="add-btn" onclick="addMember('${u.username}')">+</button>
+      </div>
+    `);
+  });
+}
+
+// Add a member to the group
+function addMember(username) {
+  if (!membersToAdd.includes(username)) {
+    membersToAdd.push(username);
+    $(`#availableUsersList .member-item[data-username="${username}"]`).hide();
+    
+    const img = $(`#availableUsersList .member-item[data-username="${username}"] img`).attr("src");
+    $("#currentMembersList").append(`
+      <div class="member-item temp-add" data-username="${username}" style="display:flex;align-items:center;justify-content:space-between;padding:8px;border-bottom:1px solid #eee;">
+        <div style="display:flex;align-items:center;gap:8px;">
+          <img src="${img}" alt="${username}" style="width:32px;height:32px;border-radius:50%;object-fit:cover;">
+          <span>${username}</span>
+        </div>
+        <button type="button" class="remove-btn" onclick="cancelAdd('${username}')">×</button>
+      </div>
+    `);
+  }
+}
+
+// Cancel adding a member
+function cancelAdd(username) {
+  const index = membersToAdd.indexOf(username);
+  if (index !== -1) {
+    membersToAdd.splice(index, 1);
+  }
+  
+  $(`.temp-add[data-username="${username}"]`).remove();
+  $(`#availableUsersList .member-item[data-username="${username}"]`).show();
+}
+
+// Remove a member from the group
+function removeMember(username) {
+  if (username === CURRENT_USER) {
+    alert("You cannot remove yourself from the group");
+    return;
+  }
+  
+  if (!membersToRemove.includes(username)) {
+    membersToRemove.push(username);
+    $(`#currentMembersList .member-item[data-username="${username}"]`).addClass("marked-remove").css("opacity", "0.5");
+  }
+}
+
+// Save member changes
+function saveMembers() {
+  const groupId = $("#editGroupId").val();
+  
+  if (membersToAdd.length === 0 && membersToRemove.length === 0) {
+    backToGroupProfile();
+    return;
+  }
+  
+  $.ajax({
+    url: "/update_group_members",
+    type: "POST",
+    contentType: "application/json",
+    data: JSON.stringify({
+      group_id: groupId,
+      add: membersToAdd,
+      remove: membersToRemove
+    }),
+    success: function() {
+      alert("Members updated successfully!");
+      membersToAdd = [];
+      membersToRemove = [];
+      backToGroupProfile();
+      openGroupProfile(groupId);
+    },
+    error: function(xhr) {
+      alert("Error updating members: " + xhr.responseText);
+    }
+  });
+}
+
+// Return to group profile view
+function backToGroupProfile() {
+  $("#memberManagement").hide();
+  $("#groupProfileForm").hide();
+  $("#groupProfileView").show();
+}
+
+// Profile update handling
+$("#profileForm").on("submit", function (e) {
+  e.preventDefault();
+  var formData = new FormData(this);
+  $.ajax({
+    url: $(this).attr("action"),
+    type: "POST",
+    data: formData,
+    processData: false,
+    contentType: false,
+    success: function () { 
+      $("#profileMessage").html("<p style='color:green'>Profile updated successfully!</p>");
+    },
+    error: function () { 
+      $("#profileMessage").html("<p style='color:red'>Error updating profile</p>");
+    }
+  });
+});
+
+// Group form handling
+$("#groupProfileForm").on("submit", function(e) {
+  e.preventDefault();
+  const groupId = $("#editGroupId").val();
+  
+  if (!groupId) {
+    alert("Error: No group selected");
+    return;
+  }
+  
+  var formData = new FormData(this);
+  
+  $.ajax({
+    url: $(this).attr("action"),
+    type: "POST",
+    data: formData,
+    processData: false,
+    contentType: false,
+    success: function() {
+      alert("Group updated successfully!");
+      closeGroupProfile();
+      location.reload();
+    },
+    error: function(xhr) {
+      alert("Error updating group");
+    }
+  });
+});
+
+// Open group profile
+function openGroupProfile(groupId) {
+  $.ajax({
+    url: "/group_profile/" + groupId,
+    type: "GET",
+    success: function(res) {
+      $("#groupProfilePic").attr("src", res.image || "/static/default_profile.png");
+      $("#groupProfileName").text(res.name);
+      $("#groupProfileDesc").text(res.description || "No description");
+      $("#editGroupId").val(groupId);
+      const admin = currentThread && currentThread.kind === "group" && currentThread.id === groupId && currentThread.created_by === CURRENT_USER;
+      $("#groupAdminControls").css("display", admin ? "flex" : "none");
+      renderGroupMembers(res.members, false);
+      setMembersCursor("profile", res.members_next_cursor);
+      $("#groupProfileModal").show();
+    }
+  });
+}
+
+// Show edit form for group
+function showGroupEditForm() {
+  $("#groupProfileView").hide();
+  $("#groupProfileForm").show();
+}
+
+// Close group profile modal
+function closeGroupProfile() { 
+  $("#groupProfileModal").hide();
+}
+
+// Search filters: open threads are filtered in place, contacts come from /directory
+let directorySearchTimer = null;
+
+function filterSidebarList() {
+  var input = document.getElementById("sidebarSearch").value.toLowerCase();
+  document.querySelectorAll(".chat-list .chat-item:not(.directory-item)").forEach(function (item) {
+    item.style.display = item.innerText.toLowerCase().includes(input) ? "" : "none";
+  });
+  clearTimeout(directorySearchTimer);
+  directorySearchTimer = setTimeout(() => loadDirectory(false), 250);
+}
+
+// Pages of contacts, by username prefix
+const directoryCursors = {};
+
+function fetchDirectory(key, query, append, render) {
+  const params = { q: query };
+  if (append && directoryCursors[key]) params.after = directoryCursors[key];
+  $.ajax({
+    url: URLS.directory,
+    type: "GET",
+    data: params,
+    success: function (res) {
+      directoryCursors[key] = res.next_cursor;
+      render(res.users, append, !!res.next_cursor);
+    }
+  });
+}
+
+function loadDirectory(append) {
+  const query = document.getElementById("sidebarSearch").value.trim();
+  fetchDirectory("sidebar", query, append, function (users, append, more) {
+    const list = document.getElementById("directoryList");
+    if (!append) list.innerHTML = "";
+    users.forEach(u => {
+      // Contacts with a thread are already listed above
+      if (document.querySelector(`.chat-list .chat-item[data-kind="user"][data-id="${CSS.escape(u.username)}"]`)) return;
+      const item = document.createElement("div");
+      item.className = "chat-item directory-item";
+      item.dataset.kind = "user";
+      item.dataset.id = u.username;
+      item.innerHTML = `<img src="${escapeHtml(u.profile_image)}" alt="Profile" class="user-list-pic">
+        <div class="chat-item-text"><span>${escapeHtml(u.username)}</span></div>`;
+      item.querySelector("img").onclick = () => openUserProfile(u.username);
+      item.querySelector(".chat-item-text").onclick = () => switchThread({ user: u.username });
+      list.appendChild(item);
+    });
+    document.getElementById("directoryMore").style.display = more ? "" : "none";
+  });
+}
+
+// User pickers in the create-group and forward dialogs
+let pickerSearchTimer = null;
+
+function searchPicker(key) {
+  clearTimeout(pickerSearchTimer);
+  pickerSearchTimer = setTimeout(() => loadPicker(key, false), 250);
+}
+
+function loadPicker(key, append) {
+  const query = document.getElementById(key + "Search").value.trim();
+  fetchDirectory(key, query, append, function (users, append, more) {
+    const list = document.getElementById(key === "forward" ? "forwardUsers" : "createGroupUsers");
+    if (!append) list.innerHTML = "";
+    users.forEach(u => list.appendChild(key === "forward" ? forwardItem(u) : memberCheckbox(u)));
+    document.getElementById(key + "More").style.display = more ? "" : "none";
+  });
+}
+
+function forwardItem(u) {
+  const item = document.createElement("div");
+  item.className = "forward-item";
+  item.style.cssText = "display:flex;align-items:center;gap:8px;margin:6px 0;cursor:pointer;";
+  item.innerHTML = `<img src="${escapeHtml(u.profile_image)}" alt="Profile"
+    style="width:32px;height:32px;border-radius:50%;object-fit:cover;"><span>${escapeHtml(u.username)}</span>`;
+  item.onclick = () => sendForward(u.username, "user");
+  return item;
+}
+
+function memberCheckbox(u) {
+  const selected = document.getElementById("createGroupSelected");
+  const item = document.createElement("label");
+  item.className = "member-item";
+  item.style.cssText = "display:flex;align-items:center;gap:8px;margin:6px 0;cursor:pointer;";
+  item.innerHTML = `<input type="checkbox"><strong>${escapeHtml(u.username)}</strong>`;
+  const box = item.querySelector("input");
+  box.checked = !!selected.querySelector(`input[value="${CSS.escape(u.username)}"]`);
+  box.onchange = function () {
+    const existing = selected.querySelector(`input[value="${CSS.escape(u.username)}"]`);
+    if (box.checked && !existing) {
+      const hidden = document.createElement("input");
+      hidden.type = "hidden";
+      hidden.name = "members";
+      hidden.value = u.username;
+      selected.appendChild(hidden);
+    } else if (!box.checked && existing) {
+      existing.remove();
+    }
+  };
+  return item;
+}
+
+// Server-side search over the whole thread, debounced while typing
+let chatSearchTimer = null;
+let chatSearchSeq = 0;
+
+function searchChatMessages() {
+  clearTimeout(chatSearchTimer);
+  chatSearchTimer = setTimeout(runChatSearch, 300);
+}
+
+function runChatSearch(page) {
+  const query = document.getElementById("chatSearch").value.trim();
+  const results = $("#chatSearchResults");
+  if (!query || !HISTORY_QUERY) {
+    results.hide().empty();
+    return;
+  }
+  const seq = ++chatSearchSeq;
+  $.ajax({
+    url: URLS.search,
+    type: "GET",
+    data: Object.assign({ q: query, page: page || 0 }, HISTORY_QUERY),
+    success: function (res) {
+      if (seq !== chatSearchSeq) return;  // a newer query is in flight
+      if (!page) results.empty();
+      results.find(".search-more").remove();
+      if (!res.hits.length && !page) {
+        results.append(`<div class="search-empty">No messages found</div>`);
+      }
+      res.hits.forEach(hit => {
+        results.append(`
+          <a class="search-hit" href="${escapeHtml(hit.url)}" onclick="return openSearchHit(this)">
+            <small>${escapeHtml(hit.sender)} · ${hit.timestamp.slice(0, 10)} ${formatIstTime(hit.timestamp)}</small>
+            ${escapeHtml(hit.snippet)}
+          </a>`);
+      });
+      if (res.has_more) {
+        results.append(`<a class="search-hit search-more" href="#" onclick="runChatSearch(${res.page + 1}); return false;">More results…</a>`);
+      }
+      results.show();
+    }
+  });
+}
+
+// Message options menu
+function toggleOptions(el) {
+  let menu = el.nextElementSibling;
+  document.querySelectorAll(".options-menu").forEach(m => { if (m !== menu) m.style.display = "none"; });
+  menu.style.display = (menu.style.display === "block") ? "none" : "block";
+}
+
+// Reply handling
+function replyMessage(msgId, msgText) {
+  document.getElementById("reply_message_id").value = msgId;
+  document.getElementById("reply_message_text").value = msgText;
+  document.getElementById("replyPreviewText").innerText = msgText;
+  document.getElementById("replyPreviewBox").style.display = "flex";
+}
+
+function cancelReply() {
+  document.getElementById("reply_message_id").value = "";
+  document.getElementById("reply_message_text").value = "";
+  document.getElementById("replyPreviewBox").style.display = "none";
+}
+
+// Forward message
+var forwardMsgId = null;
+function forwardMessage(msgId) { 
+  forwardMsgId = msgId; 
+  $("#forwardModal").show();
+  loadPicker("forward", false);
+}
+
+function closeForwardModal() { 
+  $("#forwardModal").hide();
+  forwardMsgId = null;
+}
+
+function sendForward(targetId, chatType) {
+  if (!forwardMsgId) return;
+  $.ajax({
+    url: "/forward_message",
+    type: "POST",
+    contentType: "application/json",
+    data: JSON.stringify({ message_id: forwardMsgId, target_id: targetId, chat_type: chatType }),
+    success: function () { 
+      alert("Message forwarded!");
+      closeForwardModal();
+    },
+    error: function () {
+      alert("Error forwarding message");
+    }
+  });
+}
+
+// Copy message to clipboard
+function copyMessage(msg) {
+  navigator.clipboard.writeText(msg).then(() => alert("Message copied!"));
+}
+
+// Close menus when clicking elsewhere
+document.addEventListener("click", function (e) {
+  if (!e.target.classList.contains("dots")) {
+    document.querySelectorAll(".options-menu").forEach(m => m.style.display = "none");
+  }
+  if (!e.target.closest(".search-results") && e.target.id !== "chatSearch") {
+    $("#chatSearchResults").hide();
+  }
+});
+
+// Group creation form handling
+$("#createGroupForm").on("submit", function (e) {
+  e.preventDefault();
+  var formData = new FormData(this);
+
+  $.ajax({
+    url: $(this).attr("action"),
+    type: "POST",
+    data: formData,
+    processData: false,
+    contentType: false,
+    success: function () {
+      $("#createGroupMessage").html("<p style='color:green'>Group created successfully!</p>");
+      closeCreateGroup();
+      location.reload();
+    },
+    error: function () {
+      $("#createGroupMessage").html("<p style='color:red'>Error creating group</p>");
+    }
+  });
+});
+
+function renderGroupMembers(members, append) {
+  const list = $("#groupMembersList");
+  if (!append) list.empty();
+  
+  if (!append && (!members || !members.length)) {
+    list.append("<li>No members yet</li>");
+    return;
+  }
+  
+  // Debug log to check what we're receiving
+  console.log("Members data:", members);
+
+  members.forEach(member => {
+    // Handle different possible formats of member data
+    let username, profileImg;
+    
+    if (typeof member === 'string') {
+      // If member is just a string (username)
+      username = member;
+      profileImg = "/static/default_profile.png";
+    } else {
+      // If member is an object with username and profile_image
+      username = member.username || "Unknown";
+      profileImg = member.profile_image || "/static/default_profile.png";
+    }
+    
+    list.append(`
+      <li style="display:flex; align-items:center; gap:8px; padding:8px 4px; border-bottom:1px solid #eee;">
+        <img src="${profileImg}" alt="${username}" style="width:32px; height:32px; border-radius:50%; object-fit:cover;">
+        <span>${username}</span>
+      </li>
+    `);
+  });
+}
+
+function openCreateGroup() {
+  $("#createGroupModal").show();
+  loadPicker("createGroup", false);
+}
+
+function closeCreateGroup() {
+  $("#createGroupModal").hide();
+  $("#createGroupForm")[0].reset();
+  $("#createGroupSelected").empty();
+  $("#createGroupMessage").html("");
+}
+
+$(window).on("click", function (e) {
+  if ($(e.target).is("#createGroupModal")) {
+    closeCreateGroup();
+  }
+});
+
+$(document).on("keydown", function (e) {
+  if (e.key === "Escape") {
+    closeCreateGroup();
+    closeProfileModal();
+    closeGroupProfile();
+    closeUserProfile();
+    closeForwardModal();
+    closeImageModal();
+  }
+});
+
+function handleFileSelect(input) {
+  const file = input.files[0];
+  if (!file) return;
+  
+  // Check 5MB limit
+  if (file.size > 5 * 1024 * 1024) {
+    alert("File size exceeds 5MB limit");
+    input.value = "";
+    return;
+  }
+  
+  const form = input.form;
+  const container = form.querySelector('.file-preview-container');
+  const nameDisplay = form.querySelector('.file-name');
+  
+  // Set icon based on file type
+  let icon = '📄';
+  if (file.type.startsWith('image/')) icon = '🖼️';
+  else if (file.type.startsWith('video/')) icon = '🎬';
+  else if (file.type.startsWith('audio/')) icon = '🎵';
+  else if (file.name.match(/\.pdf$/i)) icon = '📕';
+  else if (file.name.match(/\.(doc|docx)$/i)) icon = '📝';
+  else if (file.name.match(/\.(js|py|html|css)$/i)) icon = '💻';
+  
+  // Display file info
+  nameDisplay.textContent = `${icon} ${file.name} (${Math.round(file.size/1024)} KB)`;
+  container.style.display = 'block';
+}
+
+function removeSelectedFile(form) {
+  const fileInput = form.querySelector('input[type="file"]');
+  const container = form.querySelector('.file-preview-container');
+  
+  fileInput.value = "";
+  container.style.display = "none";
+}
+
+// First render from the data embedded in the page
+renderSidebar(BOOT.sidebar);
+renderThread(BOOT.thread);
+loadDirectory(false);
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# In-process MongoDB stand-in (needs ``mongomock``); set before the app is imported
+os.environ.setdefault("MONGO_URI", "mongomock://")
+os.environ.setdefault("PRESENCE_FLUSH_MS", "50")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,38 @@
+import gzip
+
+from flask import Flask, session
+
+import compression
+
+
+def _app():
+    app = Flask(__name__)
+    app.secret_key = "test"
+    compression.init_app(app)
+
+    @app.route("/page")
+    def page():
+        return "x" * 4096
+
+    @app.route("/login")
+    def login():
+        session["user"] = "alice"
+        return "x" * 4096
+
+    return app
+
+
+def test_large_page_is_compressed():
+    response = _app().test_client().get("/page", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == b"x" * 4096
+    assert response.headers["Content-Length"] == str(len(response.data))
+
+
+def test_response_setting_the_session_cookie_is_not_compressed():
+    response = _app().test_client().get("/login", headers={"Accept-Encoding": "gzip"})
+
+    assert "session=" in response.headers["Set-Cookie"]
+    assert "Content-Encoding" not in response.headers
+    assert response.data == b"x" * 4096
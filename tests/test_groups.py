@@ -0,0 +1,25 @@
+from app import app
+from db_config import get_db
+import membership
+
+
+def _client(username):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = username
+    return client
+
+
+def test_group_members_requires_membership():
+    db = get_db()
+    group_id = str(db["groups"].insert_one({"name": "team", "member_count": 0}).inserted_id)
+    membership.add_members(db, group_id, ["alice", "bob"])
+
+    response = _client("alice").get(f"/group_members/{group_id}?limit=1")
+    assert response.status_code == 200
+    assert [m["username"] for m in response.get_json()["members"]] == ["alice"]
+    assert response.get_json()["members_next_cursor"] == "alice"
+
+    assert _client("mallory").get(f"/group_members/{group_id}").status_code == 403
+    assert _client("alice").get("/group_members/not-an-id").status_code == 400
+    assert _client("alice").get("/group_members/" + "0" * 24).status_code == 404
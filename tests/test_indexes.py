@@ -0,0 +1,15 @@
+import mongomock
+
+from indexes import INDEXES, ensure_indexes
+
+
+def test_failing_collection_does_not_block_the_others():
+    db = mongomock.MongoClient().db
+    db["users"].insert_many([{"username": "alice", "email": "a@example.com"},
+                             {"username": "alice", "email": "b@example.com"}])
+
+    created, failed = ensure_indexes(db)
+
+    assert list(failed) == ["users"]
+    assert set(created) == set(INDEXES) - {"users"}
+    assert "expires" in db["presence"].index_information()
@@ -0,0 +1,49 @@
+import mongomock
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import ingest
+
+
+def _db():
+    return mongomock.MongoClient().db
+
+
+def test_partial_failure_reports_the_stored_documents():
+    db = _db()
+    db["messages"].insert_one({"_id": 2})
+    docs = [{"_id": 1}, {"_id": 2}, {"_id": 3}]
+
+    stored, error = ingest.insert_messages(db, "messages", docs)
+
+    assert [d["_id"] for d in stored] == [1, 3]
+    assert isinstance(error, ingest.IngestFailed)
+
+
+def test_write_concern_errors_alone_count_as_stored(monkeypatch):
+    db = _db()
+    details = {"writeErrors": [], "writeConcernErrors": [{"code": 64, "errmsg": "waiting for replication timed out"}]}
+
+    def insert_many(docs, ordered=True):
+        raise BulkWriteError(details)
+
+    monkeypatch.setattr(db["messages"], "insert_many", insert_many)
+    stored, error = ingest.insert_messages(db, "messages", [{"_id": 1}, {"_id": 2}])
+
+    assert [d["_id"] for d in stored] == [1, 2]
+    assert error is None
+
+
+def test_interrupted_write_looks_up_what_landed(monkeypatch):
+    db = _db()
+    coll = db["messages"]
+    real_insert_many = coll.insert_many
+
+    def insert_many(docs, ordered=True):
+        real_insert_many(docs[:1], ordered=ordered)
+        raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(coll, "insert_many", insert_many)
+    stored, error = ingest.insert_messages(db, "messages", [{"_id": 1}, {"_id": 2}])
+
+    assert [d["_id"] for d in stored] == [1]
+    assert isinstance(error, ingest.IngestFailed)
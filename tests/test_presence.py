@@ -0,0 +1,33 @@
+import time
+
+from app import app
+from sockets import socketio
+
+
+def _client(username):
+    http = app.test_client()
+    with http.session_transaction() as session:
+        session["user"] = username
+    return socketio.test_client(app, flask_test_client=http)
+
+
+def _wait_for(client, event, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for received in client.get_received():
+            if received["name"] == event:
+                return received["args"][0]
+        time.sleep(0.05)
+    return None
+
+
+def test_typing_reaches_the_peer():
+    alice, bob = _client("alice"), _client("bob")
+    try:
+        assert alice.emit("typing", {"chat_type": "user", "id": "bob", "typing": True}, callback=True)["success"]
+        event = _wait_for(bob, "typing")
+        assert event is not None, "the presence flush loop never ran"
+        assert event["id"] == "alice" and event["typing"] == ["alice"]
+    finally:
+        alice.disconnect()
+        bob.disconnect()
@@ -0,0 +1,7 @@
+from ratelimit import _parse_limit
+
+
+def test_parse_limit_falls_back_on_unusable_values():
+    assert _parse_limit("2/10", (1, 5)) == (2.0, 10.0)
+    for value in (None, "", "fast", "1/2/3", "0/10", "-1/10", "2/0", "inf/10", "nan/10"):
+        assert _parse_limit(value, (1, 5)) == (1, 5)
@@ -0,0 +1,46 @@
+import io
+
+from app import app
+from blob_store import UploadTooLarge
+from db_config import get_db
+import membership
+import ratelimit
+import send_message
+
+
+def _client(username):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = username
+    return client
+
+
+def test_non_member_cannot_post_to_group():
+    db = get_db()
+    group_id = str(db["groups"].insert_one({"name": "closed", "member_count": 0}).inserted_id)
+    membership.add_members(db, group_id, ["alice"])
+
+    response = _client("mallory").post("/send_message", data={"chat_type": "group", "receiver": group_id,
+                                                               "message": "hi"},
+                                       headers={"Accept": "application/json"})
+    assert response.status_code == 403
+    assert db["group_messages"].count_documents({"group_id": group_id}) == 0
+
+    response = _client("alice").post("/send_message", data={"chat_type": "group", "receiver": group_id,
+                                                             "message": "hi"},
+                                     headers={"Accept": "application/json"})
+    assert response.status_code == 200
+
+
+def test_oversized_upload_refunds_its_tokens(monkeypatch):
+    def save_upload(db, file):
+        raise UploadTooLarge("File exceeds 1 MB limit")
+
+    refunded = []
+    monkeypatch.setattr(send_message, "save_upload", save_upload)
+    monkeypatch.setattr(ratelimit, "refund", lambda name, cost=1: refunded.append(name))
+    response = _client("alice").post("/send_message", data={"chat_type": "user", "receiver": "bob",
+                                                             "file": (io.BytesIO(b"x"), "a.png")},
+                                     headers={"Accept": "application/json"})
+    assert response.status_code == 413
+    assert sorted(refunded) == ["send", "upload"]
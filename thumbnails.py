@@ -0,0 +1,140 @@
+"""Background thumbnails for image messages and first-page previews for PDFs.
+
+send_message marks the message ``thumbnail_status: "pending"`` and hands it
+to a small worker pool; the request never waits. The worker renders a
+bounded-size JPEG, stores it in the blob store, records it on the message
+(and on the source blob, so re-sends of the same file reuse it) and pushes a
+``message_updated`` event to the thread. The thumbnail's blob reference
+belongs to the source blob and is released along with it, so it lives
+exactly as long as some message still holds the original. Pillow is
+optional: without it the status becomes "failed" and clients keep showing
+the original.
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from db_config import get_db
+import blob_store
+
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_MAX_PX = int(os.environ.get("THUMBNAIL_MAX_PX", 320))
+THUMBNAIL_QUALITY = 80
+PREVIEWABLE = {"png", "jpg", "jpeg", "gif", "pdf"}
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS,
+                                               thread_name_prefix="thumbnail")
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _pdf_first_page(path):
+    """PNG bytes of page one, via PyMuPDF or poppler's pdftoppm, or None."""
+    try:
+        import fitz  # PyMuPDF, optional
+        with fitz.open(path) as pdf:
+            return pdf[0].get_pixmap(dpi=72).tobytes("png")
+    except ImportError:
+        pass
+
+    if shutil.which("pdftoppm"):
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, "page")
+            subprocess.run(["pdftoppm", "-png", "-r", "72", "-singlefile", "-f", "1", "-l", "1", path, prefix],
+                           check=True, timeout=30, capture_output=True)
+            with open(prefix + ".png", "rb") as f:
+                return f.read()
+    return None
+
+
+def render_thumbnail(path, ext):
+    """JPEG bytes no larger than THUMBNAIL_MAX_PX on either side, or None."""
+    from PIL import Image, ImageOps
+
+    source = path
+    if ext == "pdf":
+        page = _pdf_first_page(path)
+        if page is None:
+            return None
+        source = io.BytesIO(page)
+
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((THUMBNAIL_MAX_PX, THUMBNAIL_MAX_PX))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+def needs_thumbnail(blob):
+    return blob.get("ext") in PREVIEWABLE
+
+
+def _generate(collection, msg_doc, digest):
+    from sockets import broadcast_message_update
+
+    db = get_db()
+    status, url = "failed", None
+    try:
+        blob = db["blobs"].find_one({"_id": digest})
+        url = blob.get("thumbnail_url") if blob else None
+        if blob and not url:
+            data = render_thumbnail(blob_store.blob_path(blob), blob.get("ext"))
+            if data:
+                # The source blob owns this reference; release() drops it with the blob
+                url = blob_store.store_bytes(db, data, "jpg", "image/jpeg")["url"]
+                linked = db["blobs"].update_one({"_id": digest, "thumbnail_url": {"$exists": False}},
+                                                {"$set": {"thumbnail_url": url}}).modified_count
+                if not linked:
+                    # Another job linked one first, or the source is gone: ours has no owner
+                    blob_store.release(db, blob_store.hash_from_url(url))
+                    source = db["blobs"].find_one({"_id": digest}, {"thumbnail_url": 1})
+                    url = source.get("thumbnail_url") if source else None
+        if url:
+            status = "ready"
+    except Exception:
+        url = None
+
+    fields = {"thumbnail_status": status}
+    if url:
+        fields["thumbnail_url"] = url
+    db[collection].update_one({"_id": msg_doc["_id"]}, {"$set": fields})
+    broadcast_message_update(msg_doc, fields)
+
+
+def prepare(msg_doc, blob):
+    """Set thumbnail fields on a message before insert.
+
+    Returns True when a background job is needed (call ``schedule`` after the
+    message is stored), False when the blob already has a thumbnail or none
+    applies.
+    """
+    if not needs_thumbnail(blob):
+        return False
+    if blob.get("thumbnail_url"):
+        msg_doc["thumbnail_url"] = blob["thumbnail_url"]
+        msg_doc["thumbnail_status"] = "ready"
+        return False
+    msg_doc["thumbnail_status"] = "pending"
+    return True
+
+
+def schedule(collection, msg_doc):
+    """Queue thumbnail generation for a stored message; returns immediately."""
+    _get_executor().submit(_generate, collection, msg_doc, msg_doc["file_hash"])